@@ -0,0 +1,387 @@
+"""
+metrics of every python file of a corpus, computed in a process pool and streamed
+to a JSONL or CSV file, optionally before and after a transform
+
+    python batch.py repo/ other_repo/ -o metrics.jsonl --transform expand_all
+"""
+import argparse
+import csv
+import json
+import math
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from radon.complexity import cc_rank
+
+from graph import CodeGraph
+from metrics import GraphMetrics
+from transforms import expand_all_calls, remove_redundant_variables
+
+
+FILE_METRICS = (
+    'Average Complexity', 'Lines of Code', 'Maintainability Index', 'Total Complexity',
+    'Halstead Volume', 'Halstead Difficulty', 'Halstead Effort',
+)
+FUNCTION_METRICS = ('Complexity', 'Lines of Code', 'Halstead Volume', 'Maintainability Index')
+
+# transforms that can be named on the command line
+TRANSFORMS: Dict[str, Callable[[CodeGraph], object]] = {
+    "expand_all": expand_all_calls,
+    "remove_redundant_variables": remove_redundant_variables,
+}
+
+_graph_metrics = GraphMetrics()
+
+
+def columns(transform: bool) -> List[str]:
+    """
+    columns of the output: kind is "file", "function" or "error", stage is
+    "before" or "after" the transform for function rows
+    """
+    names = ["kind", "stage", "file", "function", "lineno", "error"]
+    names += list(FILE_METRICS)
+    if transform:
+        names += [f"{name} after" for name in FILE_METRICS]
+        names += [f"{name} delta" for name in FILE_METRICS]
+    names += [name for name in FUNCTION_METRICS if name not in FILE_METRICS]
+    return names
+
+
+def measure_file(filename: str, transform: Callable[[CodeGraph], object] = None) -> List[Dict]:
+    """
+    rows of a file: one per function, then the file row, which comes last so that
+    a file whose file row is written is complete (see MetricsBatch resume)
+    """
+    try:
+        G = CodeGraph.from_file(filename)
+    except (SyntaxError, ValueError, UnicodeDecodeError, RecursionError) as e:
+        return [{"kind": "error", "file": filename, "error": _error(e)}]
+
+    row = {"kind": "file", "file": filename}
+    row.update(_graph_metrics(G))
+    rows = list(_function_rows(G, filename, "before" if transform else None))
+    if transform is not None:
+        try:
+            transform(G)
+            after = _graph_metrics(G)
+        except (
+            AssertionError, AttributeError, IndexError, KeyError, TypeError, ValueError,
+            RecursionError,
+        ) as e:
+            row["error"] = _error(e)
+        else:
+            for name in FILE_METRICS:
+                row[f"{name} after"] = after[name]
+                row[f"{name} delta"] = after[name] - row[name]
+            rows.extend(_function_rows(G, filename, "after"))
+    rows.append(row)
+    return rows
+
+
+def _function_rows(G: CodeGraph, filename: str, stage: Optional[str]) -> Iterator[Dict]:
+    for node_id, name, counts in _graph_metrics.functions(G):
+        yield {
+            "kind": "function",
+            "stage": stage,
+            "file": filename,
+            "function": name,
+            "lineno": getattr(G.ast_nodes[node_id], "lineno", None),
+            "Complexity": counts.complexity,
+            "Lines of Code": counts.lloc,
+            "Halstead Volume": counts.volume,
+            "Maintainability Index": counts.maintainability_index,
+        }
+
+
+def _error(e: Exception) -> str:
+    # on one line, the output is read back line by line
+    return f"{e.__class__.__name__}: {e}".replace("\n", " ")
+
+
+def _measure_files(filenames: List[str], transform) -> List[Tuple[str, List[Dict]]]:
+    return [(filename, measure_file(filename, transform)) for filename in filenames]
+
+
+class RunningStats:
+    """
+    count, mean, standard deviation, min and max of a stream of values (Welford)
+    """
+
+    __slots__ = ("count", "mean", "_m2", "min", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = self._m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def to_dict(self) -> Dict[str, float]:
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count, "mean": self.mean, "std": self.std, "min": self.min, "max": self.max}
+
+
+class Summary:
+    """
+    corpus statistics updated row by row: RunningStats of every metric of the
+    files (before, after and delta) and of the functions before the transform,
+    the functions per complexity rank (radon's A to F) and the maintainability
+    index of the corpus, the mean over the files weighted by their lines of code
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.errors = 0
+        self.transform_errors = 0
+        self.stats: Dict[str, RunningStats] = {}
+        self.ranks: Dict[str, int] = {rank: 0 for rank in "ABCDEF"}
+        self._weighted_mi = self._lloc = 0.0
+
+    def add(self, row: Dict):
+        kind = row["kind"]
+        if kind == "error":
+            self.errors += 1
+            return
+        if kind == "function":
+            if row.get("stage") == "after":
+                return
+            for name in FUNCTION_METRICS:
+                self._add(f"function {name}", row[name])
+            self.ranks[cc_rank(int(float(row["Complexity"])))] += 1
+            return
+
+        self.files += 1
+        if row.get("error"):
+            self.transform_errors += 1
+        for name in FILE_METRICS:
+            for column in (name, f"{name} after", f"{name} delta"):
+                self._add(column, row.get(column))
+        lloc = float(row["Lines of Code"])
+        self._weighted_mi += float(row["Maintainability Index"]) * lloc
+        self._lloc += lloc
+
+    def _add(self, name: str, value):
+        if value is None or value == "":
+            return
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = RunningStats()
+        stats.add(float(value))
+
+    @property
+    def maintainability_index(self) -> float:
+        return self._weighted_mi / self._lloc if self._lloc else 100.0
+
+    def to_dict(self) -> Dict:
+        return {
+            "files": self.files,
+            "errors": self.errors,
+            "transform errors": self.transform_errors,
+            "Maintainability Index": self.maintainability_index,
+            "ranks": dict(self.ranks),
+            "stats": {name: stats.to_dict() for name, stats in self.stats.items()},
+        }
+
+    def report(self) -> str:
+        lines = [
+            f"{self.files} files ({self.errors} failed to parse, "
+            f"{self.transform_errors} failed to transform)",
+            f"Maintainability Index (weighted by lines of code): {self.maintainability_index:.2f}",
+            "functions per complexity rank: "
+            + ", ".join(f"{rank} {count}" for rank, count in self.ranks.items()),
+        ]
+        for name, stats in self.stats.items():
+            if stats.count:
+                lines.append(
+                    f"  {name}: mean {stats.mean:.2f}, std {stats.std:.2f}, "
+                    f"min {stats.min:.2f}, max {stats.max:.2f}"
+                )
+        return "\n".join(lines)
+
+
+class MetricsBatch:
+    """
+    measures every file matching pattern under the given paths and appends its rows
+    to output (CSV if its name ends with .csv, JSONL otherwise) as soon as the
+    file is measured, the rows of a file are written at once and flushed
+
+    transform: function changing a CodeGraph in place, the file rows then also
+        hold the metrics after it and the deltas, it is sent to the worker
+        processes so it has to be picklable (defined at module level)
+    workers: number of processes, os.cpu_count() by default and 0 to measure in
+        this process
+    chunksize: files sent to a worker at a time, at most 2 chunks per worker are
+        in flight
+    resume: if output exists, the files it has a file or error row for are
+        skipped and the rows of an interrupted file are dropped, otherwise
+        output is overwritten
+    """
+
+    def __init__(
+        self,
+        output,
+        transform: Callable[[CodeGraph], object] = None,
+        pattern: str = "*.py",
+        workers: int = None,
+        chunksize: int = 8,
+        resume: bool = True,
+    ):
+        self.output = Path(output)
+        self.transform = transform
+        self.pattern = pattern
+        self.workers = workers
+        self.chunksize = chunksize
+        self.resume = resume
+        self.csv = self.output.suffix.lower() == ".csv"
+        self.columns = columns(transform is not None)
+
+    def run(self, paths: Iterable) -> Summary:
+        """
+        measures the files and returns the Summary of all the rows of output,
+        the ones of an earlier run included
+        """
+        if isinstance(paths, (str, os.PathLike)):
+            paths = [paths]
+        summary = Summary()
+        resume = self.resume and self.output.exists()
+        done = self._resume(summary) if resume else set()
+        filenames = [f for f in self._filenames(paths) if f not in done]
+
+        with open(self.output, "a" if resume else "w", newline="") as file:
+            if self.csv:
+                writer = csv.DictWriter(file, self.columns, restval="", extrasaction="ignore")
+                if file.tell() == 0:
+                    writer.writeheader()
+                write = writer.writerows
+            else:
+                def write(rows):
+                    file.write("".join(json.dumps(row) + "\n" for row in rows))
+
+            for filename, rows in self._measure(filenames):
+                write(rows)
+                file.flush()
+                for row in rows:
+                    summary.add(row)
+                if rows[-1]["kind"] == "error":
+                    print(f"Warning: skipping {filename}: {rows[-1]['error']}")
+        return summary
+
+    def _filenames(self, paths: Iterable) -> List[str]:
+        filenames = []
+        for path in paths:
+            path = Path(path)
+            if path.is_file():
+                filenames.append(str(path))
+            else:
+                filenames.extend(sorted(str(p) for p in path.rglob(self.pattern) if p.is_file()))
+        return filenames
+
+    def _measure(self, filenames: List[str]) -> Iterator[Tuple[str, List[Dict]]]:
+        """
+        yields (filename, rows) as the chunks are measured, in no particular order
+        """
+        chunks = [filenames[i : i + self.chunksize] for i in range(0, len(filenames), self.chunksize)]
+        if self.workers == 0:
+            for chunk in chunks:
+                yield from _measure_files(chunk, self.transform)
+            return
+
+        workers = self.workers or os.cpu_count()
+        chunks = iter(chunks)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = {executor.submit(_measure_files, c, self.transform) for c in islice(chunks, 2 * workers)}
+            try:
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.update(executor.submit(_measure_files, c, self.transform) for c in islice(chunks, 1))
+                        yield from future.result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _resume(self, summary: Summary) -> set:
+        """
+        reads output back one row at a time, adding the rows of the complete files
+        to summary, and truncates it after the last complete file
+        """
+        done = set()
+        end = 0
+        with open(self.output, "rb") as file:
+            if self.csv:
+                header = next(csv.reader([file.readline().decode("utf-8")]), [])
+                if header != self.columns:
+                    raise ValueError(f"{self.output} has other columns, it cannot be resumed")
+                end = file.tell()
+            pending = []
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                line = line.decode("utf-8")
+                if self.csv:
+                    row = next(csv.DictReader([line], self.columns))
+                else:
+                    row = json.loads(line)
+                pending.append(row)
+                if row["kind"] != "function":
+                    for pending_row in pending:
+                        summary.add(pending_row)
+                    pending = []
+                    done.add(row["file"])
+                    end = file.tell()
+        with open(self.output, "r+b") as file:
+            file.truncate(end)
+        return done
+
+
+def run_batch(paths: Iterable, output, **kwargs) -> Summary:
+    """
+    MetricsBatch(output, **kwargs).run(paths)
+    """
+    return MetricsBatch(output, **kwargs).run(paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="files and directories to measure")
+    parser.add_argument("-o", "--output", default="metrics.jsonl", help="JSONL or CSV (.csv) file")
+    parser.add_argument("--transform", choices=sorted(TRANSFORMS))
+    parser.add_argument("--pattern", default="*.py")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunksize", type=int, default=8)
+    parser.add_argument("--restart", action="store_true", help="overwrite output instead of resuming")
+    parser.add_argument("--summary", help="also write the summary as JSON to this file")
+    args = parser.parse_args()
+
+    summary = run_batch(
+        args.paths,
+        args.output,
+        transform=TRANSFORMS.get(args.transform),
+        pattern=args.pattern,
+        workers=args.workers,
+        chunksize=args.chunksize,
+        resume=not args.restart,
+    )
+    print(summary.report())
+    if args.summary:
+        with open(args.summary, "w") as file:
+            json.dump(summary.to_dict(), file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+time of building a CodeGraph (nodes, edges and syntax tokens) on deep and wide trees
+
+    python benchmarks/bench_traversal.py [--repeat 3]
+"""
+import argparse
+import ast
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from graph import CodeGraph  # noqa: E402
+
+
+def deep_tree(depth: int) -> ast.Module:
+    """
+    def f(a): return a + a + ... + a, nested depth times
+    """
+    expr = ast.Name(id="a", ctx=ast.Load())
+    for _ in range(depth):
+        expr = ast.BinOp(left=expr, op=ast.Add(), right=ast.Name(id="a", ctx=ast.Load()))
+    tree = ast.parse("def f(a):\n    return a")
+    tree.body[0].body[0].value = expr
+    return tree
+
+
+def wide_tree(width: int) -> ast.Module:
+    """
+    a function with width statements
+    """
+    body = "".join(f"    x{i} = a + {i}\n" for i in range(width))
+    return ast.parse(f"def f(a):\n{body}    return a\n")
+
+
+def bench(tree: ast.Module, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        G = CodeGraph(tree)
+        best = min(best, time.perf_counter() - start)
+    return len(G.ast_nodes), best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    cases = [(f"deep {n}", deep_tree(n)) for n in (100, 1000, 10000, 50000)]
+    cases += [(f"wide {n}", wide_tree(n)) for n in (100, 1000, 10000)]
+
+    print(f"{'case':<12}{'nodes':>10}{'seconds':>10}{'us/node':>10}")
+    for name, tree in cases:
+        try:
+            n, seconds = bench(tree, args.repeat)
+        except RecursionError:
+            print(f"{name:<12}{'RecursionError':>30}")
+            continue
+        print(f"{name:<12}{n:>10}{seconds:>10.3f}{seconds / n * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+import ast
+from array import array
+from collections.abc import Mapping
+from typing import Callable, Dict, FrozenSet, Iterator, List, Tuple
+
+from graph import ASTEdge, ASTNode, CodeGraph, Occurence, ROOT_ID, path_id
+
+
+NODE_TYPES: List[str] = sorted(
+    name
+    for name, cls in vars(ast).items()
+    if isinstance(cls, type) and issubclass(cls, ast.AST)
+)
+TYPE_CODES: Dict[str, int] = {name: i for i, name in enumerate(NODE_TYPES)}
+
+# code 0 is the root, which is not stored in any field
+FIELD_NAMES: List[str] = [""] + sorted(
+    {field for name in NODE_TYPES for field in getattr(ast, name)._fields}
+)
+FIELD_CODES: Dict[str, int] = {name: i for i, name in enumerate(FIELD_NAMES)}
+
+# CodeGraph keeps these out of our_nodes and our_edges
+HIDDEN_TYPES: FrozenSet[int] = frozenset((TYPE_CODES["Load"], TYPE_CODES["Store"]))
+
+
+def preorder(ast_tree: ast.AST) -> Iterator[Tuple[ast.AST, int, int, int]]:
+    """
+    yields (node, parent index, field code, list position) for every node in preorder
+    """
+    stack = [(ast_tree, -1, 0, -1)]
+    i = 0
+    while stack:
+        item = stack.pop()
+        yield item
+        node = item[0]
+        children = []
+        for name, value in ast.iter_fields(node):
+            if isinstance(value, list):
+                for j, child in enumerate(value):
+                    if isinstance(child, ast.AST):
+                        children.append((child, i, FIELD_CODES[name], j))
+            elif isinstance(value, ast.AST):
+                children.append((value, i, FIELD_CODES[name], -1))
+        stack.extend(reversed(children))
+        i += 1
+
+
+class CompactTree:
+    """
+    ast tree flattened in preorder: node i has type NODE_TYPES[types[i]], its parent
+    is parents[i] (-1 for the root), it is stored in the field FIELD_NAMES[fields[i]]
+    of the parent at position list_index[i] (-1 if the field is not a list), its
+    children are child_index[child_offsets[i]:child_offsets[i + 1]] and its subtree
+    is range(i, ends[i])
+    """
+
+    __slots__ = (
+        "nodes",
+        "ids",
+        "types",
+        "parents",
+        "fields",
+        "list_index",
+        "depths",
+        "ends",
+        "child_offsets",
+        "child_index",
+        "index",
+    )
+
+    def __init__(self, ast_tree: ast.AST):
+        nodes = []
+        ids = array("q")
+        types = array("H")
+        parents = array("i")
+        fields = array("H")
+        list_index = array("i")
+        depths = array("i")
+
+        for node, parent, field, position in preorder(ast_tree):
+            nodes.append(node)
+            ids.append(
+                ROOT_ID
+                if parent < 0
+                else path_id(ids[parent], FIELD_NAMES[field], position)
+            )
+            types.append(TYPE_CODES[node.__class__.__name__])
+            parents.append(parent)
+            fields.append(field)
+            list_index.append(position)
+            depths.append(0 if parent < 0 else depths[parent] + 1)
+
+        n = len(nodes)
+        child_offsets = array("i", bytes(4 * (n + 1)))
+        for p in parents:
+            if p >= 0:
+                child_offsets[p + 1] += 1
+        for i in range(n):
+            child_offsets[i + 1] += child_offsets[i]
+
+        child_index = array("i", bytes(4 * (n - 1)))
+        fill = child_offsets[:-1]
+        ends = array("i", range(1, n + 1))
+        for i in range(1, n):
+            p = parents[i]
+            child_index[fill[p]] = i
+            fill[p] += 1
+        for i in range(n - 1, 0, -1):
+            p = parents[i]
+            if ends[i] > ends[p]:
+                ends[p] = ends[i]
+
+        self.nodes: List[ast.AST] = nodes
+        self.ids = ids
+        self.types = types
+        self.parents = parents
+        self.fields = fields
+        self.list_index = list_index
+        self.depths = depths
+        self.ends = ends
+        self.child_offsets = child_offsets
+        self.child_index = child_index
+
+        self.index: Dict[int, int] = {node_id: i for i, node_id in enumerate(ids)}
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def copy(self) -> "CompactTree":
+        """
+        copy with its own node list, the arrays are never modified and are shared
+        """
+        tree = object.__new__(CompactTree)
+        for name in CompactTree.__slots__:
+            setattr(tree, name, getattr(self, name))
+        tree.nodes = list(self.nodes)
+        return tree
+
+    def children(self, i: int) -> array:
+        return self.child_index[self.child_offsets[i] : self.child_offsets[i + 1]]
+
+    def where(self, *type_names: str) -> List[int]:
+        """
+        indices of all nodes of the given types, in preorder
+        """
+        codes = {TYPE_CODES[name] for name in type_names}
+        return [i for i, code in enumerate(self.types) if code in codes]
+
+
+class CompactASTNode(ASTNode):
+    __slots__ = ("_tree", "_index")
+
+    def __init__(self, tree: CompactTree, index: int):
+        self._tree = tree
+        self._index = index
+        self.node_id = tree.ids[index]
+        self.ast_node = tree.nodes[index]
+
+    def __reduce__(self):
+        return (self.__class__, (self._tree, self._index))
+
+    @property
+    def parent(self):
+        p = self._tree.parents[self._index]
+        return CompactASTNode(self._tree, p) if p >= 0 else None
+
+
+class CompactASTEdge(ASTEdge):
+    __slots__ = ("_tree", "_index")
+
+    def __init__(self, tree: CompactTree, index: int):
+        self._tree = tree
+        self._index = index
+        self.parent = CompactASTNode(tree, tree.parents[index])
+        self.child = CompactASTNode(tree, index)
+
+    def __reduce__(self):
+        return (self.__class__, (self._tree, self._index))
+
+    @property
+    def attrs(self) -> List:
+        field = FIELD_NAMES[self._tree.fields[self._index]]
+        position = self._tree.list_index[self._index]
+        return [field] if position < 0 else [field, position]
+
+
+def _ast_node(tree: CompactTree, index: int) -> ast.AST:
+    return tree.nodes[index]
+
+
+class CompactNodes(Mapping):
+    """
+    read-only node_id -> value(tree, index) mapping over a CompactTree
+    """
+
+    def __init__(
+        self,
+        tree: CompactTree,
+        value: Callable = _ast_node,
+        hidden: FrozenSet[int] = frozenset(),
+    ):
+        self._tree = tree
+        self._value = value
+        self._hidden = hidden
+        self._len = None
+
+    def __getitem__(self, node_id: int):
+        i = self._tree.index[node_id]
+        if self._tree.types[i] in self._hidden:
+            raise KeyError(node_id)
+        return self._value(self._tree, i)
+
+    def __contains__(self, node_id) -> bool:
+        i = self._tree.index.get(node_id)
+        return i is not None and self._tree.types[i] not in self._hidden
+
+    def __iter__(self) -> Iterator[int]:
+        types, hidden = self._tree.types, self._hidden
+        for i, node_id in enumerate(self._tree.ids):
+            if types[i] not in hidden:
+                yield node_id
+
+    def __len__(self) -> int:
+        if self._len is None:
+            self._len = sum(1 for _ in self)
+        return self._len
+
+
+class CompactEdges(Mapping):
+    """
+    read-only (parent_id, child_id) -> value(tree, child_index) mapping over a CompactTree
+    """
+
+    def __init__(
+        self,
+        tree: CompactTree,
+        value: Callable = CompactASTEdge,
+        hidden: FrozenSet[int] = frozenset(),
+    ):
+        self._tree = tree
+        self._value = value
+        self._hidden = hidden
+        self._len = None
+
+    def __getitem__(self, key: Tuple[int, int]):
+        parent_id, child_id = key
+        tree = self._tree
+        i = tree.index[child_id]
+        if i == 0 or tree.ids[tree.parents[i]] != parent_id or tree.types[i] in self._hidden:
+            raise KeyError(key)
+        return self._value(tree, i)
+
+    def __contains__(self, key) -> bool:
+        try:
+            self[key]
+        except (KeyError, TypeError, ValueError):
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        tree = self._tree
+        ids, parents, types = tree.ids, tree.parents, tree.types
+        for i in range(1, len(tree)):
+            if types[i] not in self._hidden:
+                yield (ids[parents[i]], ids[i])
+
+    def __len__(self) -> int:
+        if self._len is None:
+            self._len = sum(1 for _ in self)
+        return self._len
+
+
+class CompactCodeGraph(CodeGraph):
+    """
+    CodeGraph stored in the flat arrays of a CompactTree. ast_nodes, our_nodes and
+    our_edges are read-only views over them and the ASTNode / ASTEdge wrappers
+    are only created when accessed. Every refresh rebuilds the arrays.
+    """
+
+    def _rebuild(self):
+        self._hashes = {}
+        self.tree = CompactTree(self._ast_tree)
+        self.ast_nodes = CompactNodes(self.tree)
+        self.our_nodes = CompactNodes(self.tree, CompactASTNode, HIDDEN_TYPES)
+        self.our_edges = CompactEdges(self.tree, CompactASTEdge, HIDDEN_TYPES)
+        self.lookup = self._token_lookup()
+
+    def _refresh_changed(self, changed):
+        self._rebuild()
+        self._index_tokens()
+
+    def _index_tokens(self):
+        self.syntax_tokens = {w.id: w for v in self.lookup.values() for w in v.values()}
+        occurences = [
+            Occurence(node, token)
+            for token in self.syntax_tokens.values()
+            for node in token.occurences
+        ]
+        self.occurences = {o.id: o for o in occurences}
+
+    @property
+    def edges(self):
+        return CompactEdges(self.tree).keys()
+
+    def _edge_list(self):
+        return self.edges
+
+    def _copy_containers(self):
+        self.tree = self.tree.copy()
+        self.ast_nodes = CompactNodes(self.tree)
+        self.our_nodes = CompactNodes(self.tree, CompactASTNode, HIDDEN_TYPES)
+        self.our_edges = CompactEdges(self.tree, CompactASTEdge, HIDDEN_TYPES)
+        self._hashes = dict(self._hashes)
+        self.lookup = dict(self.lookup)
+
+    def _replace_node(self, node_id, node: ast.AST):
+        self.tree.nodes[self.tree.index[node_id]] = node
+
+    def get_parent(self, node_id):
+        i = self.tree.index.get(node_id)
+        if i is None or self.tree.parents[i] < 0:
+            return None
+        return self.tree.ids[self.tree.parents[i]]
+
+    def depth(self, node_id) -> int:
+        return self.tree.depths[self.tree.index[node_id]]
+
+    def children(self, node_id) -> List[int]:
+        ids = self.tree.ids
+        return [ids[c] for c in self.tree.children(self.tree.index[node_id])]
+
+    def ancestors(self, node_id) -> List[int]:
+        ids, parents = self.tree.ids, self.tree.parents
+        ancestors = []
+        i = parents[self.tree.index[node_id]]
+        while i >= 0:
+            ancestors.append(ids[i])
+            i = parents[i]
+        return ancestors
+
+    def subtree(self, node_id) -> List[int]:
+        i = self.tree.index[node_id]
+        return self.tree.ids[i : self.tree.ends[i]].tolist()
+
+    def lowest_common_ancestor(self, a, b):
+        parents, depths = self.tree.parents, self.tree.depths
+        a, b = self.tree.index[a], self.tree.index[b]
+        while depths[a] > depths[b]:
+            a = parents[a]
+        while depths[b] > depths[a]:
+            b = parents[b]
+        while a != b:
+            a, b = parents[a], parents[b]
+        return self.tree.ids[a]
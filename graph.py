@@ -1,13 +1,39 @@
 import ast
 import networkx as nx
 from networkx.drawing.nx_pydot import graphviz_layout
-from typing import Dict, List, Tuple
-import astor
+from layout import tidy_tree_layout
+from scopes import (
+    DEF,
+    GLOBAL,
+    NONLOCAL,
+    SCOPED_TYPES,
+    USE,
+    Bindings,
+    Scope,
+    SymbolTable,
+    child_fields,
+    enter,
+    field_scope,
+    resolve,
+)
+from source import SourceCache, source_map, to_source
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
 import copy
+import hashlib
+import os
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from itertools import chain, islice
+from pathlib import Path
 from abc import ABC, abstractmethod
 
 
 class Node(ABC):
+    __slots__ = ()
+
     def __init__(self, ast_node: ast.AST, parent=None):
         self.ast_node = ast_node
         self.parent = parent
@@ -28,6 +54,8 @@ class Node(ABC):
 
 
 class Edge(ABC):
+    __slots__ = ()
+
     def __init__(self, parent: Node, child: Node):
         self.parent = parent
         self.child = child
@@ -43,6 +71,8 @@ class Edge(ABC):
 
 
 class ASTNode(Node):
+    __slots__ = ("node_id", "ast_node", "parent")
+
     def __init__(self, node_id: int, ast_node: ast.AST, parent=None):
         self.node_id = node_id
         self.ast_node = ast_node
@@ -73,6 +103,8 @@ class ASTNode(Node):
 
 
 class ASTEdge(Edge):
+    __slots__ = ("parent", "child")
+
     def __init__(self, parent: ASTNode, child: ASTNode):
         self.parent = parent
         self.child = child
@@ -94,23 +126,41 @@ class ASTEdge(Edge):
 
 
 class SyntaxToken(Node):
+    """
+    binding of a name in a scope (module, function, lambda, class or comprehension),
+    defs and uses are the ids of the nodes binding and reading it
+    """
+
     def __init__(
-        self, name: str, scope: ast.FunctionDef, occurences: List[ASTNode] = []
+        self,
+        name: str,
+        scope: ast.AST,
+        occurences: List[ASTNode] = [],
+        scope_id: int = None,
+        defs: List[int] = None,
+        uses: List[int] = None,
     ):
         self.name = name
         self.scope = scope
         self.occurences = occurences
+        self.scope_id = scope_id
+        self.defs = [] if defs is None else defs
+        self.uses = [] if uses is None else uses
 
     @property
     def id(self):
-        return f"stx_{self.name}_{id(self.scope)}"
+        return f"stx_{self.name}_{self.scope_id}"
+
+    @property
+    def scope_name(self) -> str:
+        return getattr(self.scope, "name", self.scope.__class__.__name__)
 
     @property
     def attrs(self):
-        return {"name": self.name, "scope": self.scope.name}
+        return {"name": self.name, "scope": self.scope_name}
 
     def __repr__(self):
-        return f"SyntaxToken({self.name}, scope={self.scope.name})"
+        return f"SyntaxToken({self.name}, scope={self.scope_name})"
 
 
 class Occurence(Edge):
@@ -126,10 +176,35 @@ class Occurence(Edge):
         return {}
 
 
-class TravesalInfo:
-    def __init__(self, currect_scope: int, lookup: Dict[int, Dict[str, SyntaxToken]]):
-        self.lookup = lookup
-        self.current_scope = currect_scope
+def path_id(parent_id: int, field: str, index: int = -1) -> int:
+    """
+    deterministic id of the node stored in parent.field (or parent.field[index]),
+    the same for every copy of the tree, across refreshes and across runs
+    """
+    key = f"{parent_id}.{field}.{index}".encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big") >> 1
+
+
+ROOT_ID = path_id(-1, "")
+
+# nodes left out of our_nodes / our_edges
+HIDDEN_NODES = (ast.Load, ast.Store)
+
+
+def node_content(node: ast.AST) -> str:
+    """
+    type and non-ast fields of the node, source locations are left out
+    """
+    parts = [node.__class__.__name__]
+    for field, value in ast.iter_fields(node):
+        if isinstance(value, list):
+            items = ("*" if isinstance(v, ast.AST) else repr(v) for v in value)
+            parts.append(f"{field}=[{','.join(items)}]")
+        elif isinstance(value, ast.AST):
+            parts.append(f"{field}=*")
+        else:
+            parts.append(f"{field}={value!r}")
+    return "|".join(parts)
 
 
 def repr_ast(node: ast.AST):
@@ -147,28 +222,141 @@ def repr_ast(node: ast.AST):
 
 
 class CodeGraph:
-    def __init__(self, ast_tree: ast.AST):
+    def __init__(
+        self, ast_tree: ast.AST, layout: str = "tidy", build_tokens: bool = True
+    ):
+        """
+        layout: "tidy" for the built-in tree layout or "dot" for graphviz,
+        positions are only computed when pos or pos_inv is first accessed
+        build_tokens: whether to build the syntax tokens and their occurences
+        """
         self._counter = 0
         self._ast_tree: ast.AST = ast_tree
+        self.layout = layout
+        self.build_tokens = build_tokens
+        self.root_id = ROOT_ID
         self.our_nodes: Dict[int, ASTNode] = {}
         self.our_edges: Dict[Tuple, ASTEdge] = {}
         self.syntax_tokens: Dict[str, SyntaxToken] = {}
         self.occurences: Dict[Tuple, Occurence] = {}
         self.ast_nodes: Dict[int, ast.AST] = {}
+        self._owned = None
         self.refresh()
 
     @property
     def ast_tree(self):
         return self._ast_tree
 
-    def to_source(self):
-        return astor.to_source(copy.deepcopy(self._ast_tree))
+    def to_source(self, cache: SourceCache = None) -> str:
+        """
+        source of the tree printed by ast.unparse without copying it, the text of
+        unchanged statements is reused from earlier calls, see source.SourceGenerator
+        """
+        return to_source(self, cache)
+
+    def source_map(self, cache: SourceCache = None) -> Tuple[str, Dict[int, Tuple[int, int]]]:
+        """
+        to_source() and the (start, end) offsets of the nodes in it by node id
+        """
+        return source_map(self, cache)
     
     def copy(self):
-        G = copy.deepcopy(self)
-        G.refresh()
+        """
+        copy that shares the ast nodes with this graph: a node is only cloned, together
+        with its ancestors, when it is modified through mutable() or mutate()
+        """
+        G = copy.copy(self)
+        G._copy_containers()
+        # from now on both graphs have to clone before modifying a node
+        self._owned = {}
+        G._owned = {}
         return G
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        # keyed by id() of the ast nodes, which a copy or an unpickled graph does not keep
+        state["_ids"] = None
+        # a copy shares no node with the graphs this one shares nodes with
+        state["_owned"] = None
+        return state
+
+    def _copy_containers(self):
+        self._ids = None
+        self.our_nodes = dict(self.our_nodes)
+        self.our_edges = dict(self.our_edges)
+        self.ast_nodes = dict(self.ast_nodes)
+        self._parents = dict(self._parents)
+        self._children = dict(self._children)
+        self._depth = dict(self._depth)
+        self._records = dict(self._records)
+        self._scopes = dict(self._scopes)
+        self._hashes = dict(self._hashes)
+        self.lookup = dict(self.lookup)
+        self._bindings = self._bindings.copy()
+        self._replaced = set(self._replaced)
+        self._tokens_by_scope = dict(self._tokens_by_scope)
+        self._occurences_by_token = dict(self._occurences_by_token)
+
+    def mutable(self, node_id) -> ast.AST:
+        """
+        returns the ast node of node_id after cloning it and its ancestors if they
+        are shared with a copy of this graph, call it before modifying a node in place
+        """
+        self._stale = True
+        if self._owned is None:
+            return self.ast_nodes[node_id]
+
+        path = [node_id, *self.ancestors(node_id)][::-1]
+        parent_id = None
+        for current_id in path:
+            node = self.ast_nodes[current_id]
+            # by identity: the ids of the nodes change when their siblings move
+            if self._owned.get(id(node)) is not node:
+                clone = copy.copy(node)
+                for field, value in ast.iter_fields(node):
+                    if isinstance(value, list):
+                        setattr(clone, field, list(value))
+                if parent_id is None:
+                    self._ast_tree = clone
+                else:
+                    _replace_child(
+                        self.ast_nodes[parent_id], parent_id, node, current_id, clone
+                    )
+                self._replace_node(current_id, clone)
+                # the clones are kept so that their id() is not reused
+                self._owned[id(clone)] = clone
+                self._ids = None
+            parent_id = current_id
+        return self.ast_nodes[node_id]
+
+    def mutable_tree(self) -> ast.AST:
+        """
+        returns the ast tree after deep copying it if it is shared with a copy of this
+        graph, for changes that can touch any node. A full refresh() is needed afterwards.
+        """
+        self._stale = True
+        if self._owned is not None:
+            self._ast_tree = copy.deepcopy(self._ast_tree)
+            self._owned = None
+        return self._ast_tree
+
+    def _replace_node(self, node_id, node: ast.AST):
+        self.ast_nodes[node_id] = node
+        parent_id = self._parents.get(node_id)
+        our_node = ASTNode(node_id, node, parent=self.our_nodes.get(parent_id))
+        # the occurences of the next refresh point to the new ASTNodes
+        self._replaced.add(node_id)
+        if node_id in self.our_nodes:
+            self.our_nodes[node_id] = our_node
+        if (parent_id, node_id) in self.our_edges:
+            self.our_edges[(parent_id, node_id)] = ASTEdge(self.our_nodes[parent_id], our_node)
+        for child_id in self._children[node_id]:
+            if child_id in self.our_nodes:
+                child = ASTNode(child_id, self.ast_nodes[child_id], parent=our_node)
+                self.our_nodes[child_id] = child
+                self.our_edges[(node_id, child_id)] = ASTEdge(our_node, child)
+                self._replaced.add(child_id)
+
     @property
     def load_node(self) -> ast.Load:
         for node in self.ast_nodes.values():
@@ -186,119 +374,757 @@ class CodeGraph:
     def ast_node(self, node_id) -> ast.AST:
         return self.ast_nodes[node_id]
 
+    def node_id(self, ast_node: ast.AST) -> int:
+        """
+        id of the node in the graph, the first occurrence for shared nodes like ast.Load
+        """
+        if self._ids is None:
+            self._ids = {}
+            for node_id, node in self.ast_nodes.items():
+                self._ids.setdefault(id(node), node_id)
+        return self._ids[id(ast_node)]
+
+    def subtree_hash(self, node_id) -> int:
+        """
+        content hash of the subtree of node_id: equal for equal code wherever it is
+        in the tree, it ignores source locations
+        """
+        hashes = self._hashes
+        stack = [(node_id, False)]
+        while stack:
+            current, expanded = stack.pop()
+            if current in hashes:
+                continue
+            children = self.children(current)
+            if not expanded:
+                stack.append((current, True))
+                stack.extend((c, False) for c in children)
+                continue
+            h = hashlib.blake2b(node_content(self.ast_nodes[current]).encode(), digest_size=8)
+            for c in children:
+                h.update(hashes[c].to_bytes(8, "big"))
+            hashes[current] = int.from_bytes(h.digest(), "big") >> 1
+        return hashes[node_id]
+
     def get_parent(self, node_id):
-        for parent, child in self.edges:
-            if child == node_id:
-                return parent
-        return None
+        return self._parents.get(node_id)
+
+    def depth(self, node_id) -> int:
+        return self._depth[node_id]
+
+    def children(self, node_id) -> List[int]:
+        return list(self._children[node_id])
+
+    def ancestors(self, node_id) -> List[int]:
+        """
+        ids from the parent of node_id up to the root
+        """
+        ancestors = []
+        node_id = self._parents.get(node_id)
+        while node_id is not None:
+            ancestors.append(node_id)
+            node_id = self._parents.get(node_id)
+        return ancestors
+
+    def subtree(self, node_id) -> List[int]:
+        """
+        ids of node_id and all its descendants in preorder
+        """
+        nodes = {}
+        stack = [node_id]
+        while stack:
+            node_id = stack.pop()
+            nodes[node_id] = None
+            stack.extend(reversed(self._children[node_id]))
+        return list(nodes)
+
+    def lowest_common_ancestor(self, a, b):
+        depth_a, depth_b = self._depth[a], self._depth[b]
+        while depth_a > depth_b:
+            a, depth_a = self._parents[a], depth_a - 1
+        while depth_b > depth_a:
+            b, depth_b = self._parents[b], depth_b - 1
+        while a != b:
+            a, b = self._parents[a], self._parents[b]
+        return a
 
-    def refresh(self):
+    def refresh(self, changed: Iterable[int] = None):
         """
         should be called after modifying the ast_tree
+
+        changed: ids of the nodes whose fields were modified in place. Only their
+        subtrees are re-traversed and only the bindings of the names occurring in them
+        are resolved again, the result is the same as a full refresh. Nodes that were
+        moved must have both their old and their new parent listed.
         """
+        if changed is None or not self.ast_nodes:
+            self._rebuild()
+            self._index_tokens()
+        else:
+            self._refresh_changed(changed)
+
+        self._ids = None
+        self._nx = None
+        self._pos = None
+        self._pos_inv = None
+        self._symbols = None
+        self._stale = False
+
+    @property
+    def stale(self) -> bool:
+        """
+        whether nodes were made mutable (or the whole tree) since the last refresh
+        """
+        return self._stale
+
+    def _index_tokens(self):
+        """
+        syntax_tokens and occurences of the whole lookup, grouped by scope and by
+        token so that _refresh_changed can replace the groups it changes
+        """
+        self._tokens_by_scope = {
+            scope_id: {w.id: w for w in tokens.values()}
+            for scope_id, tokens in self.lookup.items()
+        }
+        self._occurences_by_token = {
+            w.id: _occurences(w) for tokens in self.lookup.values() for w in tokens.values()
+        }
+        self._join_tokens()
 
+    def _join_tokens(self):
+        self.syntax_tokens = dict(
+            chain.from_iterable(map(dict.items, self._tokens_by_scope.values()))
+        )
+        self.occurences = dict(
+            chain.from_iterable(
+                map(dict.items, map(self._occurences_by_token.__getitem__, self.syntax_tokens))
+            )
+        )
+
+    @property
+    def edges(self):
+        return self._nxG.edges
+
+    @property
+    def _nxG(self) -> nx.DiGraph:
+        if self._nx is None:
+            nxG = nx.DiGraph()
+            nxG.add_nodes_from(
+                (node_id, self._nx_attrs(ASTNode(node_id, node)))
+                for node_id, node in self.ast_nodes.items()
+            )
+            nxG.add_edges_from(self._edge_list())
+            self._nx = nxG
+        return self._nx
+
+    def _edge_list(self) -> List[Tuple[int, int]]:
+        return self._preorder()[1]
+
+    @property
+    def pos(self) -> Dict[int, Tuple[float, float]]:
+        if self._pos is None:
+            if self.layout == "dot":
+                self._pos = graphviz_layout(self._nxG, prog="dot")
+            elif self.layout == "tidy":
+                self._pos = self._tidy_layout()
+            else:
+                raise ValueError(f"Unknown layout: {self.layout}")
+        return self._pos
+
+    @property
+    def pos_inv(self) -> Dict:
+        if self._pos_inv is None:
+            y_max = max([y for _, y in self.pos.values()])
+            pos_inv = {k: (x, y_max - y) for k, (x, y) in self.pos.items()}
+
+            # token_pos = {token.id: (-150, 50*i) for i, token in enumerate(sorted(self.syntax_tokens.values(), key=lambda x: x.scope.lineno))}
+            token_pos = {
+                token.id: (-150, 50 * i)
+                for i, token in enumerate(self.syntax_tokens.values())
+            }
+            self._pos_inv = {**pos_inv, **token_pos}
+        return self._pos_inv
+
+    def _tidy_layout(self) -> Dict[int, Tuple[float, float]]:
+        children = {}
+        stack = [self.root_id]
+        while stack:
+            node_id = stack.pop()
+            children[node_id] = self.children(node_id)
+            stack.extend(children[node_id])
+        return tidy_tree_layout(self.root_id, children)
+
+    @contextmanager
+    def mutate(self, *node_ids: int):
+        """
+        context manager for in place modifications of the given nodes, yields
+        the nodes (made mutable) and refreshes only their subtrees on exit
+        """
+        yield [self.mutable(node_id) for node_id in node_ids]
+        self.refresh(changed=node_ids)
+
+    def _rebuild(self):
+        self._hashes: Dict[int, int] = {}
         self.our_nodes: Dict[int, ASTNode] = {}
         self.our_edges: Dict[Tuple, ASTEdge] = {}
         self.ast_nodes: Dict[int, ast.AST] = {}
-        self._nxG = nx.DiGraph()
-        self.traverse(self._ast_tree)
-        self.edges = self._nxG.edges
-        self.pos = graphviz_layout(self._nxG, prog="dot")
-        y_max = max([y for _, y in self.pos.values()])
-        self.pos_inv = {k: (x, y_max - y) for k, (x, y) in self.pos.items()}
-
-        info = self.traverse_syntax_tokens(
-            self.ast_tree.body[0], TravesalInfo(self.ast_tree.body[0], {})
-        )
-        self.lookup = info.lookup
-        self.syntax_tokens = {w.id: w for v in self.lookup.values() for w in v.values()}
+        self._parents: Dict[int, int] = {}
+        self._children: Dict[int, List[int]] = {}
+        self._depth: Dict[int, int] = {}
+        self._records: Dict[int, Tuple] = {}
+        self._scopes: Dict[int, Scope] = {}
+        self._replaced = set()
+        if self.build_tokens:
+            module = self._scopes[self.root_id] = Scope(self.root_id, "module")
+            self.traverse(self._ast_tree, scope=module)
+        else:
+            self.traverse(self._ast_tree)
+        self._position = dict(zip(self.ast_nodes, range(len(self.ast_nodes))))
+        self._bindings = Bindings(self.root_id)
+        self.lookup = self._resolve(self._scopes, self._records, self._bindings)
 
-        # token_pos = {token.id: (-150, 50*i) for i, token in enumerate(sorted(self.syntax_tokens.values(), key=lambda x: x.scope.lineno))}
-        token_pos = {
-            token.id: (-150, 50 * i)
-            for i, token in enumerate(self.syntax_tokens.values())
-        }
-        self.pos_inv = {**self.pos_inv, **token_pos}
-        occurences = [
-            Occurence(node, token)
-            for token in self.syntax_tokens.values()
-            for node in token.occurences
+    def _token_lookup(self) -> Dict[int, Dict[str, SyntaxToken]]:
+        """
+        syntax tokens of the whole tree, walking the graph by ids
+        """
+        if not self.build_tokens:
+            return {}
+        records = {}
+        scopes = {self.root_id: Scope(self.root_id, "module")}
+        self._record_names(self.root_id, scopes[self.root_id], records, scopes)
+        return self._resolve(scopes, records)
+
+    def _resolve(
+        self, scopes: Dict[int, Scope], records: Dict[int, Tuple], bindings: Bindings = None
+    ) -> Dict[int, Dict[str, SyntaxToken]]:
+        if not self.build_tokens:
+            return {}
+        return resolve(scopes, records, self._make_token, self.our_nodes.__getitem__, bindings)
+
+    def _make_token(self, name: str, scope_id: int) -> SyntaxToken:
+        return SyntaxToken(name, self.ast_nodes[scope_id], occurences=[], scope_id=scope_id)
+
+    @property
+    def symbols(self) -> SymbolTable:
+        """
+        def-use index of the syntax tokens, built on first use after each refresh
+        """
+        if self._symbols is None:
+            self._symbols = SymbolTable(self.lookup)
+        return self._symbols
+
+    def _refresh_changed(self, changed: Iterable[int]):
+        changed = dict.fromkeys(changed)
+        # a root nested in another root is rebuilt together with it
+        roots = [
+            node_id
+            for node_id in changed
+            if not any(a in changed for a in self.ancestors(node_id))
         ]
-        self.occurences = {o.id: o for o in occurences}
 
-    def traverse(self, node: ast.AST, parent: ASTNode = None):
-        node_id = id(node)
-        self.ast_nodes[node_id] = node
-        our_node = ASTNode(node_id, node, parent=parent)
+        order = list(self.ast_nodes)
+        spans = []
+        stale = set(self._replaced)
+        for node_id in roots:
+            old = self.subtree(node_id)
+            start = self._position[node_id]
+            spans.append((start, start + len(old), node_id))
+            stale.update(old)
+        removed = self._owned_records(stale) if self.build_tokens else {}
 
-        if not (isinstance(node, ast.Store) or isinstance(node, ast.Load)):
-            self.our_nodes[node_id] = our_node
+        for node_id in roots:
+            for ancestor_id in (node_id, *self.ancestors(node_id)):
+                self._hashes.pop(ancestor_id, None)
+            self._retraverse(node_id)
 
-        if parent is not None:
-            self._nxG.add_edge(parent.node_id, node_id)
+        # the new subtrees take the place of the old ones in preorder, the other
+        # indexes follow it
+        spans.sort()
+        ids, start = [], 0
+        for begin, end, node_id in spans:
+            ids += order[start:begin]
+            ids += self.subtree(node_id)
+            start = end
+        ids += order[start:]
+        self.ast_nodes = _in_order(self.ast_nodes, ids)
+        self._position = dict(zip(ids, range(len(ids))))
+        visible = list(filter(self.our_nodes.__contains__, ids))
+        self.our_nodes = _in_order(self.our_nodes, visible)
+        # every visible node but the root has an edge from its parent
+        children = visible[1:]
+        self.our_edges = _in_order(
+            self.our_edges, zip(map(self._parents.__getitem__, children), children)
+        )
 
-            if not (isinstance(node, ast.Store) or isinstance(node, ast.Load)):
-                self.our_edges[(parent.node_id, node_id)] = ASTEdge(parent, our_node)
+        if self.build_tokens:
+            self._resolve_changed(roots, removed, ids)
+        self._replaced = set()
 
-        for field, value in ast.iter_fields(node):
-            if isinstance(value, list):
-                for item in value:
-                    if isinstance(item, ast.AST):
-                        self.traverse(item, our_node)
-            elif isinstance(value, ast.AST):
-                self.traverse(value, our_node)
+    def _owned_records(self, node_ids: Iterable[int]) -> Dict[int, Tuple]:
+        """
+        node id -> (record, id of the scope owning its binding) of the names
+        occurring at node_ids
+        """
+        records, scopes, owner = self._records, self._scopes, self._bindings.owner
+        owned = {}
+        for node_id in node_ids:
+            record = records.get(node_id)
+            if record is None:
+                continue
+            scope_id, name, flags = record
+            if flags & (GLOBAL | NONLOCAL):
+                owned[node_id] = (record, None)
             else:
-                pass
+                owned[node_id] = (record, owner(scopes[scope_id], name))
+        return owned
+
+    def _resolve_changed(self, roots: List[int], removed: Dict[int, Tuple], ids: List[int]):
+        """
+        records the names of the re-traversed roots again and rebuilds only the
+        bindings they occur in, removed: the old records of the stale nodes as
+        given by _owned_records, ids: the node ids in preorder
+        """
+        records, scopes, bindings = self._records, self._scopes, self._bindings
+        for node_id in roots:
+            scope = self._scope_at(node_id)
+            records.pop(node_id, None)
+            if node_id != self.root_id:
+                scopes.pop(node_id, None)
+            self._record_names(node_id, scope, records, scopes)
+        self._records = records = _in_order(records, filter(records.__contains__, ids))
+        self._scopes = scopes = _in_order(scopes, filter(scopes.__contains__, ids))
+
+        # the records of the stale nodes that are still there and of the new ones
+        renewed = {node_id: records[node_id] for node_id in removed if node_id in records}
+        for node_id in roots:
+            for child_id in self.subtree(node_id):
+                if child_id in records:
+                    renewed[child_id] = records[child_id]
+
+        # the functions and classes that start or stop binding or declaring a name
+        # change its owner in the scopes nested in them, the module owns its names
+        # whatever it binds
+        keys = set()
+        for record, _ in removed.values():
+            keys.update(_bound_keys(record))
+        for record in renewed.values():
+            keys.update(_bound_keys(record))
+        before = {key: bindings.state(*key) for key in keys}
+        for record, _ in removed.values():
+            bindings.remove(record)
+        for record in renewed.values():
+            bindings.add(record)
+        for key in keys:
+            scope_id, name = key
+            if scope_id == self.root_id or scope_id not in scopes:
+                continue
+            if bindings.state(scope_id, name) != before[key]:
+                self._rebind(scopes[scope_id], name, removed, renewed)
+
+        # node ids leaving and joining every binding
+        leaving: Dict[Tuple[int, str], set] = {}
+        for node_id, (record, owner_id) in removed.items():
+            if owner_id is not None:
+                leaving.setdefault((owner_id, record[1]), set()).add(node_id)
+        joining: Dict[Tuple[int, str], List[int]] = {}
+        for node_id, (scope_id, name, flags) in renewed.items():
+            if not flags & (GLOBAL | NONLOCAL):
+                key = (bindings.owner(scopes[scope_id], name), name)
+                joining.setdefault(key, []).append(node_id)
+        # the bindings of a cloned scope node point to the clone
+        for scope_id in self._replaced:
+            if scope_id in scopes:
+                for name in self.lookup.get(scope_id, ()):
+                    leaving.setdefault((scope_id, name), set())
+
+        rank = self._position.__getitem__
+        lookup = self.lookup
+        updates: Dict[int, Dict[str, SyntaxToken]] = {}
+        for key in leaving.keys() | joining.keys():
+            owner_id, name = key
+            token = lookup.get(owner_id, {}).get(name)
+            node_ids = joining.get(key, [])
+            if token is not None:
+                gone = leaving.get(key, ())
+                node_ids += [o.node_id for o in token.occurences if o.node_id not in gone]
+                del self._occurences_by_token[token.id]
+            node_ids.sort(key=rank)
+            updates.setdefault(owner_id, {})[name] = (
+                self._make_binding(name, owner_id, node_ids) if node_ids else None
+            )
+
+        for owner_id, tokens in updates.items():
+            if owner_id not in scopes:
+                continue
+            old = lookup.get(owner_id, {})
+            new = dict(old)
+            for name, token in tokens.items():
+                if token is None:
+                    new.pop(name, None)
+                else:
+                    new[name] = token
+                    self._occurences_by_token[token.id] = _occurences(token)
+            # in order of first occurence
+            if any(
+                name not in old or old[name].occurences[0].node_id != token.occurences[0].node_id
+                for name, token in tokens.items()
+                if token is not None
+            ):
+                new = dict(
+                    sorted(new.items(), key=lambda item: rank(item[1].occurences[0].node_id))
+                )
+            lookup[owner_id] = new
+            self._tokens_by_scope[owner_id] = {w.id: w for w in new.values()}
+
+        if list(lookup) != list(scopes):
+            self.lookup = {scope_id: lookup.get(scope_id, {}) for scope_id in scopes}
+            self._tokens_by_scope = {
+                scope_id: self._tokens_by_scope.get(scope_id, {}) for scope_id in scopes
+            }
+        self._join_tokens()
+
+    def _rebind(
+        self, scope: Scope, name: str, removed: Dict[int, Tuple], renewed: Dict[int, Tuple]
+    ):
+        """
+        adds to removed and renewed the occurences of name in scope and the scopes
+        nested in it, whose binding may have moved
+        """
+        records = self._records
+        outer = scope
+        while outer is not None:
+            token = self.lookup.get(outer.node_id, {}).get(name)
+            occurences = token.occurences if token is not None else []
+            for node_id in (o.node_id for o in occurences):
+                if node_id in removed:
+                    continue
+                record = records[node_id]
+                if _nested(self._scopes[record[0]], scope):
+                    removed[node_id] = (record, outer.node_id)
+                    renewed[node_id] = record
+            outer = outer.parent
+
+    def _make_binding(self, name: str, scope_id: int, node_ids: List[int]) -> SyntaxToken:
+        records = self._records
+        return SyntaxToken(
+            name,
+            self.ast_nodes[scope_id],
+            occurences=list(map(self.our_nodes.__getitem__, node_ids)),
+            scope_id=scope_id,
+            defs=[i for i in node_ids if records[i][2] & DEF],
+            uses=[i for i in node_ids if records[i][2] & USE],
+        )
+
+    def _preorder(self) -> Tuple[List[int], List[Tuple[int, int]]]:
+        """
+        node ids in order of first visit and edges in order of visit
+        """
+        root_id = self.root_id
+        order = {root_id: None}
+        edges = []
+        stack = [(root_id, c) for c in reversed(self._children[root_id])]
+        while stack:
+            edge = stack.pop()
+            edges.append(edge)
+            node_id = edge[1]
+            order[node_id] = None
+            stack.extend((node_id, c) for c in reversed(self._children[node_id]))
+        return list(order), edges
+
+    def _scope_at(self, node_id: int) -> Scope:
+        """
+        scope in which the name occurring at node_id (if any) is evaluated
+        """
+        path = [node_id, *self.ancestors(node_id)]
+        path.reverse()
+        scope = self._scopes[self.root_id]
+        grandparent = None
+        for parent_id, child_id in zip(path, path[1:]):
+            parent = self.ast_nodes[parent_id]
+            if parent.__class__ in SCOPED_TYPES:
+                fields = zip(child_fields(parent), self.children(parent_id))
+                field = next(f for f, c in fields if c == child_id)
+                scope = field_scope(
+                    parent, field, scope, self._scopes.get(parent_id), grandparent
+                )
+            grandparent = parent
+        return scope
+
+    def _record_names(
+        self,
+        node_id: int,
+        scope: Scope,
+        records: Dict[int, Tuple],
+        scopes: Dict[int, Scope],
+    ):
+        """
+        records the names occurring in the subtree of node_id, whose own name is
+        evaluated in scope
+        """
+        stack = [(node_id, scope)]
+        while stack:
+            node_id, scope = stack.pop()
+            node = self.ast_nodes[node_id]
+            parent = self.ast_nodes.get(self.get_parent(node_id))
+            inner = enter(node, node_id, parent, scope, records, scopes)
+            if node.__class__ in SCOPED_TYPES:
+                items = [
+                    (child_id, field_scope(node, field, scope, inner, parent))
+                    for field, child_id in zip(child_fields(node), self.children(node_id))
+                ]
+            else:
+                items = [(child_id, inner or scope) for child_id in self.children(node_id)]
+            items.reverse()
+            stack.extend(items)
+
+    def _retraverse(self, node_id: int):
+        node = self.ast_nodes[node_id]
+        our_node = self.our_nodes.get(node_id) or ASTNode(node_id, node)
+
+        stack = list(self._children[node_id])
+        self._children[node_id] = []
+        while stack:
+            child_id = stack.pop()
+            stack.extend(self._children.pop(child_id))
+            self.our_edges.pop((self._parents.pop(child_id), child_id), None)
+            self.ast_nodes.pop(child_id)
+            self.our_nodes.pop(child_id, None)
+            self._depth.pop(child_id)
+            self._hashes.pop(child_id, None)
+            self._records.pop(child_id, None)
+            self._scopes.pop(child_id, None)
 
-        # stores node attrs in networkx graph
+        stack = []
+        self._push_children(stack, node, our_node, None, None)
+        self._visit(stack)
+
+    def traverse(
+        self,
+        node: ast.AST,
+        parent: ASTNode = None,
+        node_id: int = ROOT_ID,
+        scope: Scope = None,
+    ):
+        """
+        adds the subtree of node in preorder, with an explicit stack so the depth of
+        the tree is not limited by the recursion limit
+
+        scope: if given, the names occurring in the subtree are recorded in the same
+        pass, the name of node itself being evaluated in scope
+        """
+        self._visit([(node, parent, node_id, scope)])
+
+    def _visit(self, stack: List[Tuple]):
+        ast_nodes, our_nodes, our_edges = self.ast_nodes, self.our_nodes, self.our_edges
+        parents, children, depth = self._parents, self._children, self._depth
+        records, scopes = self._records, self._scopes
+        push = self._push_children
+
+        while stack:
+            node, parent, node_id, scope = stack.pop()
+            ast_nodes[node_id] = node
+            children[node_id] = []
+            our_node = ASTNode(node_id, node, parent=parent)
+            visible = node.__class__ not in HIDDEN_NODES
+            if visible:
+                our_nodes[node_id] = our_node
+
+            if parent is None:
+                depth[node_id] = 0
+            else:
+                depth[node_id] = depth[parent.node_id] + 1
+                parents[node_id] = parent.node_id
+                children[parent.node_id].append(node_id)
+                if visible:
+                    our_edges[(parent.node_id, node_id)] = ASTEdge(parent, our_node)
+
+            inner = None
+            if scope is not None:
+                parent_node = None if parent is None else parent.ast_node
+                inner = enter(node, node_id, parent_node, scope, records, scopes)
+
+            push(stack, node, our_node, scope, inner)
+
+    @staticmethod
+    def _push_children(
+        stack: List[Tuple],
+        node: ast.AST,
+        our_node: ASTNode,
+        scope: Scope,
+        inner: Scope,
+    ):
+        """
+        pushes the children of node in reverse field order, so they are popped in order,
+        with the scope their names are evaluated in
+        """
+        # same ids as path_id, the parent id is only hashed once
+        prefix = hashlib.blake2b(f"{our_node.node_id}.".encode(), digest_size=8)
+        scoped = scope is not None and node.__class__ in SCOPED_TYPES
+        if scoped:
+            parent = our_node.parent.ast_node if our_node.parent else None
+        child_scope = inner or scope
+        for field in reversed(node._fields):
+            value = getattr(node, field, None)
+            if scoped:
+                child_scope = field_scope(node, field, scope, inner, parent)
+            if value.__class__ is list:
+                for i in range(len(value) - 1, -1, -1):
+                    if isinstance(value[i], ast.AST):
+                        h = prefix.copy()
+                        h.update(f"{field}.{i}".encode())
+                        child_id = int.from_bytes(h.digest(), "big") >> 1
+                        stack.append((value[i], our_node, child_id, child_scope))
+            elif isinstance(value, ast.AST):
+                h = prefix.copy()
+                h.update(f"{field}.-1".encode())
+                child_id = int.from_bytes(h.digest(), "big") >> 1
+                stack.append((value, our_node, child_id, child_scope))
+
+    @staticmethod
+    def _nx_attrs(our_node: ASTNode) -> Dict:
         attrs = our_node.attrs
         if (
             "name" in attrs
         ):  # networkx uses name for node_id, ast uses name for function name
             attrs["fun_name"] = attrs.pop("name")
-        self._nxG.nodes[node_id].update(attrs)
+        return attrs
 
     @classmethod
-    def from_file(cls, filename):
+    def from_file(cls, filename, **kwargs):
         with open(filename, "r") as file:
             code = file.read()
 
         tree = ast.parse(code)
-        return cls(tree)
-
-    def traverse_syntax_tokens(self, node: ast.AST, info: TravesalInfo):
-        name = (
-            node.arg
-            if isinstance(node, ast.arg)
-            else node.id
-            if isinstance(node, ast.Name)
-            else None
+        return cls(tree, **kwargs)
+
+    @classmethod
+    def from_directory(
+        cls,
+        path,
+        pattern: str = "*.py",
+        workers: int = None,
+        chunksize: int = 16,
+        layout: str = None,
+        build_tokens: bool = True,
+        on_error: Callable[[str, str], None] = None,
+    ) -> Iterator[Tuple[str, "CodeGraph"]]:
+        """
+        builds the graphs of all files matching pattern under path in a process pool
+        and yields (filename, graph) pairs in filename order
+
+        workers: number of processes, os.cpu_count() by default and 0 to load in this process
+        chunksize: files sent to a worker at a time, at most 2 chunks per worker are in flight
+        layout: if given ("tidy" or "dot") the positions are computed in the worker
+        on_error: called with (filename, error message) for files that cannot be parsed,
+            they are skipped with a warning by default
+
+        graphs are pickled back from the workers, CompactCodeGraph.from_directory
+        ships a fraction of what a CodeGraph costs to unpickle
+        """
+        filenames = sorted(str(p) for p in Path(path).rglob(pattern) if p.is_file())
+        chunks = [
+            filenames[i : i + chunksize] for i in range(0, len(filenames), chunksize)
+        ]
+        job = partial(
+            _load_files,
+            cls,
+            layout=layout or "tidy",
+            eager_layout=layout is not None,
+            build_tokens=build_tokens,
         )
-        if name is not None:
-            if name not in info.lookup[id(info.current_scope)]:
-                token = SyntaxToken(name, info.current_scope, occurences=[])
-                info.lookup[id(info.current_scope)][name] = token
+        if on_error is None:
+            on_error = _warn_skipped
 
-            info.lookup[id(info.current_scope)][name].occurences.append(
-                self.our_nodes[id(node)]
-            )
+        if workers == 0:
+            for result in map(job, chunks):
+                yield from _report_errors(result, on_error)
+            return
 
-        if isinstance(node, ast.FunctionDef):
-            lookup = info.lookup
-            lookup[id(node)] = {}
-            info = TravesalInfo(node, info.lookup)
+        workers = workers or os.cpu_count()
+        chunks = iter(chunks)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque(executor.submit(job, c) for c in islice(chunks, 2 * workers))
+            try:
+                while pending:
+                    result = pending.popleft().result()
+                    pending.extend(executor.submit(job, c) for c in islice(chunks, 1))
+                    yield from _report_errors(result, on_error)
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+def _in_order(d: Dict, keys: Iterable) -> Dict:
+    """
+    d with its keys in the given order
+    """
+    keys = list(keys)
+    return dict(zip(keys, map(d.__getitem__, keys)))
+
+
+def _occurences(token: SyntaxToken) -> Dict[Tuple, Occurence]:
+    occurences = (Occurence(node, token) for node in token.occurences)
+    return {o.id: o for o in occurences}
+
+
+def _bound_keys(record: Tuple) -> List[Tuple[int, str]]:
+    """
+    (scope id, name) of the names a record binds or declares
+    """
+    scope_id, name, flags = record
+    if flags & DEF:
+        return [(scope_id, name)]
+    if flags & (GLOBAL | NONLOCAL):
+        return [(scope_id, n) for n in name]
+    return []
+
+
+def _nested(scope: Scope, outer: Scope) -> bool:
+    while scope is not None and scope is not outer:
+        scope = scope.parent
+    return scope is outer
+
+
+def _replace_child(
+    parent: ast.AST, parent_id: int, child: ast.AST, child_id: int, new_child: ast.AST
+):
+    for field, value in ast.iter_fields(parent):
+        if isinstance(value, list):
+            for i, item in enumerate(value):
+                if item is child and path_id(parent_id, field, i) == child_id:
+                    value[i] = new_child
+                    return
+        elif value is child and path_id(parent_id, field) == child_id:
+            setattr(parent, field, new_child)
+            return
+    raise ValueError(f"{child} is not a child of {parent}")
+
+
+def _load_files(
+    cls, filenames: List[str], layout: str, eager_layout: bool, build_tokens: bool
+):
+    results = []
+    for filename in filenames:
+        try:
+            G = cls.from_file(filename, layout=layout, build_tokens=build_tokens)
+            if eager_layout:
+                G.pos_inv
+            results.append((filename, G, None))
+        except (SyntaxError, ValueError, UnicodeDecodeError, RecursionError) as e:
+            results.append((filename, None, f"{e.__class__.__name__}: {e}"))
+    return results
+
+
+def _report_errors(results, on_error: Callable[[str, str], None]):
+    for filename, G, error in results:
+        if error is None:
+            yield filename, G
+        else:
+            on_error(filename, error)
 
-        for field, value in ast.iter_fields(node):
-            if isinstance(value, list):
-                for item in value:
-                    if isinstance(item, ast.AST):
-                        self.traverse_syntax_tokens(item, info)
-            elif isinstance(value, ast.AST):
-                self.traverse_syntax_tokens(value, info)
-            else:
-                pass
 
-        return info
+def _warn_skipped(filename: str, error: str):
+    warnings.warn(f"skipping {filename}: {error}", RuntimeWarning)
 
 
 class OurGraphWithNewNodes(CodeGraph):
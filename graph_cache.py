@@ -0,0 +1,458 @@
+import ast
+import hashlib
+import json
+import math
+import mmap
+import os
+import sys
+from array import array
+from typing import Dict, List, Optional, Tuple, Union
+
+from compact import (
+    CompactASTEdge,
+    CompactASTNode,
+    CompactCodeGraph,
+    CompactEdges,
+    CompactNodes,
+    CompactTree,
+    HIDDEN_TYPES,
+    preorder,
+)
+from graph import CodeGraph, Occurence, ROOT_ID, SyntaxToken
+from scopes import DEF, USE
+
+
+MAGIC = b"CODEGRF2"
+SUFFIX = ".cgraph"
+
+# sections of an entry, every one is a flat array of the given typecode
+TREE_SECTIONS = (
+    ("ids", "q"),
+    ("types", "H"),
+    ("parents", "i"),
+    ("fields", "H"),
+    ("list_index", "i"),
+    ("depths", "i"),
+    ("ends", "i"),
+    ("child_offsets", "i"),
+    ("child_index", "i"),
+)
+
+
+def source_key(source: Union[str, bytes]) -> str:
+    """
+    cache key of a source file, the ast (and so the graph) depends on the python version
+    """
+    if isinstance(source, str):
+        source = source.encode("utf-8")
+    h = hashlib.blake2b(source, digest_size=16)
+    h.update(sys.implementation.cache_tag.encode())
+    return h.hexdigest()
+
+
+class MappedTree(CompactTree):
+    """
+    CompactTree whose arrays are memoryviews over a cache entry. The ast nodes are
+    only created, by parsing the stored source, when one of them is accessed.
+    """
+
+    __slots__ = ("_source", "_nodes", "_index", "_buffer")
+
+    def __init__(self, buffer: mmap.mmap, sections: Dict[str, memoryview], source):
+        for name, _ in TREE_SECTIONS:
+            setattr(self, name, sections[name])
+        self._buffer = buffer
+        self._source = source
+        self._nodes = None
+        self._index = None
+
+    @property
+    def nodes(self) -> List[ast.AST]:
+        if self._nodes is None:
+            nodes = [node for node, *_ in preorder(ast.parse(bytes(self._source)))]
+            if len(nodes) != len(self.types):
+                raise ValueError("cache entry does not match its source")
+            self._nodes = nodes
+        return self._nodes
+
+    @property
+    def index(self) -> Dict[int, int]:
+        if self._index is None:
+            self._index = {node_id: i for i, node_id in enumerate(self.ids)}
+        return self._index
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def __reduce__(self):
+        tree = self.copy()
+        return (_restore_tree, ({name: getattr(tree, name) for name in CompactTree.__slots__},))
+
+    def copy(self) -> CompactTree:
+        """
+        plain CompactTree with its own arrays, it no longer depends on the cache file
+        """
+        tree = object.__new__(CompactTree)
+        for name, typecode in TREE_SECTIONS:
+            setattr(tree, name, array(typecode, getattr(self, name)))
+        tree.nodes = list(self.nodes)
+        tree.index = dict(self.index)
+        return tree
+
+
+def _restore_tree(state: Dict) -> CompactTree:
+    tree = object.__new__(CompactTree)
+    for name, value in state.items():
+        setattr(tree, name, value)
+    return tree
+
+
+class CachedCodeGraph(CompactCodeGraph):
+    """
+    CompactCodeGraph loaded from a cache entry. The syntax tokens, the positions and
+    the ast are rebuilt from the entry when first accessed, the first refresh turns
+    it into a plain CompactCodeGraph.
+    """
+
+    @classmethod
+    def _from_buffer(cls, buffer: mmap.mmap) -> "CachedCodeGraph":
+        (size,) = array("Q", buffer[len(MAGIC) : len(MAGIC) + 8])
+        start = len(MAGIC) + 8
+        header = json.loads(buffer[start : start + size])
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError("entry was written with another byte order")
+        start = _align(start + size)
+        view = memoryview(buffer)[start:]
+        sections = {
+            name: view[offset : offset + count * array(typecode).itemsize].cast(typecode)
+            for name, (offset, typecode, count) in header["sections"].items()
+        }
+
+        G = object.__new__(cls)
+        G._counter = 0
+        G._root = None
+        G.layout = header["layout"]
+        G.build_tokens = header["build_tokens"]
+        G.root_id = ROOT_ID
+        G._owned = None
+        G._stale = False
+        G.tree = MappedTree(buffer, sections, sections["source"])
+        G.ast_nodes = CompactNodes(G.tree)
+        G.our_nodes = CompactNodes(G.tree, CompactASTNode, HIDDEN_TYPES)
+        G.our_edges = CompactEdges(G.tree, CompactASTEdge, HIDDEN_TYPES)
+        G._hashes = {}
+        G._ids = None
+        G._nx = None
+        G._pos = None
+        G._pos_inv = None
+        G._lookup = None
+        G._syntax_tokens = None
+        G._occurences = None
+        G._symbols = None
+        G._cached_tokens = sections if "token_scopes" in sections else None
+        G._cached_layout = (sections["x"], sections["y"]) if "x" in sections else None
+        return G
+
+    def _rebuild(self):
+        self._cached_tokens = None
+        self._cached_layout = None
+        super()._rebuild()
+
+    def __getstate__(self):
+        # materialise everything that still points into the cache file
+        self.lookup
+        self.pos if self._cached_layout is not None else None
+        state = super().__getstate__()
+        state["_cached_tokens"] = None
+        state["_cached_layout"] = None
+        return state
+
+    @property
+    def _ast_tree(self) -> ast.AST:
+        if self._root is None:
+            self._root = self.tree.nodes[0]
+        return self._root
+
+    @_ast_tree.setter
+    def _ast_tree(self, value: ast.AST):
+        self._root = value
+
+    @property
+    def lookup(self) -> Dict[int, Dict[str, SyntaxToken]]:
+        if self._lookup is None:
+            self._lookup = self._cached_lookup()
+        return self._lookup
+
+    @lookup.setter
+    def lookup(self, value):
+        self._lookup = value
+
+    @property
+    def syntax_tokens(self) -> Dict[str, SyntaxToken]:
+        if self._syntax_tokens is None:
+            self._syntax_tokens = {
+                w.id: w for v in self.lookup.values() for w in v.values()
+            }
+        return self._syntax_tokens
+
+    @syntax_tokens.setter
+    def syntax_tokens(self, value):
+        self._syntax_tokens = value
+
+    @property
+    def occurences(self):
+        if self._occurences is None:
+            occurences = [
+                Occurence(node, token)
+                for token in self.syntax_tokens.values()
+                for node in token.occurences
+            ]
+            self._occurences = {o.id: o for o in occurences}
+        return self._occurences
+
+    @occurences.setter
+    def occurences(self, value):
+        self._occurences = value
+
+    @property
+    def pos(self) -> Dict[int, Tuple[float, float]]:
+        if self._pos is None and self._cached_layout is not None:
+            xs, ys = self._cached_layout
+            self._pos = {
+                node_id: (xs[i], ys[i])
+                for i, node_id in enumerate(self.tree.ids)
+                if not math.isnan(xs[i])
+            }
+        return super().pos
+
+    def _cached_lookup(self) -> Dict[int, Dict[str, SyntaxToken]]:
+        sections = self._cached_tokens
+        if sections is None:
+            return {}
+        tree = self.tree
+        names = bytes(sections["token_names"]).decode("utf-8").split("\0")
+        scopes = sections["token_scopes"]
+        offsets = sections["token_offsets"]
+        occurences = sections["token_occurences"]
+        flags = sections["token_flags"]
+
+        lookup = {tree.ids[i]: {} for i in sections["scopes"]}
+        for t, name in enumerate(names[: len(scopes)]):
+            i = sections["scopes"][scopes[t]]
+            scope_id = tree.ids[i]
+            token = lookup[scope_id][name] = SyntaxToken(
+                name, tree.nodes[i], occurences=[], scope_id=scope_id
+            )
+            for k in range(offsets[t], offsets[t + 1]):
+                j = occurences[k]
+                token.occurences.append(CompactASTNode(tree, j))
+                if flags[k] & DEF:
+                    token.defs.append(tree.ids[j])
+                if flags[k] & USE:
+                    token.uses.append(tree.ids[j])
+        return lookup
+
+
+class GraphCache:
+    """
+    on-disk cache of code graphs keyed by the source hash and the python version.
+
+    Every entry is one file: a header followed by the flat arrays of a CompactTree,
+    the syntax token tables, the positions (if they were computed) and the source.
+    Entries are memory-mapped when loaded, so a hit costs neither a parse nor a
+    traversal. When the cache grows beyond max_bytes the least recently used
+    entries are removed. The size of the cache is counted as entries are stored,
+    the directory is only scanned on the first put and when evicting.
+    """
+
+    def __init__(self, directory, max_bytes: int = 512 * 2**20):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        # bytes in the directory, None until it is scanned
+        self._size: Optional[int] = None
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, source: Union[str, bytes]) -> Optional[CachedCodeGraph]:
+        """
+        the cached graph of source, None if it is not in the cache
+        """
+        path = self._path(source_key(source))
+        try:
+            with open(path, "rb") as file:
+                buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if buffer[: len(MAGIC)] != MAGIC:
+            # written by another version of the format
+            self._remove(path)
+            return None
+        try:
+            G = CachedCodeGraph._from_buffer(buffer)
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Warning: dropping cache entry {path}: {e}")
+            self._remove(path)
+            return None
+
+        # the modification time is the last use for the LRU eviction
+        os.utime(path)
+        return G
+
+    def put(self, source: Union[str, bytes], G: CodeGraph):
+        """
+        stores G, the graph of source, positions are stored only if already computed
+        """
+        data = dump(source, G)
+        path = self._path(source_key(source))
+        try:
+            replaced = os.stat(path).st_size
+        except FileNotFoundError:
+            replaced = 0
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as file:
+            file.write(data)
+        os.replace(tmp, path)
+
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += len(data) - replaced
+        # entries written by other processes are only seen by the scan of the eviction
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def load(self, filename, layout: str = "tidy", eager_layout: bool = False) -> CodeGraph:
+        """
+        graph of a python file, from the cache if the file did not change since it was stored
+        """
+        with open(filename, "rb") as file:
+            source = file.read()
+
+        G = self.get(source)
+        if G is None:
+            G = CompactCodeGraph(ast.parse(source), layout=layout)
+            if eager_layout:
+                G.pos
+            self.put(source, G)
+        return G
+
+    def entries(self) -> List[Tuple[str, int, float]]:
+        """
+        (path, size, last use) of every entry, least recently used first
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        entries.sort(key=lambda e: e[2])
+        return entries
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes: int = None):
+        """
+        removes the least recently used entries until the cache fits in max_bytes
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= max_bytes:
+                break
+            self._remove(path)
+            total -= size
+        self._size = total
+
+    def clear(self):
+        self.evict(0)
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def dump(source: Union[str, bytes], G: CodeGraph) -> bytes:
+    """
+    serialises G, the graph of source, in the cache entry format
+    """
+    if isinstance(source, str):
+        source = source.encode("utf-8")
+    tree = G.tree if isinstance(G, CompactCodeGraph) else CompactTree(G.ast_tree)
+
+    sections = [(name, getattr(tree, name)) for name, _ in TREE_SECTIONS]
+
+    scopes = array("i")
+    token_scopes = array("i")
+    token_offsets = array("i", [0])
+    token_occurences = array("i")
+    token_flags = array("B")
+    names = []
+    for scope_id, tokens in G.lookup.items():
+        scopes.append(tree.index[scope_id])
+        for name, token in tokens.items():
+            names.append(name)
+            token_scopes.append(len(scopes) - 1)
+            token_occurences.extend(tree.index[node.node_id] for node in token.occurences)
+            defs, uses = set(token.defs), set(token.uses)
+            token_flags.extend(
+                (DEF if node.node_id in defs else 0) | (USE if node.node_id in uses else 0)
+                for node in token.occurences
+            )
+            token_offsets.append(len(token_occurences))
+    sections += [
+        ("scopes", scopes),
+        ("token_scopes", token_scopes),
+        ("token_offsets", token_offsets),
+        ("token_occurences", token_occurences),
+        ("token_flags", token_flags),
+        ("token_names", array("B", "\0".join(names).encode("utf-8"))),
+    ]
+
+    if G._pos is not None:
+        nan = float("nan")
+        pos = [G._pos.get(node_id, (nan, nan)) for node_id in tree.ids]
+        sections += [
+            ("x", array("d", (x for x, _ in pos))),
+            ("y", array("d", (y for _, y in pos))),
+        ]
+
+    sections.append(("source", array("B", source)))
+
+    header = {
+        "layout": G.layout,
+        "build_tokens": G.build_tokens,
+        "byteorder": sys.byteorder,
+        "sections": {},
+    }
+    # offsets are relative to the end of the header, aligned for the casts
+    offset = 0
+    for name, values in sections:
+        header["sections"][name] = [offset, values.typecode, len(values)]
+        offset = _align(offset + len(values) * values.itemsize)
+    header_bytes = json.dumps(header).encode()
+
+    out = bytearray(MAGIC)
+    out += array("Q", [len(header_bytes)]).tobytes()
+    out += header_bytes
+    start = _align(len(out))
+    for name, values in sections:
+        out += bytes(start + header["sections"][name][0] - len(out))
+        out += values.tobytes()
+    return bytes(out)
+
+
+def _align(n: int, alignment: int = 8) -> int:
+    return -(-n // alignment) * alignment
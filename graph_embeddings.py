@@ -1,8 +1,56 @@
 import ast
+import hashlib
+import sqlite3
+from collections import deque
 import networkx as nx
+import numpy as np
 import torch_geometric.nn as pyg_nn
 import torch
-from torch_geometric.utils.convert import from_networkx
+from torch_geometric.data import Batch, Data
+
+from graph import CodeGraph
+from metrics import qualified_functions
+
+# Index 0 stands for the types and fields missing from the vocabularies, the
+# other indices must not change so that trained models keep working: new
+# names are appended.
+AST_NODE_TYPES = (
+    "<unk>",
+    "Module", "Interactive", "Expression", "FunctionType", "FunctionDef",
+    "AsyncFunctionDef", "ClassDef", "Return", "Delete", "Assign", "AugAssign",
+    "AnnAssign", "For", "AsyncFor", "While", "If", "With", "AsyncWith", "Match",
+    "Raise", "Try", "TryStar", "Assert", "Import", "ImportFrom", "Global",
+    "Nonlocal", "Expr", "Pass", "Break", "Continue", "BoolOp", "NamedExpr",
+    "BinOp", "UnaryOp", "Lambda", "IfExp", "Dict", "Set", "ListComp", "SetComp",
+    "DictComp", "GeneratorExp", "Await", "Yield", "YieldFrom", "Compare", "Call",
+    "FormattedValue", "JoinedStr", "Constant", "Attribute", "Subscript",
+    "Starred", "Name", "List", "Tuple", "Slice", "Load", "Store", "Del", "And",
+    "Or", "Add", "Sub", "Mult", "MatMult", "Div", "Mod", "Pow", "LShift",
+    "RShift", "BitOr", "BitXor", "BitAnd", "FloorDiv", "Invert", "Not", "UAdd",
+    "USub", "Eq", "NotEq", "Lt", "LtE", "Gt", "GtE", "Is", "IsNot", "In",
+    "NotIn", "comprehension", "ExceptHandler", "arguments", "arg", "keyword",
+    "alias", "withitem", "match_case", "MatchValue", "MatchSingleton",
+    "MatchSequence", "MatchMapping", "MatchClass", "MatchStar", "MatchAs",
+    "MatchOr", "TypeIgnore",
+    # Python 3.12
+    "TypeAlias", "TypeVar", "ParamSpec", "TypeVarTuple",
+)
+AST_FIELDS = (
+    "<unk>",
+    "body", "type_ignores", "argtypes", "returns", "args", "decorator_list",
+    "bases", "keywords", "value", "targets", "target", "op", "annotation",
+    "iter", "orelse", "test", "items", "subject", "cases", "exc", "cause",
+    "handlers", "finalbody", "msg", "names", "values", "left", "right",
+    "operand", "keys", "elts", "elt", "generators", "key", "ops", "comparators",
+    "func", "format_spec", "ctx", "slice", "lower", "upper", "step", "ifs",
+    "type", "posonlyargs", "vararg", "kwonlyargs", "kw_defaults", "kwarg",
+    "defaults", "context_expr", "optional_vars", "pattern", "guard", "patterns",
+    "cls", "kwd_patterns",
+    # Python 3.12
+    "type_params", "bound", "name",
+)
+NODE_TYPE_INDEX = {name: i for i, name in enumerate(AST_NODE_TYPES)}
+FIELD_INDEX = {name: i for i, name in enumerate(AST_FIELDS)}
 
 code = """
 def main():
@@ -56,15 +104,91 @@ def _add_nodes(graph, parent_node, node):
     for child in ast.iter_child_nodes(node):
         _add_nodes(graph, node_id, child)
 
+def featurize(G, edge_fields=False, root_id=None):
+    """
+    Converts the nodes and edges of a CodeGraph to a Data object in one pass
+    over the tree, without building a NetworkX graph.
+
+    Args:
+        G: The CodeGraph, its Load and Store nodes are left out like in
+            G.our_nodes.
+        root_id: With it, only the subtree of this node (e.g. a function) is
+            converted.
+        edge_fields: Whether to add edge_type, the index in AST_FIELDS of the
+            field of the parent holding each child (the name ASTEdge.attrs
+            gives).
+
+    Returns:
+        A Data object with x, the index in AST_NODE_TYPES of the type of each
+        node, edge_index, the parent to child edges, and node_id, the id of
+        each node in G. All of them are int64 tensors.
+    """
+
+    if root_id is None:
+        nodes = G.our_nodes.items()
+    else:
+        nodes = [(i, G.our_nodes[i]) for i in G.subtree(root_id) if i in G.our_nodes]
+    num_nodes = len(nodes)
+    node_type = np.empty(num_nodes, dtype=np.int64)
+    node_id = np.empty(num_nodes, dtype=np.int64)
+    # a tree: one edge per node but the root
+    edge_index = np.empty((2, max(num_nodes - 1, 0)), dtype=np.int64)
+    edge_type = np.empty(max(num_nodes - 1, 0), dtype=np.int64) if edge_fields else None
+
+    # the nodes are in preorder, so the parents are numbered before their children
+    index = {}
+    fields = {}
+    e = 0
+    for i, (current_id, node) in enumerate(nodes):
+        index[current_id] = i
+        node_id[i] = current_id
+        ast_node = node.ast_node
+        node_type[i] = NODE_TYPE_INDEX.get(ast_node.__class__.__name__, 0)
+        if edge_fields:
+            # the children of a node are in the order of its fields
+            child_ids = iter(G.children(current_id))
+            for field, value in ast.iter_fields(ast_node):
+                for child in value if isinstance(value, list) else (value,):
+                    if isinstance(child, ast.AST):
+                        fields[next(child_ids)] = FIELD_INDEX.get(field, 0)
+        parent_id = G.get_parent(current_id)
+        if parent_id is None or parent_id not in index:
+            continue
+        edge_index[0, e] = index[parent_id]
+        edge_index[1, e] = i
+        if edge_fields:
+            edge_type[e] = fields.pop(current_id)
+        e += 1
+
+    data = Data(
+        x=torch.from_numpy(node_type),
+        edge_index=torch.from_numpy(edge_index[:, :e]),
+        node_id=torch.from_numpy(node_id),
+        num_nodes=num_nodes,
+    )
+    if edge_fields:
+        data.edge_type = torch.from_numpy(edge_type[:e])
+    return data
+
+
 class GraphConvModel(pyg_nn.MessagePassing):
-    def __init__(self, emb_dim):
+    def __init__(self, emb_dim, num_types=None):
+        """
+        Args:
+            emb_dim: The size of the node embeddings.
+            num_types: With it, x can be the node type indices of featurize()
+                (num_types=len(AST_NODE_TYPES)), they are embedded first.
+        """
         super(GraphConvModel, self).__init__(aggr='add')
 
+        self.embedding = torch.nn.Embedding(num_types, emb_dim) if num_types else None
         self.linear = torch.nn.Linear(emb_dim, emb_dim)
 
     def forward(self, x, edge_index):
-        # x has shape [N, in_channels]
+        # x has shape [N, in_channels], or [N] for node type indices
         # edge_index has shape [2, E]
+        if self.embedding is not None and not x.is_floating_point():
+            x = self.embedding(x)
 
         # Perform message passing.
         x = self.propagate(edge_index, x=x)
@@ -80,22 +204,244 @@ class GraphConvModel(pyg_nn.MessagePassing):
         # Return the message to be passed to the target nodes.
         return x_j
 
-# Parse code as AST and convert to Networkx
-tree = ast.parse(code)
-networkx_tree = ast_to_networkx(tree)
+def model_fingerprint(model):
+    """
+    Hash of the parameters of a model, embeddings computed with other
+    parameters are not taken from the cache.
+    """
+
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(len(AST_NODE_TYPES)).encode())
+    for name, tensor in model.state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of pooled graph embeddings, a SQLite database keyed by the
+    model fingerprint and the source hash of the graph (CodeGraph.subtree_hash,
+    it ignores formatting and comments).
+    """
+
+    # SQLite limits the number of parameters of a query
+    CHUNK = 500
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(model TEXT, key TEXT, vector BLOB, PRIMARY KEY (model, key))"
+        )
+        self.hits = self.misses = 0
+
+    def get_many(self, model, keys):
+        """
+        Args:
+            model: The model fingerprint.
+            keys: The source hashes.
+
+        Returns:
+            The float32 embeddings found, by source hash.
+        """
+
+        keys = list(keys)
+        found = {}
+        for start in range(0, len(keys), self.CHUNK):
+            chunk = keys[start:start + self.CHUNK]
+            rows = self.connection.execute(
+                f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN "
+                f"({', '.join('?' * len(chunk))})",
+                [model, *chunk],
+            )
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+        self.hits += len(found)
+        self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, model, embeddings):
+        """
+        Args:
+            model: The model fingerprint.
+            embeddings: (source hash, embedding) pairs.
+        """
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                [(model, key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in embeddings],
+            )
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class GraphEmbedder:
+    """
+    Pooled embeddings of code graphs (or of subtrees of them, like functions)
+    computed with a GraphConvModel. The graphs whose embeddings are not in the
+    cache are featurized and packed into mini-batches of at most node_budget
+    nodes (a larger graph gets a batch of its own), the model runs on every
+    batch under torch.inference_mode() and the node embeddings are averaged
+    per graph.
+
+    Args:
+        model: The GraphConvModel, created with num_types.
+        cache: An EmbeddingCache or the path of one, None for no cache.
+        node_budget: The maximum number of nodes of a mini-batch.
+        threads: The number of CPU threads of torch during inference, the
+            current setting by default.
+        edge_fields: Whether the graphs are featurized with their edge types.
+    """
+
+    # graphs looked up in the cache at once
+    LOOKUP = 1024
+
+    def __init__(self, model, cache=None, node_budget=20000, threads=None, edge_fields=False):
+        self.model = model
+        if cache is not None and not isinstance(cache, EmbeddingCache):
+            cache = EmbeddingCache(cache)
+        self.cache = cache
+        self.node_budget = node_budget
+        self.threads = threads
+        self.edge_fields = edge_fields
+        self.fingerprint = model_fingerprint(model)
+
+    def embed(self, graphs):
+        """
+        Args:
+            graphs: CodeGraphs, or (CodeGraph, node id) pairs for subtrees.
+
+        Returns:
+            An iterator of the embeddings (float32 numpy arrays), in the order
+            of graphs.
+        """
+
+        pending = []
+        for item in graphs:
+            G, root_id = item if isinstance(item, tuple) else (item, item.root_id)
+            pending.append((G, root_id, format(G.subtree_hash(root_id), "016x")))
+            if len(pending) >= self.LOOKUP:
+                yield from self._embed_pending(pending)
+                pending = []
+        yield from self._embed_pending(pending)
+
+    def embed_functions(self, graphs):
+        """
+        Args:
+            graphs: CodeGraphs.
+
+        Returns:
+            An iterator of (CodeGraph, node id, qualified name, embedding) of
+            every function of the graphs, nested functions included.
+        """
+
+        def functions():
+            for G in graphs:
+                for node_id, qualname in qualified_functions(G):
+                    yield G, node_id, qualname
+
+        # the functions given to embed() and not embedded yet
+        buffer = deque()
+
+        def pairs():
+            for G, node_id, qualname in functions():
+                buffer.append((G, node_id, qualname))
+                yield G, node_id
+
+        for embedding in self.embed(pairs()):
+            yield (*buffer.popleft(), embedding)
+
+    def _embed_pending(self, pending):
+        if not pending:
+            return []
+        found = {}
+        if self.cache is not None:
+            found = self.cache.get_many(self.fingerprint, {key for _, _, key in pending})
+
+        missing = {}
+        for G, root_id, key in pending:
+            if key not in found and key not in missing:
+                missing[key] = (G, root_id)
+        if missing:
+            computed = self._compute(list(missing.items()))
+            found.update(computed)
+            if self.cache is not None:
+                self.cache.put_many(self.fingerprint, computed.items())
+
+        return [found[key] for _, _, key in pending]
+
+    def _compute(self, graphs):
+        """
+        Embeddings of (source hash, (CodeGraph, node id)) by source hash, the
+        graphs are packed into mini-batches of node_budget nodes.
+
+        The thread count and the mode of the model are only changed while
+        computing, not while the caller of embed() holds the iterator.
+        """
+
+        threads = torch.get_num_threads()
+        if self.threads is not None:
+            torch.set_num_threads(self.threads)
+        was_training = self.model.training
+        self.model.eval()
+        try:
+            embeddings = {}
+            batch, keys, nodes = [], [], 0
+            for key, (G, root_id) in graphs:
+                data = featurize(G, self.edge_fields, None if root_id == G.root_id else root_id)
+                if batch and nodes + data.num_nodes > self.node_budget:
+                    embeddings.update(zip(keys, self._run(batch)))
+                    batch, keys, nodes = [], [], 0
+                batch.append(data)
+                keys.append(key)
+                nodes += data.num_nodes
+            if batch:
+                embeddings.update(zip(keys, self._run(batch)))
+            return embeddings
+        finally:
+            self.model.train(was_training)
+            torch.set_num_threads(threads)
+
+    def _run(self, datas):
+        batch = Batch.from_data_list(datas)
+        with torch.inference_mode():
+            x = self.model(batch.x, batch.edge_index)
+            pooled = pyg_nn.global_mean_pool(x, batch.batch, size=len(datas))
+        return list(pooled.float().numpy())
+
+
+def embed_graphs(graphs, model, cache=None, **kwargs):
+    """
+    GraphEmbedder(model, cache, **kwargs).embed(graphs) as a list.
+    """
+
+    return list(GraphEmbedder(model, cache, **kwargs).embed(graphs))
 
-# print(ast.dump(tree))
 
-# Convert NetworkX graph to PyTorch Geometric Data object
-data = from_networkx(networkx_tree)
-data.x = torch.randn((data.num_nodes, 32))
+if __name__ == "__main__":
+    # Parse code as AST and convert it to a PyTorch Geometric Data object
+    tree = ast.parse(code)
+    data = featurize(CodeGraph(tree, build_tokens=False), edge_fields=True)
 
-# Create a GraphConvModel instance.
-model = GraphConvModel(emb_dim=32)
+    # Create a GraphConvModel instance.
+    model = GraphConvModel(emb_dim=32, num_types=len(AST_NODE_TYPES))
 
-# Perform graph embedding.
-x = model(data.x, data.edge_index)
+    # Perform graph embedding.
+    x = model(data.x, data.edge_index)
 
-# Print the node embeddings.
-print(x)
+    # Print the node embeddings.
+    print(x)
 
@@ -0,0 +1,177 @@
+from typing import Dict, Hashable, List, Tuple
+
+
+class _TidyNode:
+    __slots__ = (
+        "key",
+        "parent",
+        "children",
+        "number",
+        "depth",
+        "prelim",
+        "mod",
+        "shift",
+        "change",
+        "thread",
+        "ancestor",
+        "default_ancestor",
+        "x",
+    )
+
+    def __init__(self, key, parent=None, number=0, depth=0):
+        self.key = key
+        self.parent = parent
+        self.children: List[_TidyNode] = []
+        self.number = number
+        self.depth = depth
+        self.prelim = 0.0
+        self.mod = 0.0
+        self.shift = 0.0
+        self.change = 0.0
+        self.thread = None
+        self.ancestor = self
+        self.default_ancestor = None
+        self.x = 0.0
+
+    def left_sibling(self):
+        if self.parent is not None and self.number > 0:
+            return self.parent.children[self.number - 1]
+        return None
+
+    def leftmost_sibling(self):
+        if self.parent is not None:
+            return self.parent.children[0]
+        return self
+
+    def next_left(self):
+        return self.children[0] if self.children else self.thread
+
+    def next_right(self):
+        return self.children[-1] if self.children else self.thread
+
+
+def tidy_tree_layout(
+    root: Hashable,
+    children: Dict[Hashable, List[Hashable]],
+    x_sep: float = 150,
+    y_sep: float = 100,
+) -> Dict[Hashable, Tuple[float, float]]:
+    """
+    Reingold-Tilford tidy tree layout in linear time (Buchheim, Juenger and Leipert, 2002)
+
+    children maps every node to the list of its children, nodes missing from it are leaves.
+    Returns the centre of every node in the graphviz convention: the root is on top
+    and y grows upwards.
+    """
+    tree_root = _TidyNode(root)
+    nodes = [tree_root]
+    stack = [tree_root]
+    while stack:
+        v = stack.pop()
+        for i, key in enumerate(children.get(v.key, ())):
+            w = _TidyNode(key, v, i, v.depth + 1)
+            v.children.append(w)
+            nodes.append(w)
+            stack.append(w)
+
+    _first_walk(tree_root)
+
+    # second walk: sum up the modifiers on the way down
+    stack = [(tree_root, 0.0)]
+    while stack:
+        v, m = stack.pop()
+        v.x = v.prelim + m
+        stack.extend((w, m + v.mod) for w in v.children)
+
+    x_min = min(v.x for v in nodes)
+    depth_max = max(v.depth for v in nodes)
+    return {
+        v.key: ((v.x - x_min) * x_sep, (depth_max - v.depth) * y_sep) for v in nodes
+    }
+
+
+def _first_walk(tree_root: _TidyNode):
+    # postorder with an explicit stack, apportioning each child as soon as its
+    # subtree is placed, exactly like the recursive formulation
+    stack = [(tree_root, 0)]
+    while stack:
+        v, i = stack[-1]
+        if i < len(v.children):
+            stack[-1] = (v, i + 1)
+            stack.append((v.children[i], 0))
+            continue
+        stack.pop()
+
+        w = v.left_sibling()
+        if v.children:
+            _execute_shifts(v)
+            midpoint = (v.children[0].prelim + v.children[-1].prelim) / 2
+            if w is not None:
+                v.prelim = w.prelim + 1
+                v.mod = v.prelim - midpoint
+            else:
+                v.prelim = midpoint
+        elif w is not None:
+            v.prelim = w.prelim + 1
+
+        parent = v.parent
+        if parent is not None:
+            if parent.default_ancestor is None:
+                parent.default_ancestor = parent.children[0]
+            parent.default_ancestor = _apportion(v, parent.default_ancestor)
+
+
+def _apportion(v: _TidyNode, default_ancestor: _TidyNode) -> _TidyNode:
+    w = v.left_sibling()
+    if w is None:
+        return default_ancestor
+
+    vir = vor = v
+    vil = w
+    vol = v.leftmost_sibling()
+    sir = sor = v.mod
+    sil = vil.mod
+    sol = vol.mod
+    while vil.next_right() is not None and vir.next_left() is not None:
+        vil = vil.next_right()
+        vir = vir.next_left()
+        vol = vol.next_left()
+        vor = vor.next_right()
+        vor.ancestor = v
+        shift = (vil.prelim + sil) - (vir.prelim + sir) + 1
+        if shift > 0:
+            ancestor = vil.ancestor if vil.ancestor.parent is v.parent else default_ancestor
+            _move_subtree(ancestor, v, shift)
+            sir += shift
+            sor += shift
+        sil += vil.mod
+        sir += vir.mod
+        sol += vol.mod
+        sor += vor.mod
+
+    if vil.next_right() is not None and vor.next_right() is None:
+        vor.thread = vil.next_right()
+        vor.mod += sil - sor
+    if vir.next_left() is not None and vol.next_left() is None:
+        vol.thread = vir.next_left()
+        vol.mod += sir - sol
+        default_ancestor = v
+    return default_ancestor
+
+
+def _move_subtree(wl: _TidyNode, wr: _TidyNode, shift: float):
+    subtrees = wr.number - wl.number
+    wr.change -= shift / subtrees
+    wr.shift += shift
+    wl.change += shift / subtrees
+    wr.prelim += shift
+    wr.mod += shift
+
+
+def _execute_shifts(v: _TidyNode):
+    shift = change = 0.0
+    for w in reversed(v.children):
+        w.prelim += shift
+        w.mod += shift
+        change += w.change
+        shift += w.shift + change
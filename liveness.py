@@ -0,0 +1,408 @@
+import ast
+import bisect
+from typing import Dict, Iterator, List, Set, Tuple
+
+from graph import path_id
+from scopes import DEF, SCOPE_KINDS, USE
+
+
+SCOPE_STATEMENTS = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+FUNCTION_STATEMENTS = (ast.FunctionDef, ast.AsyncFunctionDef)
+LOOP_TYPES = (ast.For, ast.AsyncFor, ast.While)
+TRY_TYPES = tuple(getattr(ast, name) for name in ("Try", "TryStar") if hasattr(ast, name))
+# scopes whose code runs after they are defined
+LAZY_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.GeneratorExp)
+# nodes that leave or suspend the function they are in, a statement containing one
+# outside of a nested scope cannot be moved to another function
+ESCAPE_TYPES = (ast.Return, ast.Yield, ast.YieldFrom, ast.Await, ast.Global, ast.Nonlocal)
+
+
+class Flow:
+    """
+    variables of a scope used and set by statements
+
+    uses: read before being set on some path (upward exposed), in order of occurence
+    must: set on every path
+    may: set on some path, in order of occurence
+    """
+
+    __slots__ = ("uses", "must", "may")
+
+    def __init__(
+        self,
+        uses: Dict[str, None] = None,
+        must: Set[str] = None,
+        may: Dict[str, None] = None,
+    ):
+        self.uses = {} if uses is None else uses
+        self.must = set() if must is None else must
+        self.may = {} if may is None else may
+
+    def then(self, other: "Flow") -> "Flow":
+        """
+        self followed by other
+        """
+        uses = dict(self.uses)
+        for name in other.uses:
+            if name not in self.must:
+                uses[name] = None
+        return Flow(uses, self.must | other.must, {**self.may, **other.may})
+
+    def alt(self, other: "Flow") -> "Flow":
+        """
+        either self or other
+        """
+        return Flow({**self.uses, **other.uses}, self.must & other.must, {**self.may, **other.may})
+
+    def maybe(self) -> "Flow":
+        """
+        self or nothing
+        """
+        return Flow(self.uses, set(), self.may)
+
+    def __repr__(self):
+        return f"Flow(uses={list(self.uses)}, must={sorted(self.must)}, may={list(self.may)})"
+
+
+class Region:
+    """
+    statements start to end (included) of the body of parent_id: params are the
+    variables they read that are set before them and returns the ones they set that
+    are read after them
+    """
+
+    __slots__ = ("parent_id", "start", "end", "params", "returns")
+
+    def __init__(self, parent_id: int, start: int, end: int, params: List[str], returns: List[str]):
+        self.parent_id = parent_id
+        self.start = start
+        self.end = end
+        self.params = params
+        self.returns = returns
+
+    def __len__(self):
+        return self.end - self.start + 1
+
+    def __repr__(self):
+        return f"Region({self.start}:{self.end}, params={self.params}, returns={self.returns})"
+
+
+class Liveness:
+    """
+    statement level liveness of the variables of G
+
+    The flow of every statement and the variables live before every statement of a
+    body are computed once, on first use, so the parameters and return values of
+    any slice of a body (region) cost a few set operations. G must be refreshed.
+    """
+
+    def __init__(self, G):
+        self.G = G
+        # node id -> (id of the scope owning the name, name, flags)
+        self._names: Dict[int, Tuple[int, str, int]] = {}
+        self._def_counts: Dict[Tuple[int, str], int] = {}
+        for scope_id, tokens in G.lookup.items():
+            for name, token in tokens.items():
+                for node_id in token.uses:
+                    self._names[node_id] = (scope_id, name, USE)
+                for node_id in token.defs:
+                    flags = self._names.get(node_id, (0, "", 0))[2] | DEF
+                    # del needs the variable to be set
+                    if getattr(G.ast_nodes[node_id], "ctx", None).__class__ is ast.Del:
+                        flags |= USE
+                    self._names[node_id] = (scope_id, name, flags)
+                self._def_counts[(scope_id, name)] = len(token.defs)
+
+        self._flows: Dict[int, Flow] = {}
+        self._escapes: Dict[int, bool] = {}
+        self._cell_names: Dict[int, Set[str]] = {}
+        # (node id, field) -> variables live before each statement of the list and after it
+        self._live: Dict[Tuple[int, str], List[Set[str]]] = {}
+        # body owner id -> name -> sorted indices of the statements setting it
+        self._defs: Dict[int, Dict[str, List[int]]] = {}
+
+    def scope_of(self, node_id: int) -> int:
+        """
+        id of the scope the statements of the body of node_id belong to
+        """
+        G = self.G
+        for current_id in (node_id, *G.ancestors(node_id)):
+            if isinstance(G.ast_nodes[current_id], SCOPE_STATEMENTS):
+                return current_id
+        return G.root_id
+
+    def flow(self, stmt_id: int, scope_id: int = None) -> Flow:
+        if stmt_id not in self._flows:
+            if scope_id is None:
+                scope_id = self.scope_of(self.G.get_parent(stmt_id))
+            self._flows[stmt_id] = self._statement_flow(stmt_id, scope_id)
+        return self._flows[stmt_id]
+
+    def live(self, node_id: int, field: str = "body") -> List[Set[str]]:
+        """
+        variables live before each statement of the list field of node_id, and
+        after the last one
+        """
+        key = (node_id, field)
+        if key not in self._live:
+            G = self.G
+            scope_id = self.scope_of(node_id)
+            ids = [path_id(node_id, field, i) for i in range(len(getattr(G.ast_nodes[node_id], field)))]
+            live = [set() for _ in range(len(ids) + 1)]
+            live[-1] = self._live_out(node_id, field, scope_id)
+            for i in range(len(ids) - 1, -1, -1):
+                flow = self.flow(ids[i], scope_id)
+                live[i] = (live[i + 1] - flow.must) | flow.uses.keys()
+            self._live[key] = live
+        return self._live[key]
+
+    def escapes(self, stmt_id: int) -> bool:
+        """
+        whether the statement cannot be moved to another function: it returns,
+        yields, awaits, declares global or nonlocal names, breaks out of a loop it
+        is not in, sets a global variable or defines a closure over the variables
+        of its scope
+        """
+        if stmt_id not in self._escapes:
+            self._escapes[stmt_id] = self._find_escape(stmt_id)
+        return self._escapes[stmt_id]
+
+    def region(self, parent_id: int, start: int, end: int) -> Region:
+        """
+        region of the statements start to end (included) of the body of parent_id,
+        raises ValueError if they cannot be extracted
+        """
+        G = self.G
+        body = G.ast_nodes[parent_id].body
+        if not 0 <= start <= end < len(body):
+            raise ValueError(f"Invalid region {start}:{end} of a body of {len(body)} statements")
+        scope_id = self.scope_of(parent_id)
+        flow = Flow()
+        for i in range(start, end + 1):
+            stmt_id = path_id(parent_id, "body", i)
+            if self.escapes(stmt_id):
+                raise ValueError(f"Statement {i} cannot be moved to another function")
+            flow = flow.then(self.flow(stmt_id, scope_id))
+        return self._region(parent_id, scope_id, start, end, flow)
+
+    def regions(self, parent_id: int, min_size: int = 1, max_size: int = None) -> Iterator[Region]:
+        """
+        every region of the body of parent_id that can be extracted, the flows of
+        the regions starting at the same statement are built incrementally
+        """
+        G = self.G
+        n = len(G.ast_nodes[parent_id].body)
+        max_size = n if max_size is None else max_size
+        scope_id = self.scope_of(parent_id)
+        ids = [path_id(parent_id, "body", i) for i in range(n)]
+        for start in range(n):
+            flow = Flow()
+            for end in range(start, min(n, start + max_size)):
+                if self.escapes(ids[end]):
+                    break
+                flow = flow.then(self.flow(ids[end], scope_id))
+                if end - start + 1 >= min_size:
+                    yield self._region(parent_id, scope_id, start, end, flow)
+
+    def _region(self, parent_id: int, scope_id: int, start: int, end: int, flow: Flow) -> Region:
+        live_after = self.live(parent_id)[end + 1]
+        defs = self._body_defs(parent_id, scope_id)
+
+        def set_outside(name: str) -> bool:
+            positions = defs.get(name, ())
+            inside = bisect.bisect_right(positions, end) - bisect.bisect_left(positions, start)
+            return self._def_counts.get((scope_id, name), 0) > inside
+
+        returns = [name for name in flow.may if name in live_after]
+        params = [name for name in flow.uses if set_outside(name)]
+        # a variable set on some paths only keeps its value from before on the others
+        params += [
+            name for name in returns
+            if name not in flow.must and name not in flow.uses and set_outside(name)
+        ]
+        return Region(parent_id, start, end, params, returns)
+
+    def _body_defs(self, parent_id: int, scope_id: int) -> Dict[str, List[int]]:
+        if parent_id not in self._defs:
+            defs: Dict[str, List[int]] = {}
+            for i in range(len(self.G.ast_nodes[parent_id].body)):
+                for name, flags, _ in self._occurences(path_id(parent_id, "body", i), scope_id):
+                    if flags & DEF:
+                        defs.setdefault(name, []).append(i)
+            self._defs[parent_id] = defs
+        return self._defs[parent_id]
+
+    def _occurences(self, node_id: int, scope_id: int) -> List[Tuple[str, int, bool]]:
+        """
+        (name, flags, in a nested scope) of the variables of scope_id in the subtree
+        of node_id, in order
+        """
+        G = self.G
+        names = self._names
+        occurences = []
+        stack = [(node_id, False)]
+        while stack:
+            current_id, nested = stack.pop()
+            record = names.get(current_id)
+            if record is not None and record[0] == scope_id:
+                occurences.append((record[1], record[2], nested))
+            inner = nested or G.ast_nodes[current_id].__class__ in SCOPE_KINDS
+            stack.extend((child_id, inner) for child_id in reversed(G.children(current_id)))
+        return occurences
+
+    def _simple_flow(self, node_id: int, scope_id: int) -> Flow:
+        """
+        flow of a node without statements, its reads come before its writes (the
+        value of an assignment is evaluated before its targets)
+        """
+        flow = Flow()
+        for name, flags, nested in self._occurences(node_id, scope_id):
+            if flags & USE:
+                flow.uses[name] = None
+            if flags & DEF:
+                flow.may[name] = None
+                if not nested:
+                    flow.must.add(name)
+        return flow
+
+    def _statement_flow(self, stmt_id: int, scope_id: int) -> Flow:
+        node = self.G.ast_nodes[stmt_id]
+
+        def part(field: str) -> Flow:
+            if getattr(node, field, None) is None:
+                return Flow()
+            return self._simple_flow(path_id(stmt_id, field), scope_id)
+
+        def block(owner_id: int, field: str) -> Flow:
+            flow = Flow()
+            for i in range(len(getattr(self.G.ast_nodes[owner_id], field))):
+                flow = flow.then(self.flow(path_id(owner_id, field, i), scope_id))
+            return flow
+
+        if isinstance(node, ast.If):
+            return part("test").then(block(stmt_id, "body").alt(block(stmt_id, "orelse")))
+        if isinstance(node, (ast.For, ast.AsyncFor)):
+            loop = part("target").then(block(stmt_id, "body"))
+            return part("iter").then(loop.maybe()).then(block(stmt_id, "orelse").maybe())
+        if isinstance(node, ast.While):
+            loop = block(stmt_id, "body")
+            return part("test").then(loop.maybe()).then(block(stmt_id, "orelse").maybe())
+        if isinstance(node, (ast.With, ast.AsyncWith)):
+            flow = Flow()
+            for i in range(len(node.items)):
+                flow = flow.then(self._simple_flow(path_id(stmt_id, "items", i), scope_id))
+            return flow.then(block(stmt_id, "body"))
+        if isinstance(node, TRY_TYPES):
+            # the code after the try is reached once the body and the else block or
+            # one of the handlers are done, the handlers may start after any statement
+            flow = block(stmt_id, "body").then(block(stmt_id, "orelse"))
+            for i, handler in enumerate(node.handlers):
+                handler_id = path_id(stmt_id, "handlers", i)
+                handler_flow = Flow()
+                if handler.type is not None:
+                    handler_flow = self._simple_flow(path_id(handler_id, "type"), scope_id)
+                if handler.name is not None:
+                    handler_flow = handler_flow.then(Flow(must={handler.name}, may={handler.name: None}))
+                handler_flow = handler_flow.then(block(handler_id, "body"))
+                flow = Flow(
+                    {**flow.uses, **handler_flow.uses},
+                    flow.must & handler_flow.must,
+                    {**flow.may, **handler_flow.may},
+                )
+            final = block(stmt_id, "finalbody")
+            return Flow({**flow.uses, **final.uses}, flow.must | final.must, {**flow.may, **final.may})
+        if isinstance(node, ast.Match):
+            flow = part("subject")
+            for i, case in enumerate(node.cases):
+                case_id = path_id(stmt_id, "cases", i)
+                case_flow = self._simple_flow(path_id(case_id, "pattern"), scope_id)
+                if case.guard is not None:
+                    case_flow = case_flow.then(self._simple_flow(path_id(case_id, "guard"), scope_id))
+                flow = flow.then(case_flow.then(block(case_id, "body")).maybe())
+            return flow
+        return self._simple_flow(stmt_id, scope_id)
+
+    def _live_out(self, node_id: int, field: str, scope_id: int) -> Set[str]:
+        G = self.G
+        node = G.ast_nodes[node_id]
+        if node_id == scope_id:
+            if isinstance(node, FUNCTION_STATEMENTS):
+                return set(self._cells(scope_id))
+            # module and class variables outlive their body
+            return set(G.lookup.get(scope_id, {}))
+
+        stmt_id = node_id
+        if isinstance(node, (ast.ExceptHandler, ast.match_case)):
+            stmt_id = G.get_parent(node_id)
+        container_id, container_field, index = self._position(stmt_id)
+        live = self.live(container_id, container_field)[index + 1]
+        if isinstance(G.ast_nodes[stmt_id], LOOP_TYPES + TRY_TYPES):
+            # the loop runs again and the handlers run after any statement of a try
+            live = live | self.flow(stmt_id, scope_id).uses.keys()
+        return live
+
+    def _cells(self, scope_id: int) -> Set[str]:
+        """
+        variables of the scope used by the functions nested in it, they may be read
+        at any time
+        """
+        if scope_id not in self._cell_names:
+            G = self.G
+            names = self._names
+            cells = set()
+            stack = [(child_id, False) for child_id in G.children(scope_id)]
+            while stack:
+                current_id, lazy = stack.pop()
+                record = names.get(current_id)
+                if lazy and record is not None and record[0] == scope_id:
+                    cells.add(record[1])
+                closure = lazy or isinstance(G.ast_nodes[current_id], LAZY_TYPES)
+                stack.extend((child_id, closure) for child_id in G.children(current_id))
+            self._cell_names[scope_id] = cells
+        return self._cell_names[scope_id]
+
+    def _position(self, stmt_id: int) -> Tuple[int, str, int]:
+        """
+        parent id, field and index in the field of a statement
+        """
+        G = self.G
+        parent_id = G.get_parent(stmt_id)
+        for field, value in ast.iter_fields(G.ast_nodes[parent_id]):
+            if isinstance(value, list):
+                for i in range(len(value)):
+                    if path_id(parent_id, field, i) == stmt_id:
+                        return parent_id, field, i
+        raise ValueError(f"Node {stmt_id} is not in a list")
+
+    def _find_escape(self, stmt_id: int) -> bool:
+        G = self.G
+        names = self._names
+        scope_id = self.scope_of(G.get_parent(stmt_id))
+        # (node id, in a nested scope, in a nested function, in a loop)
+        stack = [(stmt_id, False, False, False)]
+        while stack:
+            current_id, nested, lazy, in_loop = stack.pop()
+            node = G.ast_nodes[current_id]
+            record = names.get(current_id)
+            if record is not None:
+                if record[0] == scope_id:
+                    # a closure or a nested scope setting a variable of this scope
+                    # would see another variable once moved, as would the closures
+                    # defined elsewhere reading a variable set here
+                    if lazy or (nested and record[2] & DEF):
+                        return True
+                    if record[2] & DEF and record[1] in self._cells(scope_id):
+                        return True
+                elif not nested and record[2] & DEF:
+                    # a global or nonlocal variable set by this scope
+                    return True
+            if not nested:
+                if isinstance(node, ESCAPE_TYPES):
+                    return True
+                if isinstance(node, (ast.Break, ast.Continue)) and not in_loop:
+                    return True
+            inner = nested or node.__class__ in SCOPE_KINDS
+            closure = lazy or isinstance(node, LAZY_TYPES)
+            loop = in_loop or isinstance(node, LOOP_TYPES)
+            stack.extend((child_id, inner, closure, loop) for child_id in G.children(current_id))
+        return False
@@ -1,6 +1,13 @@
+import ast
+import math
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+
 from radon.complexity import cc_rank, cc_visit
 from radon.raw import analyze
-from radon.metrics import mi_visit
+from radon.metrics import mi_compute, mi_visit
+
+from scopes import child_fields
 
 def calculate_metrics(code):
     #cyclomatic complexity
@@ -18,4 +25,363 @@ def calculate_metrics(code):
         'Average Complexity': average_complexity,
         'Lines of Code': loc,
         'Maintainability Index': maintainability_index,
-    }
\ No newline at end of file
+    }
+
+
+FUNCTION_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef)
+HALSTEAD_OPERATORS = (ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.AugAssign, ast.Compare)
+# nodes that put a ":" inside a line, radon counts such a line twice
+COLON_TYPES = (ast.Lambda, ast.Slice, ast.DictComp, ast.AnnAssign)
+
+
+class Counts:
+    """
+    metrics of a subtree that add up: complexity is the one of the function the
+    counts are for, lloc/sloc/multi the lines radon would count in the source
+    generated by CodeGraph.to_source and the others the halstead operators and operands
+    """
+
+    __slots__ = (
+        "complexity", "lloc", "sloc", "multi",
+        "operators", "operands", "operator_names", "operand_values", "unique_operands",
+    )
+
+    def __init__(self):
+        self.complexity = 1
+        self.lloc = self.sloc = self.multi = 0
+        self.operators = self.operands = self.unique_operands = 0
+        self.operator_names = set()
+        self.operand_values = set()
+
+    def add(self, other: "Counts"):
+        self.lloc += other.lloc
+        self.sloc += other.sloc
+        self.multi += other.multi
+        self.operators += other.operators
+        self.operands += other.operands
+        self.unique_operands += other.unique_operands
+        self.operator_names |= other.operator_names
+        self.operand_values |= other.operand_values
+
+    @property
+    def volume(self) -> float:
+        h = len(self.operator_names) + len(self.operand_values) + self.unique_operands
+        return (self.operators + self.operands) * math.log(h, 2) if h else 0
+
+    @property
+    def maintainability_index(self) -> float:
+        comments = self.multi / float(self.sloc) * 100 if self.sloc else 0
+        return mi_compute(self.volume, self.complexity, self.lloc, comments)
+
+
+class Block:
+    """
+    complexity of the module or of a class: decision points outside of functions
+    and complexities of the functions (methods for a class) found directly in it
+    """
+
+    __slots__ = ("kind", "decisions", "functions", "classes")
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.decisions = 0
+        self.functions: List[int] = []
+        self.classes: List[Block] = []
+
+    @property
+    def real_complexity(self) -> int:
+        return 1 + self.decisions + sum(self.functions)
+
+    @property
+    def complexity(self) -> int:
+        # radon's class complexity: average complexity of the methods plus one
+        if not self.functions:
+            return self.real_complexity
+        n = len(self.functions)
+        return int(self.real_complexity / float(n)) + (n > 1)
+
+
+def qualified_functions(G) -> Iterator[Tuple[int, str]]:
+    """
+    (node id, qualified name) of every function of G in source order, nested
+    functions included
+    """
+    for node_id, node in G.ast_nodes.items():
+        if node.__class__ in FUNCTION_TYPES:
+            names = [node.name]
+            for ancestor_id in G.ancestors(node_id):
+                ancestor = G.ast_nodes[ancestor_id]
+                if ancestor.__class__ in FUNCTION_TYPES:
+                    names.append(ancestor.name + ".<locals>")
+                elif ancestor.__class__ is ast.ClassDef:
+                    names.append(ancestor.name)
+            yield node_id, ".".join(reversed(names))
+
+
+class GraphMetrics:
+    """
+    the metrics of calculate_metrics computed from the nodes of a CodeGraph in one
+    pass, without generating the source and parsing it again as radon does
+
+    The counts of every function are cached by CodeGraph.subtree_hash, so after a
+    transform only the functions it touched are visited again.
+
+    The results are the ones of calculate_metrics(G.to_source()): the complexities
+    are radon's cc_visit blocks, and the lines are counted as radon counts them in
+    the text printed by ast.unparse, which writes one line per statement and only
+    docstrings on several lines. Comments are not in the ast and count as 0.
+    """
+
+    def __init__(self, max_functions: int = 100000):
+        self.max_functions = max_functions
+        self._functions: "OrderedDict[int, Counts]" = OrderedDict()
+        self.hits = self.misses = 0
+
+    def __call__(self, G) -> Dict[str, float]:
+        counts = Counts()
+        module = Block("module")
+        root = G.ast_nodes[G.root_id]
+        if isinstance(root, ast.Module):
+            stack = [(child_id, None, module, None) for child_id in G.children(G.root_id)]
+        else:
+            stack = [(G.root_id, None, module, None)]
+        self._walk(G, stack, counts)
+
+        blocks = list(module.functions)
+        for cls in module.classes:
+            blocks.append(cls.complexity)
+            blocks.extend(cls.functions)
+        total_complexity = (
+            1 + module.decisions
+            + sum(c - 1 for c in module.functions)
+            + sum(cls.real_complexity - 1 for cls in module.classes)
+        )
+
+        h1 = len(counts.operator_names)
+        h2 = len(counts.operand_values) + counts.unique_operands
+        volume = counts.volume
+        difficulty = (h1 * counts.operands) / float(2 * h2) if h2 else 0
+        counts.complexity = total_complexity
+
+        return {
+            'Average Complexity': sum(blocks) / len(blocks) if blocks else 0,
+            'Lines of Code': counts.lloc,
+            'Maintainability Index': counts.maintainability_index,
+            'Total Complexity': total_complexity,
+            'Halstead Volume': volume,
+            'Halstead Difficulty': difficulty,
+            'Halstead Effort': difficulty * volume,
+        }
+
+    def function(self, G, node_id: int) -> Counts:
+        """
+        counts of the function defined at node_id
+        """
+        key = G.subtree_hash(node_id)
+        counts = self._functions.get(key)
+        if counts is not None:
+            self.hits += 1
+            self._functions.move_to_end(key)
+            return counts
+        self.misses += 1
+
+        node = G.ast_nodes[node_id]
+        counts = Counts()
+        counts.lloc = counts.sloc = 1 + len(node.decorator_list)
+        # like radon, only the body counts for the complexity and halstead measures
+        block = Block("function")
+        stack = []
+        for field, child_id in zip(child_fields(node), G.children(node_id)):
+            if field == "body":
+                stack.append((child_id, node.name, block, None))
+            elif field == "decorator_list" and _has_colon(G, child_id):
+                counts.lloc += 1
+        self._walk(G, stack, counts)
+        counts.complexity = 1 + block.decisions
+
+        self._functions[key] = counts
+        if len(self._functions) > self.max_functions:
+            self._functions.popitem(last=False)
+        return counts
+
+    def functions(self, G) -> Iterator[Tuple[int, str, Counts]]:
+        """
+        (node id, qualified name, counts) of every function of G in source order,
+        nested functions included, their counts are also in the enclosing one
+        """
+        for node_id, qualname in qualified_functions(G):
+            yield node_id, qualname, self.function(G, node_id)
+
+    def _walk(self, G, stack: List, counts: Counts):
+        """
+        stack items: (node id, halstead context, block taking the decision points or
+        None, simple statement the node is in or None)
+        """
+        colons = set()
+        nodes = G.ast_nodes
+        while stack:
+            node_id, context, block, stmt = stack.pop()
+            node = nodes[node_id]
+            cls = node.__class__
+
+            if cls in FUNCTION_TYPES:
+                function = self.function(G, node_id)
+                counts.add(function)
+                if block is not None and block.kind != "function":
+                    block.functions.append(function.complexity)
+                continue
+
+            if block is not None:
+                block.decisions += _decisions(node)
+
+            if isinstance(node, ast.stmt):
+                if cls is ast.Expr and node.value.__class__ is ast.Constant and isinstance(node.value.value, str):
+                    # a string on its own line, only docstrings are written on several lines
+                    counts.lloc += 1
+                    lines = node.value.value.split("\n")
+                    if len(lines) > 1 and _is_docstring(G, node_id, node):
+                        counts.multi += 2 + sum(1 for line in lines[1:-1] if line.strip())
+                    continue
+                stmt = node_id if _count_lines(node, counts) else None
+            elif cls is ast.ExceptHandler or cls is ast.match_case:
+                counts.lloc += 1
+                counts.sloc += 1
+            if stmt is not None and (
+                cls in COLON_TYPES or (cls is ast.Dict and any(k is not None for k in node.keys))
+            ):
+                colons.add(stmt)
+
+            if cls in HALSTEAD_OPERATORS:
+                _count_operators(node, context, counts)
+
+            child_block = block
+            if cls is ast.ClassDef:
+                if block is not None and block.kind == "module":
+                    child_block = Block("class")
+                    block.classes.append(child_block)
+                else:
+                    child_block = None
+            elif cls is ast.Assert:
+                child_block = None
+            elif cls is ast.JoinedStr:
+                # an f-string is a single token, its ":" do not count
+                stmt = None
+
+            children = G.children(node_id)
+            if cls is ast.ClassDef:
+                for field, child_id in zip(child_fields(node), children):
+                    if field == "decorator_list":
+                        counts.lloc += 1 + _has_colon(G, child_id)
+                        counts.sloc += 1
+                    else:
+                        stack.append((child_id, context, child_block if field == "body" else None, stmt))
+            else:
+                stack.extend((child_id, context, child_block, stmt) for child_id in children)
+        counts.lloc += len(colons)
+
+
+def _decisions(node: ast.AST) -> int:
+    """
+    decision points of node for radon's ComplexityVisitor
+    """
+    cls = node.__class__
+    if cls is ast.If or cls is ast.IfExp:
+        return 1
+    if cls is ast.BoolOp:
+        return len(node.values) - 1
+    if cls is ast.For or cls is ast.While or cls is ast.AsyncFor:
+        return 1 + bool(node.orelse)
+    if cls is ast.comprehension:
+        return 1 + len(node.ifs)
+    if cls is ast.Try:
+        return len(node.handlers) + bool(node.orelse)
+    if cls is ast.Assert:
+        return 1
+    if cls is ast.Match:
+        wildcard = any(getattr(case.pattern, "pattern", False) is None for case in node.cases)
+        return max(0, len(node.cases) - wildcard)
+    return 0
+
+
+def _count_lines(node: ast.stmt, counts: Counts) -> bool:
+    """
+    adds the lines of a statement without its body, returns True for a simple
+    statement, whose line gets one more lloc if it contains a ":"
+    """
+    if not hasattr(node, "body"):
+        counts.lloc += 1
+        counts.sloc += 1
+        return True
+    cls = node.__class__
+    lines = 1
+    orelse = getattr(node, "orelse", None)
+    if orelse and not (cls is ast.If and len(orelse) == 1 and orelse[0].__class__ is ast.If):
+        # else:, an else with a single if is written as elif
+        lines += 1
+    if getattr(node, "finalbody", None):
+        lines += 1
+    counts.lloc += lines
+    counts.sloc += lines
+    return False
+
+
+def _is_docstring(G, node_id: int, node: ast.Expr) -> bool:
+    parent = G.ast_nodes.get(G.get_parent(node_id))
+    return (
+        isinstance(parent, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef))
+        and parent.body[0] is node
+    )
+
+
+def _count_operators(node: ast.AST, context: Optional[str], counts: Counts):
+    cls = node.__class__
+    if cls is ast.Compare:
+        counts.operators += len(node.ops)
+        counts.operator_names.update(op.__class__.__name__ for op in node.ops)
+        operands = node.comparators + [node.left]
+    else:
+        counts.operators += 1
+        counts.operator_names.add(node.op.__class__.__name__)
+        if cls is ast.BinOp:
+            operands = (node.left, node.right)
+        elif cls is ast.UnaryOp:
+            operands = (node.operand,)
+        elif cls is ast.BoolOp:
+            operands = node.values
+        else:
+            operands = (node.target, node.value)
+    counts.operands += len(operands)
+    for operand in operands:
+        cls = operand.__class__
+        if cls is ast.Name:
+            counts.operand_values.add((context, operand.id))
+        elif cls is ast.Attribute:
+            counts.operand_values.add((context, operand.attr))
+        elif cls is ast.Constant:
+            counts.operand_values.add((context, operand.value))
+        else:
+            # radon tells other operands apart by identity
+            counts.unique_operands += 1
+
+
+def _has_colon(G, node_id: int) -> bool:
+    stack = [node_id]
+    while stack:
+        current_id = stack.pop()
+        node = G.ast_nodes[current_id]
+        if node.__class__ in COLON_TYPES or (
+            node.__class__ is ast.Dict and any(k is not None for k in node.keys)
+        ):
+            return True
+        stack.extend(G.children(current_id))
+    return False
+
+
+_graph_metrics = GraphMetrics()
+
+
+def calculate_graph_metrics(G) -> Dict[str, float]:
+    """
+    calculate_metrics of the code of G computed from its nodes, see GraphMetrics
+    """
+    return _graph_metrics(G)
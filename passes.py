@@ -0,0 +1,223 @@
+import ast
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from graph import CodeGraph
+from liveness import Liveness, Region
+from transforms import (
+    CallExpander,
+    DeadStoreEliminator,
+    _expand_function,
+    _extract_function,
+    _extract_functions,
+)
+
+
+# the graph itself: nodes, indexes and syntax tokens, brought up to date by a refresh
+TREE = "tree"
+
+
+class Pass(ABC):
+    """
+    a transform run by a PassManager
+
+    requires: analyses the pass reads, they are brought up to date before it runs
+    invalidates: analyses made stale by the pass, TREE (the default) for any change
+        of the ast, which also invalidates every analysis computed from the graph
+    """
+
+    requires: Tuple[str, ...] = (TREE,)
+    invalidates: Tuple[str, ...] = (TREE,)
+
+    @property
+    def name(self) -> str:
+        return self.__class__.__name__
+
+    @abstractmethod
+    def run(self, G: CodeGraph, manager: "PassManager") -> Optional[Iterable[int]]:
+        """
+        applies the pass to G without refreshing it, returns the ids of the nodes
+        whose fields were changed (see CodeGraph.refresh) or None if unknown
+        """
+        pass
+
+
+class ExpandFunctionPass(Pass):
+    def __init__(self, node_id: int):
+        self.node_id = node_id
+
+    def run(self, G, manager):
+        return _expand_function(G, self.node_id)
+
+
+class ExpandAllCallsPass(Pass):
+    requires = (TREE, "symbols")
+
+    def __init__(self, predicate: Callable[[int, int], bool] = None):
+        self.predicate = predicate
+
+    def run(self, G, manager):
+        return CallExpander(G).run(self.predicate).edit()
+
+
+class ExtractFunctionPass(Pass):
+    requires = (TREE, "liveness")
+
+    def __init__(self, parent_id: int, start: int, end: int):
+        self.parent_id = parent_id
+        self.start = start
+        self.end = end
+
+    def run(self, G, manager):
+        liveness = manager.analysis("liveness")
+        return _extract_function(G, self.parent_id, self.start, self.end, liveness)
+
+
+class ExtractFunctionsPass(Pass):
+    requires = (TREE, "liveness")
+
+    def __init__(self, regions: Iterable[Union[Region, Tuple[int, int, int]]], names: List[str] = None):
+        self.regions = regions
+        self.names = names
+
+    def run(self, G, manager):
+        return _extract_functions(G, self.regions, self.names, manager.analysis("liveness"))
+
+
+class RemoveRedundantVariablesPass(Pass):
+    requires = (TREE, "symbols")
+
+    def run(self, G, manager):
+        return DeadStoreEliminator(G).run().edit()
+
+
+class NodeTransformerPass(Pass):
+    """
+    runs an ast.NodeTransformer on the whole tree, it does not need the graph
+    to be up to date but the graph is fully refreshed after it
+    """
+
+    requires = ()
+
+    def __init__(self, transformer: ast.NodeTransformer):
+        self.transformer = transformer
+
+    @property
+    def name(self) -> str:
+        return self.transformer.__class__.__name__
+
+    def run(self, G, manager):
+        tree = self.transformer.visit(G.mutable_tree())
+        ast.fix_missing_locations(tree)
+        if tree is not G.ast_tree:
+            G._ast_tree = tree
+        return None
+
+
+class PassManager:
+    """
+    runs passes in order on a graph, sharing the analyses between them
+
+    The graph is refreshed only when a pass requires TREE (or an analysis computed
+    from it) after an earlier pass changed the ast, and once at the end, the
+    refreshes are incremental when the passes report what they changed.
+    timings holds (pass name, seconds) for every pass and every refresh.
+    """
+
+    def __init__(self, passes: Iterable[Union[Pass, ast.NodeTransformer]] = ()):
+        self.passes: List[Pass] = []
+        self.analyses: Dict[str, Tuple[Callable[[CodeGraph], object], Tuple[str, ...]]] = {}
+        self.timings: List[Tuple[str, float]] = []
+        self.register_analysis("symbols", lambda G: G.symbols)
+        self.register_analysis("liveness", Liveness)
+        for p in passes:
+            self.add(p)
+
+    def add(self, p: Union[Pass, ast.NodeTransformer]) -> "PassManager":
+        if isinstance(p, ast.NodeTransformer):
+            p = NodeTransformerPass(p)
+        self.passes.append(p)
+        return self
+
+    def register_analysis(
+        self,
+        name: str,
+        compute: Callable[[CodeGraph], object],
+        requires: Tuple[str, ...] = (TREE,),
+    ):
+        """
+        compute(G) is called when a pass first asks for the analysis, the result is
+        kept until a pass invalidates it or one of the analyses it requires
+        """
+        self.analyses[name] = (compute, requires)
+
+    def analysis(self, name: str):
+        """
+        result of the analysis for the graph being transformed, up to date
+        """
+        if name == TREE:
+            self._refresh()
+            return self.G
+        if name not in self._results:
+            compute, requires = self.analyses[name]
+            for required in requires:
+                self.analysis(required)
+            self._results[name] = self._timed(f"analysis {name}", compute, self.G)
+        return self._results[name]
+
+    def run(self, G: CodeGraph) -> CodeGraph:
+        self.G = G
+        self._results: Dict[str, object] = {}
+        self._stale = False
+        self._changed: Optional[set] = set()
+        self.timings = []
+
+        for p in self.passes:
+            for name in p.requires:
+                self.analysis(name)
+            changed = self._timed(p.name, p.run, G, self)
+            if TREE in p.invalidates:
+                self._invalidate(TREE)
+                if changed is None or self._changed is None:
+                    self._changed = None
+                else:
+                    self._changed.update(changed)
+            for name in p.invalidates:
+                self._invalidate(name)
+
+        self._refresh()
+        self.G = None
+        return G
+
+    def summary(self) -> Dict[str, float]:
+        """
+        total seconds per pass name
+        """
+        totals: Dict[str, float] = {}
+        for name, seconds in self.timings:
+            totals[name] = totals.get(name, 0.0) + seconds
+        return totals
+
+    def _invalidate(self, name: str):
+        if name == TREE:
+            self._stale = True
+        self._results.pop(name, None)
+        for other, (_, requires) in self.analyses.items():
+            if name in requires and other in self._results:
+                self._invalidate(other)
+
+    def _refresh(self):
+        if not self._stale:
+            return
+        changed, self._changed = self._changed, set()
+        self._stale = False
+        if changed is not None and not changed:
+            return
+        self._timed("refresh", self.G.refresh, changed=changed)
+
+    def _timed(self, name: str, fun: Callable, *args, **kwargs):
+        start = time.perf_counter()
+        result = fun(*args, **kwargs)
+        self.timings.append((name, time.perf_counter() - start))
+        return result
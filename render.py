@@ -0,0 +1,542 @@
+"""
+renders the drawio documents written by style.OurGraphToXML to SVG, or to PNG with
+a small rasteriser, in this process and without the drawio application
+
+    python render.py images/*.drawio --format png --workers 4
+"""
+import argparse
+import base64
+import html
+import math
+import os
+import re
+import struct
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from io import StringIO
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from urllib.parse import unquote
+import xml.etree.ElementTree as ET
+
+from graph import CodeGraph
+from style import BLACK, DetailParams, GeneralStyleParams, OurGraphToXML, WHITE
+
+
+# 5x7 bitmap font of the printable ascii characters (32 to 126): 7 rows of 5 bits
+# per character, as 2 hex digits per row, the leftmost pixel is the highest bit
+FONT_5X7 = (
+    "00000000000000040404040400040a0a00000000000a0a1f0a1f0a0a040f140e051e0418190204081303"
+    "0c12140815120d0404000000000002040808080402080402020204080004150e1504000004041f040400"
+    "000000000c04080000001f00000000000000000c0c000102040810000e11131519110e040c040404040e"
+    "0e11010204081f1f02040201110e02060a121f02021f101e0101110e0608101e11110e1f010204080808"
+    "0e11110e11110e0e11110f01020c000c0c000c0c00000c0c000c04080204081008040200001f001f0000"
+    "080402010204080e1101020400040e11010d15150e0e11111f1111111e11111e11111e0e11101010110e"
+    "1c12111111121c1f10101e10101f1f10101e1010100e11101711110f1111111f1111110e04040404040e"
+    "0702020202120c111214181412111010101010101f111b1515111111111119151311110e11111111110e"
+    "1e11111e1010100e11111115120d1e11111e1412110f10100e01011e1f0404040404041111111111110e"
+    "11111111110a041111111515150a11110a040a111111110a040404041f01020408101f0e08080808080e"
+    "001008040201000e02020202020e040a11000000000000000000001f0804000000000000000e010f110f"
+    "1010161911111e00000e1010110e01010d1311110f00000e111f100e0609081c080808000f11110f010e"
+    "1010161911111104000c0404040e0200060202120c101012141814120c04040404040e00001a15151111"
+    "0000161911111100000e1111110e00001e111e101000000d130f01010000161910101000000e100e011e"
+    "08081c080809060000111111130d00001111110a040000111115150a0000110a040a11000011110f010e"
+    "00001f0204081f02040408040402040404040404040804040204040800000815020000"
+
+)
+GLYPH_WIDTH, GLYPH_HEIGHT = 5, 7
+
+# label metrics of drawio's default font (Helvetica 12px)
+FONT_SIZE = 12
+CHAR_WIDTH = 7
+LINE_HEIGHT = 14
+MARGIN = 20
+
+Color = Tuple[int, int, int]
+Point = Tuple[float, float]
+
+
+class Cell:
+    """
+    mxCell of a drawio page: a vertex with its geometry or an edge between two vertices
+    """
+
+    __slots__ = ("id", "label", "style", "vertex", "x", "y", "width", "height", "source", "target")
+
+    def __init__(self, element: ET.Element):
+        self.id = element.get("id")
+        self.label = element.get("value", "")
+        self.style = parse_style(element.get("style", ""))
+        self.vertex = element.get("vertex") == "1"
+        self.source = element.get("source")
+        self.target = element.get("target")
+        geometry = element.find("mxGeometry")
+        get = (lambda name: float(geometry.get(name, 0))) if geometry is not None else (lambda name: 0.0)
+        self.x, self.y = get("x"), get("y")
+        self.width, self.height = get("width"), get("height")
+
+    @property
+    def center(self) -> Point:
+        return self.x + self.width / 2, self.y + self.height / 2
+
+
+def parse_style(style: str) -> Dict[str, str]:
+    items = (item.split("=", 1) for item in style.split(";") if "=" in item)
+    return {key: value for key, value in items}
+
+
+def load_cells(drawio: str, page: Union[int, str] = 0) -> Tuple[Dict[str, Cell], List[Cell]]:
+    """
+    vertices by id and edges of a page (its index or name) of a drawio document,
+    drawio is a path or the document itself, compressed pages are supported
+    """
+    if drawio.lstrip().startswith("<"):
+        root = ET.fromstring(drawio)
+    else:
+        root = ET.parse(drawio).getroot()
+    diagrams = root.findall("diagram")
+    if isinstance(page, int):
+        diagram = diagrams[page]
+    else:
+        diagram = next((d for d in diagrams if d.get("name") == page), None)
+        if diagram is None:
+            raise ValueError(f"No page named {page}")
+    model = diagram.find("mxGraphModel")
+    if model is None:
+        # compressed page: url encoded, deflated and base64 encoded
+        text = zlib.decompress(base64.b64decode(diagram.text), -15).decode("utf-8")
+        model = ET.fromstring(unquote(text))
+
+    vertices: Dict[str, Cell] = {}
+    edges: List[Cell] = []
+    for element in model.iter("mxCell"):
+        cell = Cell(element)
+        if cell.vertex:
+            vertices[cell.id] = cell
+        elif element.get("edge") == "1":
+            edges.append(cell)
+    return vertices, edges
+
+
+def parse_color(color: Optional[str], default: Color = (0, 0, 0)) -> Optional[Color]:
+    if color is None:
+        return default
+    if color == "none":
+        return None
+    color = color.lstrip("#")
+    if len(color) == 3:
+        color = "".join(c * 2 for c in color)
+    try:
+        return int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16)
+    except ValueError:
+        return default
+
+
+def label_lines(label: str, width: float, char_width: float) -> List[Tuple[str, bool, bool]]:
+    """
+    (text, bold, italic) of the lines of an html label wrapped to width
+    """
+    lines = []
+    max_chars = max(1, int(width // char_width))
+    for part in re.split(r"<br\s*/?>", label):
+        bold = "<b>" in part
+        italic = "<i>" in part
+        text = html.unescape(re.sub(r"<[^>]*>", "", part))
+        words = text.split(" ")
+        line = ""
+        for word in words:
+            while len(word) > max_chars:
+                if line:
+                    lines.append((line, bold, italic))
+                    line = ""
+                lines.append((word[:max_chars], bold, italic))
+                word = word[max_chars:]
+            if not line:
+                line = word
+            elif len(line) + 1 + len(word) <= max_chars:
+                line += " " + word
+            else:
+                lines.append((line, bold, italic))
+                line = word
+        lines.append((line, bold, italic))
+    return lines
+
+
+def edge_points(edge: Cell, vertices: Dict[str, Cell]) -> Optional[List[Point]]:
+    """
+    polyline of an edge: straight between the borders of the vertices, or
+    orthogonal to the entry point of the target for segmentEdgeStyle
+    """
+    source, target = vertices.get(edge.source), vertices.get(edge.target)
+    if source is None or target is None:
+        return None
+    if edge.style.get("edgeStyle") == "segmentEdgeStyle":
+        ex = target.x + float(edge.style.get("entryX", 0.5)) * target.width
+        ey = target.y + float(edge.style.get("entryY", 0)) * target.height
+        sx, sy = source.center
+        side = 1 if ex >= sx else -1
+        start = (sx + side * source.width / 2, sy)
+        if sy <= ey:
+            return [start, (ex, sy), (ex, ey)]
+        # the entry is on top of the target: go round above it
+        return [start, (start[0] + side * 15, sy), (start[0] + side * 15, ey - 15), (ex, ey - 15), (ex, ey)]
+    start, end = source.center, target.center
+    return [_border(source, end), _border(target, start)]
+
+
+def _border(cell: Cell, towards: Point) -> Point:
+    """
+    point where the segment from the center of cell to towards leaves the cell
+    """
+    cx, cy = cell.center
+    dx, dy = towards[0] - cx, towards[1] - cy
+    if dx == 0 and dy == 0:
+        return cx, cy
+    scale = min(
+        cell.width / 2 / abs(dx) if dx else math.inf,
+        cell.height / 2 / abs(dy) if dy else math.inf,
+    )
+    scale = min(scale, 1.0)
+    return cx + dx * scale, cy + dy * scale
+
+
+def _bounds(vertices: Dict[str, Cell]) -> Tuple[float, float, float, float]:
+    if not vertices:
+        return 0.0, 0.0, 1.0, 1.0
+    x0 = min(c.x for c in vertices.values())
+    y0 = min(c.y for c in vertices.values())
+    x1 = max(c.x + c.width for c in vertices.values())
+    y1 = max(c.y + c.height for c in vertices.values())
+    return x0, y0, x1, y1
+
+
+def to_svg(vertices: Dict[str, Cell], edges: List[Cell]) -> str:
+    """
+    SVG of the cells, labels are wrapped with an estimate of the text width
+    """
+    x0, y0, x1, y1 = _bounds(vertices)
+    width, height = x1 - x0 + 2 * MARGIN, y1 - y0 + 2 * MARGIN
+    out = StringIO()
+    out.write(
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:g}" height="{height:g}" '
+        f'viewBox="{x0 - MARGIN:g} {y0 - MARGIN:g} {width:g} {height:g}" '
+        f'font-family="Helvetica, Arial, sans-serif" font-size="{FONT_SIZE}">\n'
+        f'<rect x="{x0 - MARGIN:g}" y="{y0 - MARGIN:g}" width="{width:g}" height="{height:g}" fill="{WHITE}"/>\n'
+    )
+    markers = {}
+    for edge in edges:
+        points = edge_points(edge, vertices)
+        if points is None:
+            continue
+        stroke = edge.style.get("strokeColor", BLACK)
+        attrs = f'fill="none" stroke="{stroke}"'
+        if edge.style.get("dashed") == "1":
+            attrs += ' stroke-dasharray="3 3"'
+        if "opacity" in edge.style:
+            attrs += f' stroke-opacity="{float(edge.style["opacity"]) / 100:g}"'
+        if edge.style.get("endArrow", "classic") != "none":
+            marker = markers.setdefault(stroke, f"arrow{len(markers)}")
+            attrs += f' marker-end="url(#{marker})"'
+        path = " ".join(f"{x:.1f},{y:.1f}" for x, y in points)
+        out.write(f'<polyline points="{path}" {attrs}/>\n')
+
+    for cell in vertices.values():
+        fill = cell.style.get("fillColor", WHITE)
+        stroke = cell.style.get("strokeColor", BLACK)
+        attrs = f'fill="{fill}" stroke="{stroke}"'
+        if cell.style.get("rounded") == "1":
+            r = min(cell.width, cell.height) * 0.15
+            attrs += f' rx="{r:g}" ry="{r:g}"'
+        if cell.style.get("dashed") == "1":
+            attrs += ' stroke-dasharray="3 3"'
+        out.write(
+            f'<rect x="{cell.x:g}" y="{cell.y:g}" width="{cell.width:g}" height="{cell.height:g}" {attrs}/>\n'
+        )
+        lines = label_lines(cell.label, cell.width - 4, CHAR_WIDTH)
+        cx, cy = cell.center
+        y = cy - (len(lines) - 1) * LINE_HEIGHT / 2
+        out.write(f'<text x="{cx:g}" text-anchor="middle" dominant-baseline="central">')
+        for i, (text, bold, italic) in enumerate(lines):
+            style = (' font-weight="bold"' if bold else "") + (' font-style="italic"' if italic else "")
+            out.write(f'<tspan x="{cx:g}" y="{y + i * LINE_HEIGHT:g}"{style}>{html.escape(text)}</tspan>')
+        out.write("</text>\n")
+
+    if markers:
+        out.write("<defs>\n")
+        for stroke, marker in markers.items():
+            out.write(
+                f'<marker id="{marker}" viewBox="0 0 10 10" refX="10" refY="5" markerWidth="8" '
+                f'markerHeight="8" markerUnits="userSpaceOnUse" orient="auto">'
+                f'<path d="M0,0 L10,5 L0,10 z" fill="{stroke}"/></marker>\n'
+            )
+        out.write("</defs>\n")
+    out.write("</svg>\n")
+    return out.getvalue()
+
+
+class Raster:
+    """
+    RGB image drawn in pure python: filled and stroked rectangles, lines with
+    opacity and dashes, triangles and text in the 5x7 bitmap font
+    """
+
+    def __init__(self, width: int, height: int, background: Color = (255, 255, 255)):
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(bytes(background) * (width * height))
+
+    def fill_rect(self, x0: int, y0: int, x1: int, y1: int, color: Color, radius: int = 0):
+        """
+        fills [x0, x1) x [y0, y1), with corners rounded by radius
+        """
+        x0, x1 = max(0, x0), min(self.width, x1)
+        if x0 >= x1:
+            return
+        rgb = bytes(color)
+        for y in range(max(0, y0), min(self.height, y1)):
+            inset = _corner_inset(y - y0, y1 - 1 - y, radius)
+            left, right = x0 + inset, x1 - inset
+            if left < right:
+                start = (y * self.width + left) * 3
+                self.pixels[start : start + (right - left) * 3] = rgb * (right - left)
+
+    def stroke_rect(self, x0: int, y0: int, x1: int, y1: int, color: Color, radius: int = 0,
+                    dashed: bool = False):
+        previous = None
+        for y in range(y0, y1):
+            inset = _corner_inset(y - y0, y1 - 1 - y, radius)
+            if y == y0 or y == y1 - 1:
+                span = range(x0 + inset, x1 - inset)
+            else:
+                # joins the inset of the row above along the corner arcs
+                low, high = sorted((inset, previous))
+                span = list(range(x0 + low, x0 + max(low + 1, high))) + \
+                    list(range(x1 - max(low + 1, high), x1 - low))
+            for x in span:
+                if not dashed or ((x + y) // 3) % 2 == 0:
+                    self.set(x, y, color)
+            previous = inset
+
+    def set(self, x: int, y: int, color: Color, alpha: float = 1.0):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            i = (y * self.width + x) * 3
+            if alpha >= 1.0:
+                self.pixels[i : i + 3] = bytes(color)
+            else:
+                p = self.pixels
+                p[i] = int(p[i] + (color[0] - p[i]) * alpha)
+                p[i + 1] = int(p[i + 1] + (color[1] - p[i + 1]) * alpha)
+                p[i + 2] = int(p[i + 2] + (color[2] - p[i + 2]) * alpha)
+
+    def line(self, a: Point, b: Point, color: Color, alpha: float = 1.0, dashed: bool = False):
+        (x0, y0), (x1, y1) = a, b
+        steps = int(max(abs(x1 - x0), abs(y1 - y0))) or 1
+        dx, dy = (x1 - x0) / steps, (y1 - y0) / steps
+        for i in range(steps + 1):
+            if not dashed or (i // 3) % 2 == 0:
+                self.set(int(round(x0 + dx * i)), int(round(y0 + dy * i)), color, alpha)
+
+    def triangle(self, a: Point, b: Point, c: Point, color: Color, alpha: float = 1.0):
+        ys = [a[1], b[1], c[1]]
+        for y in range(int(math.floor(min(ys))), int(math.ceil(max(ys))) + 1):
+            xs = []
+            for (px, py), (qx, qy) in ((a, b), (b, c), (c, a)):
+                if (py <= y < qy) or (qy <= y < py):
+                    xs.append(px + (y - py) * (qx - px) / (qy - py))
+            if len(xs) >= 2:
+                for x in range(int(round(min(xs))), int(round(max(xs))) + 1):
+                    self.set(x, y, color, alpha)
+
+    def text(self, x: int, y: int, text: str, color: Color, scale: int = 1, bold: bool = False):
+        """
+        draws text with its top left corner at (x, y)
+        """
+        for ch in text:
+            code = ord(ch)
+            if not 32 <= code < 127:
+                code = ord("?")
+            offset = (code - 32) * 2 * GLYPH_HEIGHT
+            for row in range(GLYPH_HEIGHT):
+                bits = int(FONT_5X7[offset + 2 * row : offset + 2 * row + 2], 16)
+                if not bits:
+                    continue
+                for col in range(GLYPH_WIDTH):
+                    if bits & (1 << (GLYPH_WIDTH - 1 - col)):
+                        px, py = x + col * scale, y + row * scale
+                        self.fill_rect(px, py, px + scale + bold, py + scale, color)
+            x += (GLYPH_WIDTH + 1) * scale
+
+    def to_png(self) -> bytes:
+        raw = bytearray()
+        stride = self.width * 3
+        for y in range(self.height):
+            raw.append(0)
+            raw += self.pixels[y * stride : (y + 1) * stride]
+
+        def chunk(kind: bytes, data: bytes) -> bytes:
+            body = kind + data
+            return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body) & 0xFFFFFFFF)
+
+        header = struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0)
+        return (
+            b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(bytes(raw), 6))
+            + chunk(b"IEND", b"")
+        )
+
+
+def _corner_inset(top: int, bottom: int, radius: int) -> int:
+    """
+    horizontal inset of a row of a rectangle with rounded corners, top and bottom
+    are the numbers of rows above and below it
+    """
+    d = max(0, min(top, bottom))
+    if d >= radius:
+        return 0
+    return int(round(radius - math.sqrt(radius * radius - (radius - d - 0.5) ** 2)))
+
+
+def to_png(vertices: Dict[str, Cell], edges: List[Cell], scale: float = 1.0, max_size: int = 8192) -> bytes:
+    """
+    PNG of the cells, scale is in pixels per drawio unit, it is reduced so that
+    no side exceeds max_size pixels, the labels are left out below 0.5 pixel per unit
+    """
+    x0, y0, x1, y1 = _bounds(vertices)
+    scale = min(scale, max_size / (x1 - x0 + 2 * MARGIN), max_size / (y1 - y0 + 2 * MARGIN))
+    width = int(math.ceil((x1 - x0 + 2 * MARGIN) * scale))
+    height = int(math.ceil((y1 - y0 + 2 * MARGIN) * scale))
+
+    def at(p: Point) -> Point:
+        return (p[0] - x0 + MARGIN) * scale, (p[1] - y0 + MARGIN) * scale
+
+    image = Raster(width, height)
+    for edge in edges:
+        points = edge_points(edge, vertices)
+        if points is None:
+            continue
+        color = parse_color(edge.style.get("strokeColor"))
+        alpha = float(edge.style.get("opacity", 100)) / 100
+        dashed = edge.style.get("dashed") == "1"
+        points = [at(p) for p in points]
+        for a, b in zip(points, points[1:]):
+            image.line(a, b, color, alpha, dashed)
+        if edge.style.get("endArrow", "classic") != "none":
+            (ax, ay), (bx, by) = points[-2], points[-1]
+            length = math.hypot(bx - ax, by - ay) or 1.0
+            ux, uy = (bx - ax) / length, (by - ay) / length
+            size = 8 * scale
+            back = (bx - ux * size, by - uy * size)
+            image.triangle(
+                (bx, by),
+                (back[0] - uy * size / 2, back[1] + ux * size / 2),
+                (back[0] + uy * size / 2, back[1] - ux * size / 2),
+                color,
+                alpha,
+            )
+
+    glyph_scale = max(1, int(round(scale)))
+    for cell in vertices.values():
+        (left, top), (right, bottom) = at((cell.x, cell.y)), at((cell.x + cell.width, cell.y + cell.height))
+        left, top, right, bottom = int(left), int(top), int(right), int(bottom)
+        radius = int(min(right - left, bottom - top) * 0.15) if cell.style.get("rounded") == "1" else 0
+        fill = parse_color(cell.style.get("fillColor"), (255, 255, 255))
+        stroke = parse_color(cell.style.get("strokeColor"))
+        if fill is not None:
+            image.fill_rect(left, top, right, bottom, fill, radius)
+        if stroke is not None:
+            image.stroke_rect(left, top, right, bottom, stroke, radius, cell.style.get("dashed") == "1")
+        if scale < 0.5:
+            continue
+        advance = (GLYPH_WIDTH + 1) * glyph_scale
+        line_height = (GLYPH_HEIGHT + 2) * glyph_scale
+        lines = label_lines(cell.label, right - left - 4, advance)
+        y = (top + bottom) // 2 - len(lines) * line_height // 2 + glyph_scale
+        for text, bold, _ in lines:
+            x = (left + right) // 2 - len(text) * advance // 2
+            image.text(x, y, text, (0, 0, 0), glyph_scale, bold)
+            y += line_height
+    return image.to_png()
+
+
+def render(
+    source: Union[str, CodeGraph],
+    output: str,
+    page: Union[int, str] = 0,
+    scale: float = 1.0,
+    params: GeneralStyleParams = GeneralStyleParams(),
+    detail: DetailParams = None,
+) -> str:
+    """
+    renders a page of source, a drawio file or document or a graph exported with
+    OurGraphToXML(params) (and detail), to output as SVG or PNG after its suffix,
+    returns output
+    """
+    if isinstance(source, CodeGraph):
+        document = StringIO()
+        OurGraphToXML(params).write(source, document, detail=detail)
+        source = document.getvalue()
+    vertices, edges = load_cells(source, page)
+    if output.lower().endswith(".png"):
+        with open(output, "wb") as file:
+            file.write(to_png(vertices, edges, scale))
+    else:
+        with open(output, "w", encoding="utf-8") as file:
+            file.write(to_svg(vertices, edges))
+    return output
+
+
+def _render_job(job: Tuple, kwargs: Dict) -> Tuple[str, Optional[str]]:
+    source, output = job
+    try:
+        render(source, output, **kwargs)
+        return output, None
+    except (OSError, ValueError, IndexError, ET.ParseError, zlib.error) as e:
+        return output, f"{e.__class__.__name__}: {e}"
+
+
+def render_many(
+    jobs: Iterable[Tuple[Union[str, CodeGraph], str]], workers: int = None, **kwargs
+) -> List[Tuple[str, Optional[str]]]:
+    """
+    renders the (source, output) jobs (see render) in a process pool, returns
+    (output, error message or None) in the order the renders end
+
+    workers: number of processes, os.cpu_count() by default and 0 to render in this process
+    """
+    jobs = iter(jobs)
+    if workers == 0:
+        return [_render_job(job, kwargs) for job in jobs]
+
+    workers = workers or os.cpu_count()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_render_job, job, kwargs) for job in islice(jobs, 2 * workers)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results.append(future.result())
+                pending.update(executor.submit(_render_job, job, kwargs) for job in islice(jobs, 1))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+", help="drawio files")
+    parser.add_argument("--format", choices=("svg", "png"), default="svg")
+    parser.add_argument("--page", default="0", help="index or name of the page")
+    parser.add_argument("--scale", type=float, default=1.0, help="pixels per unit for png")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    page = int(args.page) if args.page.isdigit() else args.page
+    jobs = [(f, os.path.splitext(f)[0] + "." + args.format) for f in args.files]
+    for output, error in render_many(jobs, args.workers, page=page, scale=args.scale):
+        if error is None:
+            print(output)
+        else:
+            print(f"Warning: could not render {output}: {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+import ast
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+
+# flags of a name record
+DEF = 1
+USE = 2
+GLOBAL = 4
+NONLOCAL = 8
+
+SCOPE_KINDS = {
+    ast.FunctionDef: "function",
+    ast.AsyncFunctionDef: "function",
+    ast.Lambda: "function",
+    ast.ClassDef: "class",
+    ast.ListComp: "comprehension",
+    ast.SetComp: "comprehension",
+    ast.DictComp: "comprehension",
+    ast.GeneratorExp: "comprehension",
+}
+
+# fields of a scope node evaluated inside its own scope, the others (decorators,
+# bases, annotations of the return...) are evaluated in the enclosing scope
+INNER_FIELDS = {
+    ast.FunctionDef: ("args", "body"),
+    ast.AsyncFunctionDef: ("args", "body"),
+    ast.Lambda: ("args", "body"),
+    ast.ClassDef: ("body",),
+    ast.ListComp: ("elt", "generators"),
+    ast.SetComp: ("elt", "generators"),
+    ast.DictComp: ("key", "value", "generators"),
+    ast.GeneratorExp: ("elt", "generators"),
+}
+
+# fields inside a function or comprehension scope that are evaluated in the enclosing
+# scope: default values, argument annotations and the iterable of the first generator
+OUTER_FIELDS = {
+    ast.arguments: ("defaults", "kw_defaults"),
+    ast.arg: ("annotation",),
+    ast.comprehension: ("iter",),
+}
+
+NAME_TYPES = (
+    ast.Name,
+    ast.arg,
+    ast.FunctionDef,
+    ast.AsyncFunctionDef,
+    ast.ClassDef,
+    ast.alias,
+    ast.ExceptHandler,
+    ast.MatchAs,
+    ast.MatchStar,
+    ast.MatchMapping,
+    ast.Global,
+    ast.Nonlocal,
+)
+
+
+class Scope:
+    """
+    scope opened by the node node_id: "module", "function" (also lambdas),
+    "class" or "comprehension"
+    """
+
+    __slots__ = ("node_id", "kind", "parent")
+
+    def __init__(self, node_id: int, kind: str, parent: "Scope" = None):
+        self.node_id = node_id
+        self.kind = kind
+        self.parent = parent
+
+    def __repr__(self):
+        return f"Scope({self.kind}, {self.node_id})"
+
+
+def enter(
+    node: ast.AST,
+    node_id: int,
+    parent: Optional[ast.AST],
+    scope: Scope,
+    records: Dict[int, Tuple],
+    scopes: Dict[int, Scope],
+) -> Optional[Scope]:
+    """
+    records the name occurring at node (if any) evaluated in scope,
+    returns the scope node opens or None
+    """
+    cls = node.__class__
+    if cls in NAME_TYPES:
+        record = _name_record(node, parent)
+        if record is not None:
+            name, flags = record
+            if flags == DEF and parent.__class__ is ast.NamedExpr:
+                # assignment expressions bind outside of comprehensions
+                while scope.kind == "comprehension":
+                    scope = scope.parent
+            records[node_id] = (scope.node_id, name, flags)
+    kind = SCOPE_KINDS.get(cls)
+    if kind is None:
+        return None
+    inner = scopes[node_id] = Scope(node_id, kind, scope)
+    return inner
+
+
+def field_scope(
+    node: ast.AST,
+    field: str,
+    scope: Scope,
+    inner: Optional[Scope],
+    parent: Optional[ast.AST],
+) -> Scope:
+    """
+    scope of the children of node stored in field, scope is the one of node itself
+    and inner the one it opens
+    """
+    cls = node.__class__
+    if field in INNER_FIELDS.get(cls, ()):
+        return inner
+    if field in OUTER_FIELDS.get(cls, ()):
+        if cls is not ast.comprehension or parent.generators[0] is node:
+            return scope.parent
+    return scope
+
+
+SCOPED_TYPES = frozenset(INNER_FIELDS) | frozenset(OUTER_FIELDS)
+
+
+def child_fields(node: ast.AST) -> Iterator[str]:
+    """
+    field of every child of node, in the order of CodeGraph.children
+    """
+    for field in node._fields:
+        value = getattr(node, field, None)
+        if value.__class__ is list:
+            for item in value:
+                if isinstance(item, ast.AST):
+                    yield field
+        elif isinstance(value, ast.AST):
+            yield field
+
+
+def _name_record(node: ast.AST, parent: Optional[ast.AST]):
+    cls = node.__class__
+    if cls is ast.Name:
+        if node.ctx.__class__ is ast.Load:
+            return node.id, USE
+        if parent.__class__ is ast.AugAssign:
+            return node.id, DEF | USE
+        return node.id, DEF
+    if cls is ast.arg:
+        return node.arg, DEF
+    if cls is ast.alias:
+        name = node.asname or node.name.split(".")[0]
+        return None if name == "*" else (name, DEF)
+    if cls is ast.Global:
+        return tuple(node.names), GLOBAL
+    if cls is ast.Nonlocal:
+        return tuple(node.names), NONLOCAL
+    name = node.rest if cls is ast.MatchMapping else node.name
+    return None if name is None else (name, DEF)
+
+
+class Bindings:
+    """
+    the names every scope binds or declares global or nonlocal, counted from the name
+    records so that it can follow records being added and removed
+    """
+
+    def __init__(self, root_id: int):
+        self.root_id = root_id
+        self.bound: Dict[Tuple[int, str], int] = {}
+        self.declared: Dict[Tuple[int, str, int], int] = {}
+        self._owners: Dict[Tuple[int, str], int] = {}
+
+    def copy(self) -> "Bindings":
+        bindings = Bindings(self.root_id)
+        bindings.bound = dict(self.bound)
+        bindings.declared = dict(self.declared)
+        return bindings
+
+    def add(self, record: Tuple):
+        self._count(record, 1)
+
+    def remove(self, record: Tuple):
+        self._count(record, -1)
+
+    def _count(self, record: Tuple, step: int):
+        scope_id, name, flags = record
+        if flags & DEF:
+            keys, counts = [(scope_id, name)], self.bound
+        elif flags & (GLOBAL | NONLOCAL):
+            keys, counts = [(scope_id, n, flags) for n in name], self.declared
+        else:
+            return
+        for key in keys:
+            count = counts.get(key, 0) + step
+            if count:
+                counts[key] = count
+            else:
+                del counts[key]
+        self._owners.clear()
+
+    def flags(self, scope_id: int, name: str) -> Optional[int]:
+        """
+        GLOBAL or NONLOCAL if name is declared so in the scope, else None
+        """
+        declared = self.declared
+        if (scope_id, name, GLOBAL) in declared:
+            return GLOBAL
+        if (scope_id, name, NONLOCAL) in declared:
+            return NONLOCAL
+        return None
+
+    def state(self, scope_id: int, name: str) -> Tuple[bool, Optional[int]]:
+        """
+        whether the scope binds name and how it declares it, the owners of name in
+        the scope and the ones nested in it only change with it
+        """
+        return (scope_id, name) in self.bound, self.flags(scope_id, name)
+
+    def owner(self, scope: Scope, name: str) -> int:
+        """
+        id of the scope owning the binding of name as evaluated in scope
+        """
+        key = (scope.node_id, name)
+        owner_id = self._owners.get(key)
+        if owner_id is None:
+            flags = self.flags(*key)
+            if flags == GLOBAL or scope.kind == "module":
+                owner_id = self.root_id
+            elif flags is None and key in self.bound:
+                owner_id = scope.node_id
+            else:
+                owner_id = self._free(scope.parent, name)
+            self._owners[key] = owner_id
+        return owner_id
+
+    def _free(self, scope: Scope, name: str) -> int:
+        # class bodies are not visible from the scopes nested in them
+        while scope is not None and scope.kind != "module":
+            if scope.kind != "class":
+                flags = self.flags(scope.node_id, name)
+                if flags == GLOBAL:
+                    return self.root_id
+                if flags is None and (scope.node_id, name) in self.bound:
+                    return scope.node_id
+            scope = scope.parent
+        return self.root_id
+
+
+def resolve(
+    scopes: Dict[int, Scope],
+    records: Dict[int, Tuple],
+    make_token: Callable,
+    occurence: Callable,
+    bindings: Bindings = None,
+) -> Dict[int, Dict]:
+    """
+    groups the name records into bindings following the python scoping rules
+
+    scopes: every scope by node id, the module first
+    records: node id -> (scope id, name, flags) in preorder
+    make_token(name, scope_id): new binding of name owned by the scope scope_id
+    occurence(node_id): what is appended to the occurences of a binding
+    bindings: if given, empty, it is filled with the records to update them later
+
+    returns scope id -> name -> binding, with the scopes and the bindings in
+    order of first occurence
+    """
+    if bindings is None:
+        bindings = Bindings(next(iter(scopes)))
+    for record in records.values():
+        bindings.add(record)
+
+    lookup = {scope_id: {} for scope_id in scopes}
+    for node_id, (scope_id, name, flags) in records.items():
+        if flags & (GLOBAL | NONLOCAL):
+            continue
+        owner_id = bindings.owner(scopes[scope_id], name)
+        tokens = lookup[owner_id]
+        token = tokens.get(name)
+        if token is None:
+            token = tokens[name] = make_token(name, owner_id)
+        token.occurences.append(occurence(node_id))
+        if flags & DEF:
+            token.defs.append(node_id)
+        if flags & USE:
+            token.uses.append(node_id)
+    return lookup
+
+
+class SymbolTable:
+    """
+    def-use index over the bindings (syntax tokens) of a graph, every query is O(1)
+    after the first one
+
+    the index is flow insensitive: every use of a binding is linked to all its
+    definitions, whatever the control flow between them
+    """
+
+    def __init__(self, lookup: Dict[int, Dict]):
+        self.lookup = lookup
+        self._bindings = {}
+        self._names: Dict[str, List] = {}
+        for tokens in lookup.values():
+            for name, token in tokens.items():
+                self._names.setdefault(name, []).append(token)
+                for node_id in token.defs:
+                    self._bindings[node_id] = token
+                for node_id in token.uses:
+                    self._bindings[node_id] = token
+
+    def binding(self, node_id: int):
+        """
+        binding of the name occurring at node_id, None if no name occurs there
+        """
+        return self._bindings.get(node_id)
+
+    def uses(self, node_id: int) -> List[int]:
+        """
+        nodes reading the binding of the name occurring at node_id
+        """
+        token = self._bindings.get(node_id)
+        return token.uses if token is not None else []
+
+    def defs(self, node_id: int) -> List[int]:
+        """
+        nodes binding the name occurring at node_id
+        """
+        token = self._bindings.get(node_id)
+        return token.defs if token is not None else []
+
+    def bindings(self, scope_id: int) -> Dict:
+        """
+        name -> binding of the names local to the scope opened by scope_id
+        """
+        return self.lookup.get(scope_id, {})
+
+    def named(self, name: str) -> List:
+        """
+        bindings of name in every scope
+        """
+        return self._names.get(name, [])
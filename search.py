@@ -0,0 +1,342 @@
+import ast
+import heapq
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from graph import CodeGraph
+from metrics import calculate_graph_metrics
+from passes import (
+    ExpandAllCallsPass,
+    ExpandFunctionPass,
+    ExtractFunctionsPass,
+    PassManager,
+    RemoveRedundantVariablesPass,
+)
+from transforms import CallExpander, DeadStoreEliminator, score_regions
+
+
+def maintainability(metrics: Dict[str, float]) -> float:
+    """
+    default score of a state, higher is better
+    """
+    return metrics["Maintainability Index"]
+
+
+def simplicity(metrics: Dict[str, float]) -> float:
+    """
+    maintainability penalised by the average cyclomatic complexity
+    """
+    return metrics["Maintainability Index"] - metrics["Average Complexity"]
+
+
+class Move:
+    """
+    transform applied to a state: kind is "expand", "expand_all", "extract" or
+    "remove", args the node ids and indices of the transform in the graph of the state
+    """
+
+    __slots__ = ("kind", "args", "label")
+
+    def __init__(self, kind: str, args: Tuple = (), label: str = None):
+        self.kind = kind
+        self.args = args
+        self.label = label or kind
+
+    def apply(self, G: CodeGraph):
+        if self.kind == "expand":
+            p = ExpandFunctionPass(*self.args)
+        elif self.kind == "expand_all":
+            p = ExpandAllCallsPass()
+        elif self.kind == "extract":
+            p = ExtractFunctionsPass([self.args])
+        elif self.kind == "remove":
+            p = RemoveRedundantVariablesPass()
+        else:
+            raise ValueError(f"Unknown move {self.kind}")
+        PassManager([p]).run(G)
+
+    def __repr__(self):
+        return f"Move({self.label})"
+
+
+class State:
+    """
+    code reached by a sequence of moves, key is the canonical hash of its ast
+    (CodeGraph.subtree_hash of the root, it ignores formatting and locations)
+    """
+
+    __slots__ = ("source", "key", "metrics", "score", "moves", "parent", "move", "depth")
+
+    def __init__(
+        self,
+        source: str,
+        key: int,
+        metrics: Dict[str, float],
+        score: float,
+        moves: List[Move],
+        parent: "State" = None,
+        move: Move = None,
+    ):
+        self.source = source
+        self.key = key
+        self.metrics = metrics
+        self.score = score
+        self.moves = moves
+        self.parent = parent
+        self.move = move
+        self.depth = 0 if parent is None else parent.depth + 1
+
+    @property
+    def path(self) -> List["State"]:
+        """
+        states from the initial one to this one
+        """
+        path = []
+        state = self
+        while state is not None:
+            path.append(state)
+            state = state.parent
+        return path[::-1]
+
+    def __repr__(self):
+        return f"State(score={self.score:.2f}, depth={self.depth})"
+
+
+class SearchResult:
+    def __init__(self, initial: State, best: State, evaluated: int, duplicates: int,
+                 failed: int, elapsed: float, stopped: str):
+        self.initial = initial
+        self.best = best
+        self.evaluated = evaluated
+        self.duplicates = duplicates
+        self.failed = failed
+        self.elapsed = elapsed
+        self.stopped = stopped
+
+    @property
+    def moves(self) -> List[Move]:
+        return [state.move for state in self.best.path[1:]]
+
+    def report(self) -> str:
+        lines = [
+            f"evaluated {self.evaluated} states ({self.duplicates} duplicates, "
+            f"{self.failed} failed) in {self.elapsed:.2f}s, stopped: {self.stopped}",
+            f"initial score {self.initial.score:.2f}, best score {self.best.score:.2f} "
+            f"after {self.best.depth} moves",
+        ]
+        for i, state in enumerate(self.best.path[1:], 1):
+            lines.append(f"  {i}. {state.move.label}: {state.score:.2f}")
+        for name, value in self.best.metrics.items():
+            lines.append(f"  {name}: {self.initial.metrics[name]:.2f} -> {value:.2f}")
+        return "\n".join(lines)
+
+
+def find_moves(G: CodeGraph, regions: int = 3) -> List[Move]:
+    """
+    moves that can be applied to G: expanding each call that CallExpander accepts
+    and all of them at once, extracting the best regions of each function
+    (see score_regions) and removing the redundant variables
+    """
+    moves = []
+    expander = CallExpander(G).run()
+    for call_id, (def_id, _, _) in expander.sites.items():
+        call = G.ast_nodes[call_id]
+        label = f"expand {G.ast_nodes[def_id].name}() at line {call.lineno}"
+        moves.append(Move("expand", (call_id,), label))
+    if len(expander.sites) > 1:
+        moves.append(Move("expand_all", (), f"expand {len(expander.sites)} calls"))
+
+    for node_id, node in G.ast_nodes.items():
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            for _, region in score_regions(G, node_id)[:regions]:
+                first, last = node.body[region.start], node.body[region.end]
+                lines = f"{first.lineno}-{getattr(last, 'end_lineno', last.lineno)}"
+                label = f"extract lines {lines} of {node.name}()"
+                moves.append(Move("extract", (node_id, region.start, region.end), label))
+
+    if DeadStoreEliminator(G).run().dead:
+        moves.append(Move("remove", (), "remove redundant variables"))
+    return moves
+
+
+def evaluate(source: str, move: Optional[Move], score: Callable, regions: int):
+    """
+    applies move to the code in source and returns (source, key, metrics, score, moves)
+    of the result, or the error message if the move fails
+    """
+    try:
+        if move is not None:
+            G = CodeGraph(ast.parse(source))
+            move.apply(G)
+            source = G.to_source()
+        G = CodeGraph(ast.parse(source))
+        metrics = calculate_graph_metrics(G)
+        return source, G.subtree_hash(G.root_id), metrics, score(metrics), find_moves(G, regions)
+    except (
+        AssertionError, AttributeError, IndexError, KeyError, TypeError, ValueError,
+        SyntaxError, RecursionError,
+    ) as e:
+        return f"{e.__class__.__name__}: {e}"
+
+
+class Search:
+    """
+    search for the sequence of transforms that maximises score(calculate_graph_metrics(G))
+
+    strategy: "beam" keeps the beam_width best new states of each depth,
+        "best" (best-first) always expands the best state not expanded yet
+    score: function of the metrics, maintainability by default, it is sent to the
+        worker processes so it has to be picklable (defined at module level)
+    regions: number of regions of each function tried for extraction
+    max_depth: longest sequence of moves
+    time_limit: seconds, max_states: number of states evaluated, the search stops
+        at the first limit reached and the states being evaluated are dropped
+    workers: processes evaluating the states, os.cpu_count() by default and 0 to
+        evaluate in this process
+    """
+
+    def __init__(
+        self,
+        score: Callable[[Dict[str, float]], float] = maintainability,
+        strategy: str = "beam",
+        beam_width: int = 4,
+        regions: int = 3,
+        max_depth: int = 5,
+        time_limit: float = None,
+        max_states: int = None,
+        workers: int = None,
+    ):
+        if strategy not in ("beam", "best"):
+            raise ValueError(f"Unknown strategy {strategy}")
+        self.score = score
+        self.strategy = strategy
+        self.beam_width = beam_width
+        self.regions = regions
+        self.max_depth = max_depth
+        self.time_limit = time_limit
+        self.max_states = max_states
+        self.workers = workers
+
+    def run(self, source: str) -> SearchResult:
+        self._start = time.perf_counter()
+        self._seen = set()
+        self._evaluated = self._duplicates = self._failed = 0
+        self._stopped = None
+
+        initial = evaluate(source, None, self.score, self.regions)
+        if isinstance(initial, str):
+            raise ValueError(f"Cannot evaluate the initial code: {initial}")
+        initial = State(*initial)
+        self._seen.add(initial.key)
+        self._evaluated = 1
+        self._best = initial
+
+        self._executor = None
+        if self.workers != 0:
+            self._workers = self.workers or os.cpu_count()
+            self._executor = ProcessPoolExecutor(max_workers=self._workers)
+        try:
+            if self.strategy == "beam":
+                self._beam(initial)
+            else:
+                self._best_first(initial)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+        return SearchResult(
+            initial, self._best, self._evaluated, self._duplicates, self._failed,
+            time.perf_counter() - self._start, self._stopped or "exhausted",
+        )
+
+    def _beam(self, initial: State):
+        frontier = [initial]
+        while frontier and not self._stopped:
+            children = self._children(frontier)
+            children.sort(key=lambda s: -s.score)
+            frontier = [s for s in children[:self.beam_width] if s.depth < self.max_depth]
+
+    def _best_first(self, initial: State):
+        queue = [(-initial.score, 0, initial)]
+        counter = 1
+        while queue and not self._stopped:
+            _, _, state = heapq.heappop(queue)
+            if state.depth >= self.max_depth:
+                continue
+            for child in self._children([state]):
+                heapq.heappush(queue, (-child.score, counter, child))
+                counter += 1
+
+    def _children(self, states: Iterable[State]) -> List[State]:
+        """
+        new states reached by one move from states, evaluated in the pool
+        """
+        tasks = [(state, move) for state in states for move in state.moves]
+        children = []
+        for (state, move), result in self._map(tasks):
+            self._evaluated += 1
+            if isinstance(result, str):
+                self._failed += 1
+                continue
+            child = State(*result, parent=state, move=move)
+            if child.key in self._seen:
+                self._duplicates += 1
+                continue
+            self._seen.add(child.key)
+            children.append(child)
+            if child.score > self._best.score:
+                self._best = child
+        return children
+
+    def _map(self, tasks: List[Tuple[State, Move]]):
+        """
+        yields (task, result) as the evaluations end, until a limit is reached
+        """
+        if self._executor is None:
+            for task in tasks:
+                if self._limit_reached():
+                    return
+                yield task, evaluate(task[0].source, task[1], self.score, self.regions)
+            return
+
+        tasks = iter(tasks)
+        pending = {}
+        while True:
+            # at most 2 evaluations per worker are in flight
+            for state, move in tasks:
+                future = self._executor.submit(evaluate, state.source, move, self.score, self.regions)
+                pending[future] = (state, move)
+                if len(pending) >= 2 * self._workers:
+                    break
+            if not pending:
+                return
+            timeout = None
+            if self.time_limit is not None:
+                timeout = max(0.0, self._start + self.time_limit - time.perf_counter())
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = pending.pop(future)
+                if self._limit_reached():
+                    break
+                yield task, future.result()
+            if self._limit_reached():
+                for future in pending:
+                    future.cancel()
+                return
+
+    def _limit_reached(self) -> bool:
+        if self._stopped:
+            return True
+        if self.max_states is not None and self._evaluated >= self.max_states:
+            self._stopped = "max_states"
+        elif self.time_limit is not None and time.perf_counter() - self._start >= self.time_limit:
+            self._stopped = "time_limit"
+        return self._stopped is not None
+
+
+def search(source: str, **kwargs) -> SearchResult:
+    """
+    Search(**kwargs).run(source)
+    """
+    return Search(**kwargs).run(source)
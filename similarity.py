@@ -0,0 +1,382 @@
+"""
+nearest neighbour search over the function embeddings of graph_embeddings
+
+    index = SimilarityIndex(dim=32)
+    index.add_functions(GraphEmbedder(model, "embeddings.sqlite"), CodeGraph.from_directory("src"))
+    index.build_clusters()
+    for match in index.query_function(embedder, G, node_id, k=10, exclude_self=True):
+        print(match.score, match.location)
+    index.save("index")
+"""
+import json
+import math
+import os
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+
+# rows of the matrix multiplied at a time: 4096 x 128 float32 is 2MB
+BLOCK = 4096
+VECTORS = "vectors.npy"
+ENTRIES = "entries.json"
+CENTROIDS = "centroids.npy"
+ASSIGNMENTS = "assignments.npy"
+
+
+class Location(NamedTuple):
+    """
+    where a function embedded in the index is defined
+    """
+
+    filename: str
+    qualname: str
+    lineno: Optional[int]
+    end_lineno: Optional[int]
+
+
+class Match(NamedTuple):
+    score: float
+    id: int
+    location: Location
+
+
+def location(filename: str, G, node_id: int, qualname: str = None) -> Location:
+    """
+    Location of the node node_id of G, a graph of the file filename
+    """
+    node = G.ast_nodes[node_id]
+    return Location(
+        filename,
+        qualname if qualname is not None else getattr(node, "name", node.__class__.__name__),
+        getattr(node, "lineno", None),
+        getattr(node, "end_lineno", None),
+    )
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    indices of the k highest scores of every row, best first
+    """
+    if k >= scores.shape[1]:
+        top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    else:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1)
+
+
+class SimilarityIndex:
+    """
+    cosine similarity index of embeddings: the vectors are normalized and stored
+    in a float32 matrix, one row per function, memory-mapped once saved
+
+    The exact search multiplies the queries with blocks of BLOCK rows and keeps
+    the best k of each block. After build_clusters() the approximate search only
+    scores the rows of the n_probe clusters whose centroids are the closest to the
+    query. Removed rows are masked out until compact() or save() drops them.
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._size = 0
+        self.locations: List[Optional[Location]] = []
+        self._alive = np.zeros(0, dtype=bool)
+        self._by_file: Dict[str, List[int]] = {}
+        self.centroids: Optional[np.ndarray] = None
+        self._assignments = np.zeros(0, dtype=np.int32)
+        self._clusters: Optional[List[np.ndarray]] = None
+
+    def __len__(self) -> int:
+        return int(self._alive[: self._size].sum())
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """
+        rows of every function added, removed ones included
+        """
+        return self._vectors[: self._size]
+
+    def add(self, vectors: np.ndarray, locations: List[Location]) -> List[int]:
+        """
+        adds the embeddings (one per row) of the functions at locations, returns their ids
+        """
+        vectors = _normalize(np.atleast_2d(vectors))
+        if vectors.shape != (len(locations), self.dim):
+            raise ValueError(f"Expected {len(locations)} vectors of size {self.dim}, got {vectors.shape}")
+        start, end = self._size, self._size + len(locations)
+        self._reserve(end)
+        self._vectors[start:end] = vectors
+        self._alive[start:end] = True
+        self._size = end
+        self.locations.extend(locations)
+        for i, loc in enumerate(locations, start):
+            self._by_file.setdefault(loc.filename, []).append(i)
+        if self.centroids is not None:
+            self._assignments[start:end] = self._assign(vectors)
+            self._clusters = None
+        return list(range(start, end))
+
+    def add_functions(self, embedder, graphs: Iterable[Tuple[str, object]], batch: int = 1024) -> int:
+        """
+        embeds the functions of the (filename, graph) pairs (as yielded by
+        CodeGraph.from_directory) with a GraphEmbedder and adds them, returns the
+        number of functions added
+        """
+        files = {}
+
+        def tagged():
+            for filename, G in graphs:
+                files[id(G)] = filename
+                yield G
+
+        vectors, locations = [], []
+        count = 0
+        for G, node_id, qualname, vector in embedder.embed_functions(tagged()):
+            vectors.append(vector)
+            locations.append(location(files[id(G)], G, node_id, qualname))
+            if len(vectors) >= batch:
+                count += len(self.add(np.stack(vectors), locations))
+                vectors, locations = [], []
+        if vectors:
+            count += len(self.add(np.stack(vectors), locations))
+        return count
+
+    def remove(self, ids: Iterable[int]):
+        ids = np.fromiter(ids, dtype=np.int64)
+        bad = (ids < 0) | (ids >= self._size)
+        bad[~bad] = ~self._alive[ids[~bad]]
+        # an id given twice is not alive the second time
+        first = np.zeros(len(ids), dtype=bool)
+        first[np.unique(ids, return_index=True)[1]] = True
+        bad |= ~first
+        if bad.any():
+            raise KeyError(int(ids[np.argmax(bad)]))
+        self._alive[ids] = False
+        removed = set(ids.tolist())
+        for filename in {self.locations[i].filename for i in removed}:
+            kept = [i for i in self._by_file[filename] if i not in removed]
+            if kept:
+                self._by_file[filename] = kept
+            else:
+                del self._by_file[filename]
+        self._clusters = None
+
+    def remove_file(self, filename: str) -> int:
+        """
+        removes the functions of filename, e.g. before adding them again after it
+        changed, returns their number
+        """
+        ids = self._by_file.pop(filename, [])
+        self._alive[ids] = False
+        self._clusters = None
+        return len(ids)
+
+    def compact(self) -> np.ndarray:
+        """
+        drops the rows of the removed functions, the ids change: returns the old
+        id of every new one
+        """
+        rows = np.flatnonzero(self._alive[: self._size])
+        self._vectors = self._vectors[rows]
+        self._assignments = self._assignments[rows]
+        self._size = len(rows)
+        self._alive = np.ones(self._size, dtype=bool)
+        self.locations = [self.locations[i] for i in rows]
+        self._by_file = {}
+        for i, loc in enumerate(self.locations):
+            self._by_file.setdefault(loc.filename, []).append(i)
+        self._clusters = None
+        return rows
+
+    def _reserve(self, size: int):
+        if size <= len(self._vectors) and self._vectors.flags.writeable:
+            return
+        capacity = max(size, 2 * len(self._vectors), 1024)
+        # a memory-mapped matrix is read only: the rows are copied to memory
+        vectors = np.empty((capacity, self.dim), dtype=np.float32)
+        vectors[: self._size] = self._vectors[: self._size]
+        self._vectors = vectors
+        alive = np.zeros(capacity, dtype=bool)
+        alive[: self._size] = self._alive[: self._size]
+        self._alive = alive
+        assignments = np.zeros(capacity, dtype=np.int32)
+        assignments[: self._size] = self._assignments[: self._size]
+        self._assignments = assignments
+
+    def search(self, queries: np.ndarray, k: int = 10, n_probe: int = None) -> List[List[Tuple[float, int]]]:
+        """
+        (score, id) of the k most similar functions of every query (one per row),
+        best first
+
+        n_probe: number of clusters searched (at least 1, at most all of them),
+            the search is exact when it is None or when build_clusters() was not called
+        """
+        if n_probe is not None and n_probe < 1:
+            raise ValueError(f"n_probe must be at least 1, got {n_probe}")
+        queries = _normalize(np.atleast_2d(queries))
+        if n_probe is not None and self.centroids is not None:
+            n_probe = min(n_probe, len(self.centroids))
+            return [self._search_clusters(q, k, n_probe) for q in queries]
+        return self._search_rows(queries, k, np.arange(self._size))
+
+    def _search_rows(self, queries: np.ndarray, k: int, rows: np.ndarray) -> List[List[Tuple[float, int]]]:
+        """
+        exact search restricted to rows, by blocks
+        """
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(rows), BLOCK):
+            block = rows[start : start + BLOCK]
+            block = block[self._alive[block]]
+            if not len(block):
+                continue
+            scores = queries @ self._vectors[block].T
+            top = _top_k(scores, k)
+            # the best k found so far and the best k of the block
+            scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            ids = np.concatenate([best_ids, block[top]], axis=1)
+            top = _top_k(scores, k)
+            best_scores = np.take_along_axis(scores, top, axis=1)
+            best_ids = np.take_along_axis(ids, top, axis=1)
+        return [
+            [(float(s), int(i)) for s, i in zip(scores, ids)]
+            for scores, ids in zip(best_scores, best_ids)
+        ]
+
+    def _search_clusters(self, query: np.ndarray, k: int, n_probe: int) -> List[Tuple[float, int]]:
+        if self._clusters is None:
+            assignments = self._assignments[: self._size]
+            order = np.argsort(assignments, kind="stable")
+            bounds = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+            self._clusters = [order[bounds[c] : bounds[c + 1]] for c in range(len(self.centroids))]
+        nearest = np.argsort(-(self.centroids @ query))[:n_probe]
+        rows = np.concatenate([self._clusters[c] for c in nearest])
+        return self._search_rows(query[None, :], k, np.sort(rows))[0]
+
+    def query(self, vector: np.ndarray, k: int = 10, n_probe: int = None,
+              exclude: Iterable[int] = ()) -> List[Match]:
+        """
+        the k functions most similar to the embedding vector, with their locations
+        """
+        exclude = set(exclude)
+        results = self.search(vector, k + len(exclude), n_probe)[0]
+        matches = [Match(score, i, self.locations[i]) for score, i in results if i not in exclude]
+        return matches[:k]
+
+    def query_function(self, embedder, G, node_id: int, k: int = 10, n_probe: int = None,
+                       exclude_self: bool = False, filename: str = None) -> List[Match]:
+        """
+        the k functions most similar to the function node_id of G, embedded with
+        embedder (a GraphEmbedder)
+
+        exclude_self: leaves out the functions of the index at the lines of node_id
+            (in filename if it is given), the function itself when it was added
+        """
+        vector = next(embedder.embed([(G, node_id)]))
+        exclude = ()
+        if exclude_self:
+            here = location(filename, G, node_id)
+            candidates = self._by_file.get(filename, ()) if filename is not None else range(self._size)
+            exclude = [
+                i for i in candidates
+                if self._alive[i] and self.locations[i][2:] == here[2:]
+                and self.locations[i].qualname.rsplit(".", 1)[-1] == here.qualname
+            ]
+        return self.query(vector, k, n_probe, exclude)
+
+    def build_clusters(self, n_clusters: int = None, iterations: int = 10, sample: int = 100000,
+                       seed: int = 0):
+        """
+        spherical k-means of the vectors for the approximate search, run on a
+        sample of them, n_clusters is about sqrt(len(self)) by default
+        """
+        rows = np.flatnonzero(self._alive[: self._size])
+        if not len(rows):
+            raise ValueError("The index is empty")
+        if n_clusters is None:
+            n_clusters = max(1, int(math.sqrt(len(rows))))
+        n_clusters = min(n_clusters, len(rows))
+        rng = np.random.default_rng(seed)
+        if len(rows) > sample:
+            rows = np.sort(rng.choice(rows, sample, replace=False))
+        data = self._vectors[rows]
+        centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+        for _ in range(iterations):
+            self.centroids = centroids
+            labels = self._assign(data)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, data)
+            empty = ~np.bincount(labels, minlength=n_clusters).astype(bool)
+            # an empty cluster keeps its centroid
+            sums[empty] = centroids[empty]
+            centroids = _normalize(sums)
+        self.centroids = centroids
+        self._assignments[: self._size] = self._assign(self._vectors[: self._size])
+        self._clusters = None
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        nearest centroid of every vector, by blocks
+        """
+        labels = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), BLOCK):
+            scores = vectors[start : start + BLOCK] @ self.centroids.T
+            labels[start : start + BLOCK] = np.argmax(scores, axis=1)
+        return labels
+
+    def save(self, directory: str):
+        """
+        writes the index to directory, the removed functions are dropped and
+        the ids change: they are the rows of the saved matrix
+        """
+        os.makedirs(directory, exist_ok=True)
+        rows = np.flatnonzero(self._alive[: self._size])
+
+        def replace(name: str, write):
+            path = os.path.join(directory, name)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as file:
+                write(file)
+            os.replace(tmp, path)
+
+        replace(VECTORS, lambda file: np.save(file, self._vectors[rows]))
+        entries = {"dim": self.dim, "locations": [self.locations[i] for i in rows]}
+        replace(ENTRIES, lambda file: file.write(json.dumps(entries).encode("utf-8")))
+        if self.centroids is not None:
+            replace(CENTROIDS, lambda file: np.save(file, self.centroids))
+            replace(ASSIGNMENTS, lambda file: np.save(file, self._assignments[rows]))
+        else:
+            for name in (CENTROIDS, ASSIGNMENTS):
+                if os.path.exists(os.path.join(directory, name)):
+                    os.remove(os.path.join(directory, name))
+
+    @classmethod
+    def load(cls, directory: str) -> "SimilarityIndex":
+        """
+        index saved in directory, its matrix is memory-mapped and only copied
+        to memory when functions are added
+        """
+        with open(os.path.join(directory, ENTRIES), "r", encoding="utf-8") as file:
+            entries = json.load(file)
+        index = cls(entries["dim"])
+        index._vectors = np.load(os.path.join(directory, VECTORS), mmap_mode="r")
+        index._size = len(index._vectors)
+        index.locations = [Location(*loc) for loc in entries["locations"]]
+        index._alive = np.ones(index._size, dtype=bool)
+        for i, loc in enumerate(index.locations):
+            index._by_file.setdefault(loc.filename, []).append(i)
+        if os.path.exists(os.path.join(directory, CENTROIDS)):
+            index.centroids = np.load(os.path.join(directory, CENTROIDS))
+            index._assignments = np.load(os.path.join(directory, ASSIGNMENTS))
+        else:
+            index._assignments = np.zeros(index._size, dtype=np.int32)
+        return index
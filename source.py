@@ -0,0 +1,306 @@
+import ast
+import copy
+import warnings
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import astor
+
+
+# ast.unparse's generator, Python 3.9+, it is private: SourceGenerator overrides its
+# traverse, write and get_type_comment and uses its _source, _indent and _type_ignores,
+# which are checked when this module is imported (see _compatible)
+_Unparser = getattr(ast, "_Unparser", None)
+
+# printed to check that SourceGenerator works with the ast._Unparser of this Python
+_SAMPLE = """
+@decorator
+class A(B, metaclass=M):
+    \"""docstring\"""
+
+    async def f(self, x: int = 1, *args, y, **kwargs) -> None:
+        for i in range(x):  # type: int
+            if i:
+                yield f"{i!r:>{x}} {y}"
+            elif not i:
+                continue
+        try:
+            pass
+        except (ValueError, KeyError) as e:
+            raise RuntimeError() from e
+        finally:
+            del x
+        return [lambda: (yield) for _ in args if _]
+"""
+
+Span = Tuple[int, int]
+
+
+class _Unrefreshed(Exception):
+    """
+    a node of the tree is not in the graph, the tree was changed without a refresh
+    """
+
+
+class SourceCache:
+    """
+    text printed for statements, by (CodeGraph.subtree_hash, indentation level),
+    with the spans of the nodes of the statement in preorder if they were asked
+    for, least recently used entries are dropped past max_entries
+    """
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[int, int], Tuple[str, Optional[List]]]" = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key: Tuple[int, int]):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Tuple[int, int], entry: Tuple[str, Optional[List]]):
+        self._entries[key] = entry
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+if _Unparser is not None:
+
+    class SourceGenerator(_Unparser):
+        """
+        ast.unparse of the tree of a CodeGraph that reuses the text of the statements
+        printed before: every statement is looked up in the cache by its subtree hash,
+        so after a local transform only the statements containing a changed node are
+        printed again (the others are copied from the cache). The tree is not copied
+        nor modified.
+
+        With spans=True, spans maps the node ids to the (start, end) offsets of the
+        nodes in the text, the nodes inside f-strings are not in it.
+        """
+
+        def __init__(self, G=None, cache: SourceCache = None, spans: bool = False, **kwargs):
+            # ast._Unparser creates generators without a graph for f-string parts
+            super().__init__(**kwargs)
+            self.G = G
+            self.cache = cache
+            self.spans: Optional[Dict[int, Span]] = {} if spans else None
+            self._buffer = None
+            if G is not None and getattr(G.ast_tree, "type_ignores", None):
+                # the type comments are found by line number
+                self.cache = None
+
+        def generate(self) -> str:
+            self._source = self._buffer = []
+            self._length = 0
+            try:
+                self.traverse(self.G.ast_tree)
+            except _Unrefreshed:
+                if self.spans is not None:
+                    raise ValueError("the tree was changed without a refresh of the graph")
+                # the subtree hashes of the statements are out of date as well
+                return _uncached(self.G.ast_tree)
+            text = "".join(self._source)
+            if self.spans is not None:
+                # a statement starts after the newline and indentation written before it
+                for node_id, (start, end) in self.spans.items():
+                    if isinstance(self.G.ast_nodes[node_id], ast.stmt):
+                        while start < end and text[start] in " \n":
+                            start += 1
+                        self.spans[node_id] = (start, end)
+            return text + "\n" if text else text
+
+        def get_type_comment(self, node):
+            # nodes created by the transforms have no location
+            comment = self._type_ignores.get(getattr(node, "lineno", None)) or node.type_comment
+            if comment is not None:
+                return f" # type: {comment}"
+
+        def write(self, *text):
+            self._source.extend(text)
+            if self._source is self._buffer:
+                self._length += sum(map(len, text))
+
+        def traverse(self, node):
+            if self.G is None:
+                super().traverse(node)
+                return
+            if isinstance(node, list):
+                for item in node:
+                    self.traverse(item)
+                return
+            try:
+                node_id = self.G.node_id(node)
+            except KeyError:
+                raise _Unrefreshed() from None
+            if self.cache is not None and isinstance(node, ast.stmt):
+                self._traverse_cached(node, node_id)
+            elif self.spans is not None and self._source is self._buffer:
+                start = self._length
+                super().traverse(node)
+                self.spans[node_id] = (start, self._length)
+            else:
+                super().traverse(node)
+
+        def _traverse_cached(self, node: ast.stmt, node_id: int):
+            key = (self.G.subtree_hash(node_id), self._indent)
+            entry = self.cache.get(key)
+            if entry is None or (self.spans is not None and entry[1] is None):
+                self.cache.misses += 1
+                entry = self._print(node, node_id)
+                self.cache.put(key, entry)
+            else:
+                self.cache.hits += 1
+
+            text, spans = entry
+            shift = 0
+            if not self._source:
+                # nothing written yet, so no newline before the statement
+                shift = len(text) - len(text.lstrip("\n"))
+                text = text[shift:]
+            start = self._length
+            tracked = self._source is self._buffer
+            self.write(text)
+            if self.spans is not None and tracked:
+                for span_id, span in zip(self._preorder(node_id), spans):
+                    if span is not None:
+                        self.spans[span_id] = (
+                            start + max(0, span[0] - shift),
+                            start + max(0, span[1] - shift),
+                        )
+
+        def _print(self, node: ast.stmt, node_id: int) -> Tuple[str, Optional[List]]:
+            """
+            text of the statement as written after other code, and the spans of its
+            nodes in preorder relative to the text
+            """
+            outer = self._source, self._buffer, self._length, self.spans
+            # not empty, so that the newlines before the statement are written
+            self._source = self._buffer = [""]
+            self._length = 0
+            if self.spans is not None:
+                self.spans = {}
+            super().traverse(node)
+            text = "".join(self._source)
+            spans = None
+            if self.spans is not None:
+                self.spans[node_id] = (0, len(text))
+                spans = [self.spans.get(i) for i in self._preorder(node_id)]
+            self._source, self._buffer, self._length, self.spans = outer
+            return text, spans
+
+        def _preorder(self, node_id: int) -> List[int]:
+            ids = []
+            stack = [node_id]
+            while stack:
+                current = stack.pop()
+                ids.append(current)
+                stack.extend(reversed(self.G.children(current)))
+            return ids
+
+    def _uncached(tree: ast.AST) -> str:
+        text = SourceGenerator().visit(tree)
+        return text + "\n" if text else text
+
+    def _compatible() -> bool:
+        """
+        whether SourceGenerator prints like ast.unparse with the ast._Unparser of this
+        Python, its internals are not part of the ast API
+        """
+        try:
+            for name in ("traverse", "write", "get_type_comment"):
+                if not callable(getattr(_Unparser, name, None)):
+                    return False
+            tree = ast.parse(_SAMPLE, type_comments=True)
+            generator = SourceGenerator()
+            text = generator.visit(tree)
+            return (
+                text == ast.unparse(tree)
+                and isinstance(generator._source, list)
+                and isinstance(generator._indent, int)
+                and isinstance(generator._type_ignores, dict)
+            )
+        except Exception:
+            return False
+
+    if not _compatible():
+        warnings.warn(
+            "ast._Unparser is not compatible with SourceGenerator, astor prints the trees",
+            RuntimeWarning,
+        )
+        _Unparser = None
+
+
+_cache = SourceCache()
+
+
+def to_source(G, cache: SourceCache = None) -> str:
+    """
+    source of the tree of G, see SourceGenerator, the statements are cached in a
+    cache shared by all graphs unless another one is given. The cache is not used
+    while G is stale (see CodeGraph.stale) or once a node of the tree is not in G,
+    so nodes changed in place must be made mutable or followed by a refresh. Without
+    a compatible ast.unparse (see _compatible) the tree is copied and printed by astor.
+    """
+    if _Unparser is None:
+        return astor.to_source(copy.deepcopy(G.ast_tree))
+    if G.stale:
+        # the subtree hashes of the changed statements are out of date
+        return _uncached(G.ast_tree)
+    return SourceGenerator(G, cache if cache is not None else _cache).generate()
+
+
+def source_map(G, cache: SourceCache = None) -> Tuple[str, Dict[int, Span]]:
+    """
+    source of the tree of G and the (start, end) offsets of its nodes in it, the
+    graph must be up to date with its tree. Without a compatible ast.unparse only the
+    nodes with a location are in the map, see _located_spans
+    """
+    if G.stale:
+        raise ValueError("the tree was changed without a refresh of the graph")
+    if _Unparser is None:
+        text = to_source(G)
+        return text, _located_spans(G, text)
+    generator = SourceGenerator(G, cache if cache is not None else _cache, spans=True)
+    text = generator.generate()
+    return text, generator.spans
+
+
+def _located_spans(G, text: str) -> Dict[int, Span]:
+    """
+    spans of the nodes of G that have a location, taken from the tree parsed back
+    from text, whose nodes are matched with the ones of G in preorder
+    """
+    lines = text.splitlines(keepends=True)
+    starts = [0]
+    for line in lines:
+        starts.append(starts[-1] + len(line))
+
+    def offset(lineno: int, col: int) -> int:
+        # the columns of the ast are in utf-8 bytes
+        line = lines[lineno - 1] if lineno <= len(lines) else ""
+        return starts[lineno - 1] + len(line.encode()[:col].decode(errors="ignore"))
+
+    spans = {}
+    stack = [(G.root_id, ast.parse(text))]
+    while stack:
+        node_id, printed = stack.pop()
+        children = G.children(node_id)
+        printed_children = list(ast.iter_child_nodes(printed))
+        if G.ast_nodes[node_id].__class__ is not printed.__class__ or (
+            len(children) != len(printed_children)
+        ):
+            raise ValueError("the printed source does not parse back to the tree of the graph")
+        if getattr(printed, "end_lineno", None) is not None:
+            spans[node_id] = (
+                offset(printed.lineno, printed.col_offset),
+                offset(printed.end_lineno, printed.end_col_offset),
+            )
+        # the locations inside f-strings are the ones of the whole string
+        if not isinstance(printed, ast.JoinedStr):
+            stack.extend(zip(reversed(children), reversed(printed_children)))
+    return spans
@@ -1,5 +1,7 @@
 from dataclasses import dataclass
+import ast
 import xml.etree.ElementTree as ET
+from layout import tidy_tree_layout
 from graph import (
     ASTEdge,
     Edge,
@@ -10,9 +12,14 @@ from graph import (
     SyntaxToken,
     Occurence,
 )
-from typing import Union, Tuple
+from typing import IO, Dict, List, Optional, Union, Tuple
 from abc import ABC, abstractmethod
-import random
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+from collections import OrderedDict, deque
+import base64
+import re
+import zlib
 
 PURPLE = "#CCCCFF"
 MID_PURPLE = "#CC99FF"
@@ -95,12 +102,72 @@ AST_NODE_COLORS = {
 }
 
 
+NODE_TEMPLATE = (
+    '<mxCell id="{id}" value="{value}" style="{style}" parent="1" vertex="1">'
+    '<mxGeometry x="{x}" y="{y}" width="{width}" height="{height}" as="geometry" />'
+    "</mxCell>\n"
+)
+EDGE_TEMPLATE = (
+    '<mxCell id="{id}" value="{value}" style="{style}" parent="1" source="{source}" '
+    'target="{target}" edge="1">'
+    '<mxGeometry width="50" height="50" relative="1" as="geometry">'
+    '<mxPoint x="400" y="440" as="sourcePoint" />'
+    '<mxPoint x="450" y="390" as="targetPoint" />'
+    "</mxGeometry></mxCell>\n"
+)
+GRAPH_MODEL = (
+    '<mxGraphModel dx="422" dy="816" grid="1" gridSize="10" guides="1" tooltips="1" '
+    'connect="1" arrows="1" fold="1" page="1" pageScale="1" pageWidth="850" '
+    'pageHeight="1100" math="0" shadow="0"><root>\n'
+    '<mxCell id="0" />\n<mxCell id="1" parent="0" />\n'
+)
+GRAPH_MODEL_END = "</root></mxGraphModel>"
+
+_ATTRIBUTE_ENTITIES = {'"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#09;"}
+# characters xml 1.0 does not allow, not even as character references
+_INVALID_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+
+def _attr(value: str) -> str:
+    if _INVALID_XML.search(value) is not None:
+        # written as in python source, e.g. \x0b
+        value = _INVALID_XML.sub(lambda m: ascii(m.group())[1:-1], value)
+    return escape(value, _ATTRIBUTE_ENTITIES)
+
+
 @dataclass
 class GeneralStyleParams:
     x_scaling: int = 1
     y_scaling: int = 1
     box_width: int = 120
     box_height: int = 60
+    # the entry points of the occurrence edges are spread after it
+    seed: int = 0
+
+
+@dataclass
+class DetailParams:
+    """
+    what an export shows, the work done for it only depends on the cells shown
+
+    max_depth: nodes deeper than it below the root of their page are hidden, the
+        node at max_depth is shown as a summary cell, None to show every level
+    collapse_types: names of the ast types whose subtrees are hidden behind a
+        summary cell, e.g. ("Call", "JoinedStr")
+    split_functions: every function and class gets its own page, shown as a
+        summary cell on the page of the enclosing code
+    max_occurences: occurrence edges drawn per syntax token and page, None for all
+    tokens: whether the syntax tokens (and their occurrences) are shown
+    """
+
+    max_depth: Optional[int] = None
+    collapse_types: Tuple[str, ...] = ()
+    split_functions: bool = False
+    max_occurences: Optional[int] = None
+    tokens: bool = True
+
+
+PAGE_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
 
 
 class NodeXML(ABC):
@@ -116,6 +183,9 @@ class NodeXML(ABC):
     def style(self):
         pass
 
+    def style_html(self) -> str:
+        return self.style().to_html()
+
     def to_xml(self, pos: Tuple[float, float]):
         x, y = pos
         x = x * self.params.x_scaling
@@ -132,13 +202,28 @@ class NodeXML(ABC):
         box = ET.Element("mxCell")
         box.set("id", str(self.node.id))
         box.set("value", self.node_html_label())
-        box.set("style", self.style().to_html())
+        box.set("style", self.style_html())
         box.set("parent", "1")
         box.set("vertex", "1")
         box.append(point_xml)
 
         return box
 
+    def to_xml_string(self, pos: Tuple[float, float]) -> str:
+        """
+        to_xml() written out, without building the elements
+        """
+        x, y = pos
+        return NODE_TEMPLATE.format(
+            id=_attr(str(self.node.id)),
+            value=_attr(self.node_html_label()),
+            style=_attr(self.style_html()),
+            x=x * self.params.x_scaling,
+            y=y * self.params.y_scaling,
+            width=self.params.box_width,
+            height=self.params.box_height,
+        )
+
 
 @dataclass
 class NodeStyle(ABC):
@@ -167,17 +252,35 @@ class ASTNodeXML(NodeXML):
         fillColor = AST_NODE_COLORS.get(self.node.ast_node.__class__.__name__, GREY)
         return ASTNodeStyle(fillColor=fillColor)
 
+    def style_html(self) -> str:
+        return AST_NODE_STYLES.get(self.node.ast_node.__class__.__name__, AST_NODE_STYLES[None])
+
     def node_html_label(self):
-        attrs = {
-            k: v
-            for k, v in self.node.attrs.items()
-            if k not in ("lineno", "col_offset", "end_lineno", "end_col_offset")
-        }
-        label = "<br>".join(
-            ["<b>" + self.node.ast_node.__class__.__name__ + "</b>"]
-            + [f"{key}: {value}" for key, value in attrs.items() if key != "type"]
-        )
-        return label
+        return _labels.label(self.node.ast_node)
+
+
+class SummaryNodeXML(ASTNodeXML):
+    """
+    node standing for a hidden subtree or for a function on another page
+    """
+
+    def __init__(
+        self, node: ASTNode, summary: str, params: GeneralStyleParams = GeneralStyleParams()
+    ):
+        self.params = params
+        self.node = node
+        self.summary = summary
+
+    def style(self):
+        style = super().style()
+        style.dashed = 1
+        return style
+
+    def style_html(self) -> str:
+        return super().style_html() + ";dashed=1"
+
+    def node_html_label(self):
+        return super().node_html_label() + f"<br><i>{self.summary}</i>"
 
 
 class SyntaxTokenStyle(NodeXML):
@@ -190,6 +293,9 @@ class SyntaxTokenStyle(NodeXML):
     def style(self):
         return ASTNodeStyle(fillColor=MID_BLUE, strokeColor=MID_BLUE)
 
+    def style_html(self) -> str:
+        return SYNTAX_TOKEN_STYLE
+
     def node_html_label(self):
         attrs = {
             k: v
@@ -217,6 +323,10 @@ class EdgeXML(ABC):
     def style(self) -> EdgeStyle:
         pass
 
+    @property
+    def style_html(self) -> str:
+        return self.style.to_html()
+
     @property
     @abstractmethod
     def value(self):
@@ -231,7 +341,7 @@ class EdgeXML(ABC):
             "mxCell",
             id=edge_id,
             value=self.value,
-            style=self.style.to_html(),
+            style=self.style_html,
             parent="1",
             source=str(source_id),
             target=str(target_id),
@@ -261,6 +371,19 @@ class EdgeXML(ABC):
 
         return mxCell
 
+    def to_xml_string(self) -> str:
+        """
+        to_xml() written out, without building the elements
+        """
+        source_id, target_id = self.edge.id
+        return EDGE_TEMPLATE.format(
+            id=_attr(f"{source_id}_{target_id}"),
+            value=_attr(self.value),
+            style=_attr(self.style_html),
+            source=_attr(str(source_id)),
+            target=_attr(str(target_id)),
+        )
+
 
 @dataclass
 class ASTEdgeStyle(EdgeStyle):
@@ -277,6 +400,10 @@ class ASTEdgeXML(EdgeXML):
     def style(self) -> ASTEdgeStyle:
         return ASTEdgeStyle()
 
+    @property
+    def style_html(self) -> str:
+        return AST_EDGE_STYLE
+
     @property
     def value(self):
         return str(self.edge.attrs)
@@ -309,19 +436,91 @@ class OccurenceStyle:
 
 
 class OccurenceXML(EdgeXML):
-    def __init__(self, edge: Occurence):
+    def __init__(self, edge: Occurence, params: GeneralStyleParams = GeneralStyleParams()):
         self.edge = edge
+        self.params = params
 
     @property
-    def style(self) -> str:
-        style = OccurenceStyle(entryX=0.25 + random.random() * 0.25)
-        return style
+    def style(self) -> OccurenceStyle:
+        return OccurenceStyle(entryX=occurence_entry(self.edge, self.params.seed))
 
     @property
     def value(self):
         return ""
 
 
+def occurence_entry(edge: Occurence, seed: int = 0) -> float:
+    """
+    entryX of an occurrence edge, spread over [0.25, 0.5) so that the edges ending
+    on a node do not overlap, it only depends on the ids of the edge and on seed
+    """
+    source_id, target_id = edge.id
+    offset = zlib.crc32(f"{seed}:{source_id}_{target_id}".encode("utf-8")) / (1 << 32)
+    return round(0.25 + offset * 0.25, 4)
+
+
+# styles of the cells, written out once
+AST_NODE_STYLES: Dict[Optional[str], str] = {
+    name: ASTNodeStyle(fillColor=color).to_html() for name, color in AST_NODE_COLORS.items()
+}
+AST_NODE_STYLES[None] = ASTNodeStyle(fillColor=GREY).to_html()
+SYNTAX_TOKEN_STYLE = ASTNodeStyle(fillColor=MID_BLUE, strokeColor=MID_BLUE).to_html()
+AST_EDGE_STYLE = ASTEdgeStyle().to_html()
+
+# attributes of the ast nodes left out of their labels
+_HIDDEN_ATTRS = frozenset(("lineno", "col_offset", "end_lineno", "end_col_offset", "type", "parent"))
+
+
+class LabelCache:
+    """
+    html labels of the ast nodes (see ASTNodeXML), by node identity and the
+    attributes shown in the label, so a node changed by a transform gets a new
+    label, least recently used entries are dropped past max_entries
+    """
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, str]" = OrderedDict()
+        self.hits = self.misses = 0
+
+    def label(self, ast_node: ast.AST) -> str:
+        attrs = [
+            (k, v)
+            for k, v in ast_node.__dict__.items()
+            if not (v is None or isinstance(v, (list, ast.AST)) or k in _HIDDEN_ATTRS)
+        ]
+        if hasattr(ast_node, "ctx"):
+            attrs.append(("ctx", ast_node.ctx.__class__.__name__))
+        # the types tell 1, 1.0 and True apart
+        key = (id(ast_node), ast_node.__class__, tuple((k, v.__class__, v) for k, v in attrs))
+        try:
+            label = self._entries.get(key)
+        except TypeError:
+            # unhashable attribute
+            return self._format(ast_node, attrs)
+        if label is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return label
+        self.misses += 1
+        label = self._entries[key] = self._format(ast_node, attrs)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return label
+
+    @staticmethod
+    def _format(ast_node: ast.AST, attrs: List[Tuple[str, object]]) -> str:
+        return "<br>".join(
+            ["<b>" + ast_node.__class__.__name__ + "</b>"] + [f"{key}: {value}" for key, value in attrs]
+        )
+
+    def clear(self):
+        self._entries.clear()
+
+
+_labels = LabelCache()
+
+
 def get_style_cls(element: Union[Node, Edge]):
     if element.__class__.__name__ == "SyntaxToken":
         return SyntaxTokenStyle
@@ -400,6 +599,185 @@ class OurGraphToXML:
             root.append(SyntaxTokenStyle(node, self.params).to_xml(G.pos_inv[node.id]))
 
         for edge in G.occurences.values():
-            root.append(OccurenceXML(edge).to_xml())
+            root.append(OccurenceXML(edge, self.params).to_xml())
 
         return mxfile
+
+    def write(self, G: Union[CodeGraph, OurGraphWithNewNodes], file: Union[str, IO[str]],
+              compressed: bool = False, detail: DetailParams = None):
+        """
+        writes the document of graph_to_xml to file (a path or a text file) one cell
+        at a time, see DrawioWriter
+
+        detail: with it only the part of G it asks for is written, see DetailParams,
+            and the nodes are laid out again on each page with the tidy layout
+        """
+        with DrawioWriter(file, compressed) as writer:
+            if detail is not None:
+                self._write_pages(G, writer, detail)
+                return
+            writer.begin_page("code-graph", "Page-1")
+            for node in G.our_nodes.values():
+                writer.write(ASTNodeXML(node, self.params).to_xml_string(G.pos_inv[node.id]))
+            for edge in G.our_edges.values():
+                writer.write(ASTEdgeXML(edge).to_xml_string())
+            for node in G.syntax_tokens.values():
+                writer.write(SyntaxTokenStyle(node, self.params).to_xml_string(G.pos_inv[node.id]))
+            for edge in G.occurences.values():
+                writer.write(OccurenceXML(edge, self.params).to_xml_string())
+            writer.end_page()
+
+    def _write_pages(self, G: CodeGraph, writer: "DrawioWriter", detail: DetailParams):
+        symbols = G.symbols if detail.tokens else None
+        pages = deque([(G.root_id, "Page-1")])
+        while pages:
+            root_id, name = pages.popleft()
+            writer.begin_page(f"code-graph-{root_id}", name)
+            shown, children, summaries = self._page(G, root_id, name, detail, pages)
+
+            pos = tidy_tree_layout(root_id, children)
+            y_max = max(y for _, y in pos.values())
+            for node_id in shown:
+                x, y = pos[node_id]
+                node = G.our_nodes[node_id]
+                if node_id in summaries:
+                    cell = SummaryNodeXML(node, summaries[node_id], self.params)
+                else:
+                    cell = ASTNodeXML(node, self.params)
+                writer.write(cell.to_xml_string((x, y_max - y)))
+            for parent_id, child_ids in children.items():
+                for child_id in child_ids:
+                    writer.write(ASTEdgeXML(G.our_edges[(parent_id, child_id)]).to_xml_string())
+
+            if symbols is not None:
+                tokens: Dict[str, SyntaxToken] = {}
+                occurences: List[Occurence] = []
+                counts: Dict[str, int] = {}
+                for node_id in shown:
+                    token = symbols.binding(node_id)
+                    if token is None:
+                        continue
+                    tokens.setdefault(token.id, token)
+                    count = counts.get(token.id, 0)
+                    if detail.max_occurences is None or count < detail.max_occurences:
+                        occurences.append(Occurence(G.our_nodes[node_id], token))
+                    counts[token.id] = count + 1
+                for i, token in enumerate(tokens.values()):
+                    writer.write(SyntaxTokenStyle(token, self.params).to_xml_string((-150, 50 * i)))
+                for edge in occurences:
+                    writer.write(OccurenceXML(edge, self.params).to_xml_string())
+            writer.end_page()
+
+    def _page(self, G: CodeGraph, root_id: int, name: str, detail: DetailParams, pages: deque):
+        """
+        nodes shown on the page of root_id in preorder, the children shown of each
+        node and the summaries of the nodes hiding their subtree, adds the pages of
+        the functions found to pages
+        """
+        shown = []
+        children = {}
+        summaries = {}
+        nodes = G.our_nodes
+        stack = [(root_id, 0)]
+        while stack:
+            node_id, depth = stack.pop()
+            shown.append(node_id)
+            if node_id == root_id:
+                child_ids = [child_id for child_id in G.children(node_id) if child_id in nodes]
+                children[node_id] = child_ids
+                stack.extend((child_id, 1) for child_id in reversed(child_ids))
+                continue
+            node = G.ast_nodes[node_id]
+            if detail.split_functions and isinstance(node, PAGE_TYPES):
+                page = node.name if root_id == G.root_id else f"{name}.{node.name}"
+                summaries[node_id] = f"page {page}"
+                pages.append((node_id, page))
+                continue
+            # the contexts (Load, Store) are not drawn
+            child_ids = [child_id for child_id in G.children(node_id) if child_id in nodes]
+            if child_ids and (
+                node.__class__.__name__ in detail.collapse_types
+                or (detail.max_depth is not None and depth >= detail.max_depth)
+            ):
+                summaries[node_id] = f"{len(child_ids)} children hidden"
+                continue
+            if child_ids:
+                children[node_id] = child_ids
+                stack.extend((child_id, depth + 1) for child_id in reversed(child_ids))
+        return shown, children, summaries
+
+
+class DrawioWriter:
+    """
+    writes a drawio document to a file as its cells are given, so the document is
+    never held in memory
+
+    compressed: the pages are stored as drawio compresses them, the page xml url
+        encoded, deflated and base64 encoded, which is streamed as well
+    """
+
+    def __init__(self, file: Union[str, IO[str]], compressed: bool = False):
+        self._owned = isinstance(file, str)
+        self.file = open(file, "w", encoding="utf-8") if self._owned else file
+        self.compressed = compressed
+        self._page = False
+        self.file.write('<mxfile host="65bd71144e">\n')
+
+    def begin_page(self, page_id: str, name: str):
+        if self._page:
+            self.end_page()
+        self._page = True
+        self.file.write(f'<diagram id="{_attr(page_id)}" name="{_attr(name)}">')
+        if self.compressed:
+            self._deflate = zlib.compressobj(9, zlib.DEFLATED, -15)
+            self._pending = b""
+            self._texts = []
+            self._size = 0
+        else:
+            self.file.write("\n")
+        self.write(GRAPH_MODEL)
+
+    def write(self, text: str):
+        if not self.compressed:
+            self.file.write(text)
+            return
+        # the cells are compressed by blocks of about 64kB
+        self._texts.append(text)
+        self._size += len(text)
+        if self._size >= 1 << 16:
+            self._compress()
+
+    def _compress(self):
+        text = "".join(self._texts)
+        self._texts = []
+        self._size = 0
+        data = self._pending + self._deflate.compress(quote(text, safe="~()*!.'").encode("ascii"))
+        # base64 works on groups of 3 bytes, the rest waits for the next block
+        cut = len(data) - len(data) % 3
+        self.file.write(base64.b64encode(data[:cut]).decode("ascii"))
+        self._pending = data[cut:]
+
+    def end_page(self):
+        self.write(GRAPH_MODEL_END)
+        if self.compressed:
+            self._compress()
+            data = self._pending + self._deflate.flush()
+            self.file.write(base64.b64encode(data).decode("ascii"))
+            self._deflate = None
+        else:
+            self.file.write("\n")
+        self.file.write("</diagram>\n")
+        self._page = False
+
+    def close(self):
+        if self._page:
+            self.end_page()
+        self.file.write("</mxfile>\n")
+        if self._owned:
+            self.file.close()
+
+    def __enter__(self) -> "DrawioWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
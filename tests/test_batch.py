@@ -0,0 +1,100 @@
+import csv
+import json
+import os
+import shutil
+
+import pytest
+
+from batch import MetricsBatch, columns, measure_file, run_batch
+from conftest import SAMPLES
+from transforms import expand_all_calls
+
+
+FORMATS = pytest.mark.parametrize("ext", ["jsonl", "csv"])
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    directory = tmp_path / "corpus"
+    directory.mkdir()
+    for name in os.listdir(SAMPLES):
+        if name.endswith(".py"):
+            shutil.copy(os.path.join(SAMPLES, name), directory)
+    for name in ("textwrap.py", "shlex.py"):
+        shutil.copy(os.path.join(os.path.dirname(os.__file__), name), directory)
+    (directory / "sub").mkdir()
+    (directory / "sub" / "broken.py").write_text("def f(:\n")
+    return directory
+
+
+def read(path):
+    with open(path, newline="") as f:
+        if str(path).endswith(".csv"):
+            return [dict(row) for row in csv.DictReader(f)]
+        return [json.loads(line) for line in f]
+
+
+def normalized(rows):
+    return sorted(json.dumps({k: str(v) for k, v in row.items() if v not in ("", None)}, sort_keys=True) for row in rows)
+
+
+def test_measure_file():
+    rows = measure_file(os.path.join(SAMPLES, "test-expansion.py"), expand_all_calls)
+    assert rows[-1]["kind"] == "file"
+    assert {row["stage"] for row in rows[:-1]} == {"before", "after"}
+    assert rows[-1]["Lines of Code delta"] == rows[-1]["Lines of Code after"] - rows[-1]["Lines of Code"]
+
+
+@FORMATS
+def test_run(corpus, tmp_path, ext):
+    output = tmp_path / f"out.{ext}"
+    summary = run_batch(corpus, output, transform=expand_all_calls, workers=0)
+    rows = read(output)
+    assert summary.files == 5
+    assert summary.errors == 1
+    assert [row["file"] for row in rows if row["kind"] == "error"] == [str(corpus / "sub" / "broken.py")]
+    assert sum(summary.ranks.values()) == sum(
+        1 for row in rows if row["kind"] == "function" and row["stage"] == "before"
+    )
+    if ext == "csv":
+        with open(output) as f:
+            assert next(csv.reader(f)) == columns(True)
+
+
+@FORMATS
+def test_resume(corpus, tmp_path, ext):
+    output = tmp_path / f"out.{ext}"
+    full = run_batch(corpus, output, transform=expand_all_calls, workers=0)
+    data = output.read_bytes()
+
+    # interrupted in the middle of a line
+    output.write_bytes(data[: len(data) // 2])
+    resumed = run_batch(corpus, output, transform=expand_all_calls, workers=0)
+    assert resumed.report() == full.report()
+    assert sorted(output.read_bytes().splitlines()) == sorted(data.splitlines())
+
+    # nothing left to measure
+    again = run_batch(corpus, output, transform=expand_all_calls, workers=0)
+    assert again.report() == full.report()
+    assert sorted(output.read_bytes().splitlines()) == sorted(data.splitlines())
+
+
+def test_restart(corpus, tmp_path):
+    output = tmp_path / "out.jsonl"
+    run_batch(corpus, output, workers=0)
+    data = output.read_bytes()
+    run_batch(corpus, output, workers=0, resume=False)
+    assert output.read_bytes() == data
+
+
+def test_resume_other_columns(corpus, tmp_path):
+    output = tmp_path / "out.csv"
+    run_batch(corpus, output, workers=0)
+    with pytest.raises(ValueError):
+        MetricsBatch(output, transform=expand_all_calls, workers=0).run(corpus)
+
+
+def test_workers(corpus, tmp_path):
+    run_batch(corpus, tmp_path / "serial.jsonl", transform=expand_all_calls, workers=0)
+    run_batch(corpus, tmp_path / "pool.jsonl", transform=expand_all_calls, workers=2, chunksize=2)
+    assert normalized(read(tmp_path / "pool.jsonl")) == normalized(read(tmp_path / "serial.jsonl"))
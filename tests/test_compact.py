@@ -0,0 +1,73 @@
+import ast
+import copy
+import os
+import pickle
+
+import pytest
+
+from compact import CompactCodeGraph
+from conftest import SAMPLES
+from graph import CodeGraph
+
+
+SOURCE = """
+def main(a):
+    def inner(x):
+        return x < a < 3 and x + a
+    b = inner(a) + -a
+    return {None: b, **a}
+"""
+
+FILES = [os.path.join(SAMPLES, name) for name in sorted(os.listdir(SAMPLES)) if name.endswith(".py")]
+FILES.append(os.path.join(os.path.dirname(os.__file__), "textwrap.py"))
+
+
+def read(name):
+    if name == "snippet":
+        return SOURCE
+    with open(next(path for path in FILES if os.path.basename(path) == name)) as f:
+        return f.read()
+
+
+def check_equal(A, B):
+    assert list(A.ast_nodes) == list(B.ast_nodes)
+    assert list(A.our_nodes) == list(B.our_nodes)
+    for node_id in A.our_nodes:
+        assert A.our_nodes[node_id].attrs == B.our_nodes[node_id].attrs
+    assert list(A.our_edges) == list(B.our_edges)
+    assert list(A._nxG.nodes(data=True)) == list(B._nxG.nodes(data=True))
+    assert list(A._nxG.edges) == list(B._nxG.edges)
+    assert list(A.syntax_tokens) == list(B.syntax_tokens)
+    assert list(A.occurences) == list(B.occurences)
+    assert A.pos_inv == B.pos_inv
+    for node_id in A.ast_nodes:
+        assert A.get_parent(node_id) == B.get_parent(node_id)
+        assert A.children(node_id) == B.children(node_id)
+        assert A.depth(node_id) == B.depth(node_id)
+        assert A.subtree(node_id) == B.subtree(node_id)
+    assert A.subtree_hash(A.root_id) == B.subtree_hash(B.root_id)
+    assert A.to_source() == B.to_source()
+
+
+@pytest.mark.parametrize("name", ["snippet", *map(os.path.basename, FILES)])
+def test_same_graph(name):
+    source = read(name)
+    check_equal(CodeGraph(ast.parse(source)), CompactCodeGraph(ast.parse(source)))
+
+
+def test_round_trips():
+    B = CompactCodeGraph(ast.parse(SOURCE))
+    check_equal(B, pickle.loads(pickle.dumps(B)))
+    check_equal(B, copy.deepcopy(B))
+    check_equal(B, B.copy())
+
+
+def test_refresh():
+    A = CodeGraph(ast.parse(SOURCE))
+    B = CompactCodeGraph(ast.parse(SOURCE))
+    for G in (A, B):
+        function_id = next(i for i, n in G.ast_nodes.items() if isinstance(n, ast.FunctionDef) and n.name == "inner")
+        with G.mutate(function_id) as (function,):
+            function.body.insert(0, ast.parse("y = x * 2").body[0])
+    check_equal(A, B)
+    check_equal(B, CompactCodeGraph(B.ast_tree))
@@ -0,0 +1,96 @@
+import ast
+import copy
+import os
+
+import pytest
+
+import transforms
+from compact import CompactCodeGraph
+from conftest import SAMPLES
+from graph import CodeGraph
+
+
+CHAIN = """
+def main():
+    def plus(a, b):
+        return a + b
+    s, r = 1, 2
+    x, y = 1, 2
+    res = plus(x, y)
+    u = 3
+    t = plus(s, r)
+    return res + t
+"""
+
+CLASSES = pytest.mark.parametrize("cls", [CodeGraph, CompactCodeGraph], ids=lambda cls: cls.__name__)
+
+
+def plus_calls(G):
+    return [
+        i for i, n in G.ast_nodes.items()
+        if isinstance(n, ast.Call) and getattr(n.func, "id", None) == "plus"
+    ]
+
+
+def transform(G, name):
+    if name == "expand":
+        call = next(k for k, n in G.ast_nodes.items() if isinstance(n, ast.Call))
+        transforms.expand_function(G, call)
+    elif name == "extract":
+        transforms.extract_function(G, G.node_id(G.ast_tree.body[0]), 1, 2)
+    else:
+        transforms.remove_redundant_variables(G)
+
+
+@CLASSES
+def test_chain_on_copy_leaves_original_unchanged(cls):
+    G = cls(ast.parse(CHAIN))
+    # the tree itself, to_source() could reuse text cached by subtree hash
+    before = ast.unparse(G.ast_tree)
+    H = G.copy()
+    main_id = H.node_id(H.ast_tree.body[0])
+    transforms.expand_function(H, plus_calls(H)[0])
+    transforms.extract_function(H, main_id, 1, 5)
+    # the statement calling plus(s, r) now has the id of a statement cloned above
+    transforms.expand_function(H, plus_calls(H)[-1])
+
+    assert ast.unparse(G.ast_tree) == before
+    assert "t = plus(s, r)" in G.to_source()
+    assert "plus(s, r)" not in H.to_source()
+
+
+@CLASSES
+@pytest.mark.parametrize(
+    "name,sample",
+    [("expand", "test-expansion.py"), ("extract", "test-extraction.py"), ("remove", "test-redundant-vars.py")],
+)
+def test_copy_matches_deepcopy(cls, name, sample):
+    G = cls.from_file(os.path.join(SAMPLES, sample))
+    before = ast.unparse(G.ast_tree)
+    ids = list(G.our_nodes)
+
+    H = G.copy()
+    transform(H, name)
+    D = copy.deepcopy(G)
+    transform(D, name)
+
+    assert ast.unparse(G.ast_tree) == before
+    assert list(G.our_nodes) == ids
+    assert H.to_source() == D.to_source() != G.to_source()
+    assert list(H.our_edges) == list(D.our_edges)
+    for node_id, node in H.our_nodes.items():
+        assert node.ast_node is H.ast_nodes[node_id]
+
+    # and the original can still be transformed without touching the copy
+    transforms.remove_redundant_variables(G)
+    assert ast.dump(H.ast_tree) == ast.dump(D.ast_tree)
+
+
+def test_copy_shares_unchanged_nodes():
+    G = CodeGraph(ast.parse(CHAIN + "\ndef other():\n    return 1\n"))
+    H = G.copy()
+    with H.mutate(H.node_id(H.ast_tree.body[1])) as (other,):
+        other.body.append(ast.parse("x = 1").body[0])
+    main_id = G.node_id(G.ast_tree.body[0])
+    assert H.ast_nodes[main_id] is G.ast_nodes[main_id]
+    assert H.ast_tree is not G.ast_tree
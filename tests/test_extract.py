@@ -0,0 +1,137 @@
+import ast
+import copy
+
+import pytest
+
+from graph import CodeGraph
+from liveness import Liveness
+from transforms import extract_function, extract_functions
+
+
+SOURCE = """
+def f1(a, b):
+    x = a + 1
+    y = b * 2
+    if x > 3:
+        z = x + y
+    else:
+        z = x - y
+    t = 0
+    for i in range(z % 7):
+        t += i * x
+        if t > 100:
+            break
+    w = [t * k for k in range(3)]
+    q = sum(w) + y
+    del y
+    return q, t, z
+
+def f2(n):
+    acc = 0
+    i = 0
+    while i < n:
+        if i % 2:
+            last = i
+        acc += i
+        i += 1
+    try:
+        r = 10 // (n - 3)
+    except ZeroDivisionError as e:
+        r = -1
+    with open("/dev/null") as fh:
+        data = fh.read()
+    def inner():
+        return acc + 1
+    acc = acc * 2
+    s = inner()
+    return acc, r, s, data
+
+def f3(xs):
+    out = []
+    for x in xs:
+        y = x * 2
+        if y > 4:
+            out.append(y)
+        m = y
+    total = 0
+    total += len(out)
+    match total:
+        case 0:
+            kind = "none"
+        case n if n > 2:
+            kind = "many"
+        case _:
+            kind = "few"
+    return out, total, kind
+"""
+
+CASES = {"f1": [(1, 2), (5, 1), (10, 10)], "f2": [(0,), (3,), (7,)], "f3": [([],), ([1, 2, 3, 4],), ([5, 6, 7],)]}
+
+
+def results(tree):
+    # no fix_missing_locations: the transforms have to locate their nodes
+    namespace = {}
+    exec(compile(tree, "<extracted>", "exec"), namespace)
+    out = {}
+    for name, cases in CASES.items():
+        for args in cases:
+            try:
+                out[name, repr(args)] = namespace[name](*copy.deepcopy(args))
+            except Exception as e:
+                out[name, repr(args)] = type(e).__name__
+    return out
+
+
+def functions(G):
+    return {n.name: i for i, n in G.ast_nodes.items() if isinstance(n, ast.FunctionDef) and n.name in CASES}
+
+
+def bodies():
+    G = CodeGraph(ast.parse(SOURCE))
+    liveness = Liveness(G)
+    ids = functions(G)
+    nested = [
+        i for i, n in G.ast_nodes.items()
+        if isinstance(n, (ast.For, ast.While, ast.If)) and liveness.scope_of(i) in ids.values()
+    ]
+    return [(parent_id, region.start, region.end) for parent_id in [*ids.values(), *nested]
+            for region in liveness.regions(parent_id)]
+
+
+EXPECTED = results(ast.parse(SOURCE))
+
+
+@pytest.mark.parametrize("region", bodies())
+def test_every_region_keeps_behaviour(region):
+    G = CodeGraph(ast.parse(SOURCE))
+    extract_functions(G, [region])
+    assert results(G.ast_tree) == EXPECTED
+    assert results(ast.parse(G.to_source())) == EXPECTED
+
+
+def test_batch_extraction_matches_rebuild():
+    G = CodeGraph(ast.parse(SOURCE))
+    ids = functions(G)
+    extract_functions(G, [(ids["f1"], 0, 1), (ids["f1"], 3, 4), (ids["f3"], 0, 1)])
+    assert results(G.ast_tree) == EXPECTED
+    assert list(G.ast_nodes) == list(CodeGraph(copy.deepcopy(G.ast_tree)).ast_nodes)
+
+
+def test_region_reports_params_and_returns():
+    G = CodeGraph(ast.parse(SOURCE))
+    region = Liveness(G).region(functions(G)["f1"], 0, 1)
+    assert region.params == ["a", "b"]
+    assert sorted(region.returns) == ["x", "y"]
+
+
+def test_overlapping_regions_are_rejected():
+    G = CodeGraph(ast.parse(SOURCE))
+    f1 = functions(G)["f1"]
+    with pytest.raises(ValueError):
+        extract_functions(G, [(f1, 0, 2), (f1, 2, 3)])
+
+
+def test_region_with_escaping_control_flow_is_rejected():
+    G = CodeGraph(ast.parse(SOURCE))
+    with pytest.raises(ValueError):
+        extract_function(G, functions(G)["f1"], 8, 9)
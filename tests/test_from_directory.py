@@ -0,0 +1,56 @@
+import os
+import shutil
+
+import pytest
+
+from compact import CompactCodeGraph
+from conftest import SAMPLES
+from graph import CodeGraph
+
+
+CLASSES = pytest.mark.parametrize("cls", [CodeGraph, CompactCodeGraph], ids=lambda cls: cls.__name__)
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    for name in os.listdir(SAMPLES):
+        if name.endswith(".py"):
+            shutil.copy(os.path.join(SAMPLES, name), tmp_path)
+    (tmp_path / "package").mkdir()
+    shutil.copy(os.path.join(os.path.dirname(os.__file__), "textwrap.py"), tmp_path / "package")
+    (tmp_path / "package" / "broken.py").write_text("def f(:\n")
+    (tmp_path / "notes.txt").write_text("not python")
+    return tmp_path
+
+
+def expected(corpus):
+    return sorted(str(p) for p in corpus.rglob("*.py") if p.name != "broken.py")
+
+
+@CLASSES
+@pytest.mark.parametrize("workers", [0, 2])
+def test_from_directory(corpus, cls, workers):
+    errors = []
+    graphs = list(cls.from_directory(corpus, workers=workers, chunksize=2, on_error=lambda *e: errors.append(e)))
+    assert [filename for filename, _ in graphs] == expected(corpus)
+    assert [filename for filename, _ in errors] == [str(corpus / "package" / "broken.py")]
+    assert errors[0][1].startswith("SyntaxError")
+    for filename, G in graphs:
+        assert isinstance(G, cls)
+        reference = cls.from_file(filename)
+        assert list(G.ast_nodes) == list(reference.ast_nodes)
+        assert list(G.syntax_tokens) == list(reference.syntax_tokens)
+        assert G.to_source() == reference.to_source()
+
+
+def test_options(corpus):
+    with pytest.warns(RuntimeWarning, match="skipping"):
+        graphs = dict(
+            CodeGraph.from_directory(corpus, workers=0, layout="tidy", build_tokens=False)
+        )
+    for G in graphs.values():
+        assert G._pos is not None
+        assert not G.syntax_tokens
+    graphs = dict(CodeGraph.from_directory(corpus, pattern="test-*.py", workers=0))
+    assert sorted(graphs) == sorted(str(p) for p in corpus.glob("test-*.py"))
+    assert next(iter(graphs.values()))._pos is None
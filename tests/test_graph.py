@@ -0,0 +1,126 @@
+import ast
+import os
+import random
+
+import pytest
+
+from conftest import SAMPLES
+from graph import CodeGraph
+
+
+SOURCES = [os.path.join(SAMPLES, name) for name in sorted(os.listdir(SAMPLES)) if name.endswith(".py")]
+SOURCES.append(os.path.join(os.path.dirname(os.__file__), "textwrap.py"))
+
+# ast.parse shares one instance of each of these between the nodes
+SHARED = (ast.expr_context, ast.operator, ast.unaryop, ast.cmpop, ast.boolop)
+
+
+def parse(path):
+    with open(path) as f:
+        return CodeGraph(ast.parse(f.read()))
+
+
+def ast_parents(tree):
+    """
+    parent of every node but the shared ones
+    """
+    parents = {}
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            if not isinstance(child, SHARED):
+                parents[child] = node
+    return parents
+
+
+def ast_ancestors(parents, node):
+    ancestors = []
+    while node in parents:
+        node = parents[node]
+        ancestors.append(node)
+    return ancestors
+
+
+@pytest.mark.parametrize("path", SOURCES, ids=os.path.basename)
+def test_indexes(path):
+    G = parse(path)
+    parents = ast_parents(G.ast_tree)
+    for node in ast.walk(G.ast_tree):
+        if isinstance(node, SHARED):
+            continue
+        node_id = G.node_id(node)
+        parent = parents.get(node)
+        assert G.get_parent(node_id) == (G.node_id(parent) if parent is not None else None)
+        ancestors = [G.node_id(a) for a in ast_ancestors(parents, node)]
+        assert G.ancestors(node_id) == ancestors
+        assert G.depth(node_id) == len(ancestors)
+        assert [c for c in G.children(node_id) if not isinstance(G.ast_nodes[c], SHARED)] == [
+            G.node_id(c) for c in ast.iter_child_nodes(node) if not isinstance(c, SHARED)
+        ]
+        subtree = G.subtree(node_id)
+        assert subtree[0] == node_id
+        assert [i for i in subtree if not isinstance(G.ast_nodes[i], SHARED)] == [
+            G.node_id(n) for n in _preorder(node) if not isinstance(n, SHARED)
+        ]
+
+
+def _preorder(node):
+    yield node
+    for child in ast.iter_child_nodes(node):
+        yield from _preorder(child)
+
+
+@pytest.mark.parametrize("path", SOURCES, ids=os.path.basename)
+def test_lowest_common_ancestor(path):
+    G = parse(path)
+    parents = ast_parents(G.ast_tree)
+    nodes = [n for n in ast.walk(G.ast_tree) if not isinstance(n, SHARED)]
+    rng = random.Random(0)
+    for _ in range(200):
+        a, b = rng.choice(nodes), rng.choice(nodes)
+        chain = [a, *ast_ancestors(parents, a)]
+        above_b = {b, *ast_ancestors(parents, b)}
+        expected = next(n for n in chain if n in above_b)
+        assert G.lowest_common_ancestor(G.node_id(a), G.node_id(b)) == G.node_id(expected)
+
+
+def test_indexes_after_mutate():
+    G = parse(os.path.join(SAMPLES, "test-expansion.py"))
+    function_id = next(i for i, n in G.ast_nodes.items() if isinstance(n, ast.FunctionDef))
+    with G.mutate(function_id) as (function,):
+        function.body.insert(0, ast.parse("if x:\n    y = [z for z in x]").body[0])
+    rebuilt = CodeGraph(G.ast_tree)
+    for node_id in rebuilt.ast_nodes:
+        assert G.get_parent(node_id) == rebuilt.get_parent(node_id)
+        assert G.depth(node_id) == rebuilt.depth(node_id)
+        assert G.children(node_id) == rebuilt.children(node_id)
+
+
+def test_edges():
+    G = parse(os.path.join(SAMPLES, "test-extraction.py"))
+    edges = {(parent, child) for parent in G.ast_nodes for child in G.children(parent)}
+    assert set(G.edges) == edges
+    # the Load and Store contexts are left out of our_nodes and our_edges
+    contexts = {i for i, n in G.ast_nodes.items() if isinstance(n, (ast.Load, ast.Store))}
+    assert set(G.our_nodes) == set(G.ast_nodes) - contexts
+    assert set(G.our_edges) == {(parent, child) for parent, child in edges if child not in contexts}
+
+
+def test_deep_tree():
+    # built without recursion
+    expr = ast.Constant(1)
+    for _ in range(5000):
+        expr = ast.BinOp(expr, ast.Add(), ast.Constant(1))
+    G = CodeGraph(ast.Module([ast.Expr(expr)], []))
+    assert max(G.depth(i) for i in G.ast_nodes) > 5000
+    assert len(G.subtree(G.root_id)) == len(G.ast_nodes)
+
+
+def test_without_tokens():
+    path = os.path.join(SAMPLES, "test-extraction.py")
+    G = parse(path)
+    with open(path) as f:
+        H = CodeGraph(ast.parse(f.read()), build_tokens=False)
+    assert list(H.ast_nodes) == list(G.ast_nodes)
+    assert list(H.our_edges) == list(G.our_edges)
+    assert not H.syntax_tokens and not H.occurences
+    assert G.syntax_tokens
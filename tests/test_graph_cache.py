@@ -0,0 +1,102 @@
+import ast
+import copy
+import os
+import pickle
+
+import pytest
+
+from compact import CompactCodeGraph
+from conftest import SAMPLES
+from graph import CodeGraph
+from graph_cache import CachedCodeGraph, GraphCache
+
+
+@pytest.fixture
+def source():
+    with open(os.path.join(SAMPLES, "test-redundant-vars.py")) as file:
+        return file.read()
+
+
+def tokens(G):
+    return {k: (t.scope_id, [o.node_id for o in t.occurences]) for k, t in G.syntax_tokens.items()}
+
+
+@pytest.mark.parametrize("cls", [CodeGraph, CompactCodeGraph], ids=lambda cls: cls.__name__)
+def test_entry_matches_the_graph(tmp_path, source, cls):
+    cache = GraphCache(tmp_path)
+    G = cls(ast.parse(source))
+    G.pos
+    cache.put(source, G)
+
+    H = cache.get(source)
+    assert isinstance(H, CachedCodeGraph)
+    assert list(H.ast_nodes) == list(G.ast_nodes)
+    assert list(H.our_edges) == list(G.our_edges)
+    assert tokens(H) == tokens(G)
+    assert H.pos == G.pos
+    assert H.to_source() == G.to_source()
+
+
+def test_changed_source_misses(tmp_path, source):
+    cache = GraphCache(tmp_path)
+    cache.put(source, CompactCodeGraph(ast.parse(source)))
+    assert cache.get(source + "\nz = 1\n") is None
+
+
+@pytest.mark.parametrize(
+    "roundtrip",
+    [copy.deepcopy, lambda G: pickle.loads(pickle.dumps(G))],
+    ids=["deepcopy", "pickle"],
+)
+def test_roundtrip_after_to_source(tmp_path, source, roundtrip):
+    cache = GraphCache(tmp_path)
+    cache.put(source, CompactCodeGraph(ast.parse(source)))
+    G = cache.get(source)
+    text = G.to_source()
+    H = roundtrip(G)
+    assert H.to_source() == text
+    assert H.node_id(H.ast_tree.body[0]) == G.node_id(G.ast_tree.body[0])
+
+
+def test_mutating_a_copy_leaves_the_entry(tmp_path, source):
+    cache = GraphCache(tmp_path)
+    cache.put(source, CompactCodeGraph(ast.parse(source)))
+    G = cache.get(source)
+    H = G.copy()
+    function_id = next(i for i, n in H.ast_nodes.items() if isinstance(n, ast.FunctionDef))
+    with H.mutate(function_id) as (function,):
+        function.name = "renamed"
+    assert "renamed" in H.to_source()
+    assert "renamed" not in G.to_source()
+    assert "renamed" not in cache.get(source).to_source()
+
+
+def test_eviction(tmp_path, source):
+    cache = GraphCache(tmp_path)
+    for i in range(3):
+        text = source + f"\nx{i} = {i}\n"
+        cache.put(text, CompactCodeGraph(ast.parse(text)))
+    assert len(cache.entries()) == 3
+    cache.evict(cache.size() - 1)
+    assert len(cache.entries()) == 2
+    cache.clear()
+    assert cache.entries() == []
+
+
+def test_put_does_not_scan(tmp_path, source, monkeypatch):
+    scans = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, "scandir", lambda path: scans.append(path) or scandir(path))
+    cache = GraphCache(tmp_path)
+    G = CompactCodeGraph(ast.parse(source))
+    for i in range(10):
+        cache.put(source + f"\nx{i} = {i}\n", G)
+    cache.put(source + "\nx0 = 0\n", G)
+    assert len(scans) == 1
+    assert cache._size == cache.size()
+
+    # evicting scans the directory again
+    cache.max_bytes = cache._size // 2
+    cache.put(source, G)
+    assert len(scans) == 3
+    assert cache._size == cache.size() <= cache.max_bytes
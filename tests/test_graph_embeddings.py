@@ -0,0 +1,132 @@
+import ast
+import os
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torch_geometric")
+
+import graph_embeddings as ge  # noqa: E402
+from conftest import SAMPLES  # noqa: E402
+from graph import CodeGraph  # noqa: E402
+from metrics import qualified_functions  # noqa: E402
+
+
+SOURCE = os.path.join(os.path.dirname(os.__file__), "textwrap.py")
+
+
+@pytest.fixture(scope="module")
+def G():
+    with open(SOURCE) as f:
+        return CodeGraph(ast.parse(f.read()), build_tokens=False)
+
+
+def check(G, data, node_ids):
+    assert data.num_nodes == len(node_ids)
+    assert data.node_id.tolist() == node_ids
+    assert data.x.tolist() == [ge.NODE_TYPE_INDEX[G.ast_nodes[i].__class__.__name__] for i in node_ids]
+    edges = [(node_ids[p], node_ids[c]) for p, c in data.edge_index.t().tolist()]
+    assert edges == [(G.get_parent(i), i) for i in node_ids[1:]]
+    assert data.edge_type.tolist() == [ge.FIELD_INDEX[G.our_edges[edge].attrs[0]] for edge in edges]
+    for tensor in (data.x, data.edge_index, data.node_id, data.edge_type):
+        assert tensor.dtype == torch.int64
+
+
+def test_featurize(G):
+    data = ge.featurize(G, edge_fields=True)
+    check(G, data, list(G.our_nodes))
+    assert not hasattr(ge.featurize(G), "edge_type")
+
+
+def test_featurize_subtree(G):
+    function_id = next(i for i, n in G.ast_nodes.items() if isinstance(n, ast.FunctionDef))
+    data = ge.featurize(G, edge_fields=True, root_id=function_id)
+    check(G, data, [i for i in G.subtree(function_id) if i in G.our_nodes])
+
+
+class Unknown(ast.expr):
+    _fields = ()
+
+
+def test_unknown_types():
+    G = CodeGraph(ast.Module([ast.Expr(Unknown())], []), build_tokens=False)
+    data = ge.featurize(G, edge_fields=True)
+    assert data.x.tolist() == [ge.NODE_TYPE_INDEX["Module"], ge.NODE_TYPE_INDEX["Expr"], 0]
+
+
+def test_model():
+    with open(os.path.join(SAMPLES, "test-expansion.py")) as f:
+        data = ge.featurize(CodeGraph(ast.parse(f.read()), build_tokens=False))
+    model = ge.GraphConvModel(16, num_types=len(ge.AST_NODE_TYPES))
+    assert model(data.x, data.edge_index).shape == (data.num_nodes, 16)
+    # node features can still be given directly
+    features = torch.rand(data.num_nodes, 16)
+    assert model(features, data.edge_index).shape == (data.num_nodes, 16)
+
+
+@pytest.fixture(scope="module")
+def graphs():
+    paths = [os.path.join(SAMPLES, name) for name in sorted(os.listdir(SAMPLES)) if name.endswith(".py")]
+    return [CodeGraph.from_file(path, build_tokens=False) for path in paths + [SOURCE]]
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    return ge.GraphConvModel(16, num_types=len(ge.AST_NODE_TYPES))
+
+
+def test_batches_match_single_graphs(graphs, model):
+    batched = ge.embed_graphs(graphs, model, node_budget=500)
+    for G, embedding in zip(graphs, batched):
+        [single] = ge.embed_graphs([G], model, node_budget=10 ** 9)
+        assert embedding.dtype == np.float32
+        assert np.allclose(embedding, single, atol=1e-5)
+
+
+def test_embed_functions(graphs, model):
+    results = list(ge.GraphEmbedder(model, node_budget=200).embed_functions(graphs))
+    expected = [(G, node_id, qualname) for G in graphs for node_id, qualname in qualified_functions(G)]
+    assert [result[:3] for result in results] == expected
+    for G, node_id, _, embedding in results[:5]:
+        [single] = ge.embed_graphs([(G, node_id)], model)
+        assert np.allclose(embedding, single, atol=1e-5)
+
+
+def test_cache(graphs, model, tmp_path):
+    path = tmp_path / "embeddings.sqlite"
+    embedder = ge.GraphEmbedder(model, path)
+    first = list(embedder.embed_functions(graphs))
+    assert embedder.cache.hits == 0
+    # identical functions are embedded once
+    keys = {format(G.subtree_hash(node_id), "016x") for G, node_id, _, _ in first}
+    assert len(embedder.cache) == len(keys)
+
+    with ge.EmbeddingCache(path) as cache:
+        second = list(ge.GraphEmbedder(model, cache).embed_functions(graphs))
+        assert cache.misses == 0
+    for a, b in zip(first, second):
+        assert np.array_equal(a[3], b[3])
+
+    # other parameters, other embeddings
+    torch.manual_seed(1)
+    other = ge.GraphConvModel(16, num_types=len(ge.AST_NODE_TYPES))
+    assert ge.model_fingerprint(other) != ge.model_fingerprint(model)
+    with ge.EmbeddingCache(path) as cache:
+        list(ge.GraphEmbedder(other, cache).embed(graphs))
+        assert cache.hits == 0
+
+
+def test_model_state_restored(graphs, model):
+    threads = torch.get_num_threads()
+    model.train()
+    ge.embed_graphs(graphs[:1], model, threads=1)
+    assert model.training
+    assert torch.get_num_threads() == threads
+    # and between the embeddings of a partly consumed iterator
+    embeddings = ge.GraphEmbedder(model, threads=1).embed(graphs)
+    next(embeddings)
+    assert model.training
+    assert torch.get_num_threads() == threads
+    embeddings.close()
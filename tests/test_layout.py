@@ -0,0 +1,86 @@
+import ast
+import os
+import random
+from collections import defaultdict
+
+import pytest
+
+from conftest import SAMPLES
+from graph import CodeGraph
+from layout import tidy_tree_layout
+
+
+def random_tree(n, seed):
+    rng = random.Random(seed)
+    children = defaultdict(list)
+    for node in range(1, n):
+        children[rng.randrange(node)].append(node)
+    return dict(children)
+
+
+def check(root, children, pos, x_sep=150, y_sep=100):
+    depth = {root: 0}
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for child in children.get(node, ()):
+            depth[child] = depth[node] + 1
+        stack.extend(reversed(children.get(node, ())))
+    assert set(pos) == set(depth)
+    depth_max = max(depth.values())
+    assert min(x for x, _ in pos.values()) == 0
+    for node, (x, y) in pos.items():
+        assert y == (depth_max - depth[node]) * y_sep
+    # children left to right, parents centred above them
+    for node, nodes in children.items():
+        xs = [pos[c][0] for c in nodes]
+        assert xs == sorted(xs)
+        assert pos[node][0] == pytest.approx((xs[0] + xs[-1]) / 2)
+    # no overlap on a level
+    levels = defaultdict(list)
+    for node, (x, y) in pos.items():
+        levels[y].append(x)
+    for xs in levels.values():
+        xs.sort()
+        assert all(b - a >= x_sep - 1e-6 for a, b in zip(xs, xs[1:]))
+
+
+def test_small_trees():
+    assert tidy_tree_layout("a", {}) == {"a": (0, 0)}
+    assert tidy_tree_layout("a", {"a": ["b", "c"]}) == {"a": (75, 100), "b": (0, 0), "c": (150, 0)}
+    assert tidy_tree_layout(0, {0: [1], 1: [2]}, x_sep=10, y_sep=1) == {0: (0, 2), 1: (0, 1), 2: (0, 0)}
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_trees(seed):
+    children = random_tree(500, seed)
+    check(0, children, tidy_tree_layout(0, children))
+
+
+def test_identical_subtrees():
+    children = {"root": ["a", "b"], "a": ["a1", "a2"], "b": ["b1", "b2"], "a1": ["a3"], "b1": ["b3"]}
+    pos = tidy_tree_layout("root", children)
+    shift = pos["b"][0] - pos["a"][0]
+    for name in ("1", "2", "3"):
+        assert pos["b" + name] == (pos["a" + name][0] + shift, pos["a" + name][1])
+
+
+def test_deep_tree():
+    # no recursion
+    n = 50000
+    pos = tidy_tree_layout(0, {i: [i + 1] for i in range(n - 1)})
+    assert pos[0] == (0, (n - 1) * 100)
+
+
+def test_code_graph():
+    with open(os.path.join(SAMPLES, "test-extraction.py")) as f:
+        G = CodeGraph(ast.parse(f.read()))
+    # computed when first used
+    assert G._pos is None
+    check(G.root_id, {i: G.children(i) for i in G.ast_nodes if G.children(i)}, G.pos)
+    assert set(G.pos_inv) == set(G.pos) | set(G.syntax_tokens)
+
+    G.layout = "other"
+    G.refresh()
+    with pytest.raises(ValueError):
+        G.pos
@@ -0,0 +1,112 @@
+import ast
+import os
+
+import pytest
+from radon.metrics import h_visit
+
+import transforms
+from conftest import SAMPLES
+from graph import CodeGraph
+from metrics import GraphMetrics, calculate_metrics
+
+
+STDLIB = os.path.dirname(os.__file__)
+FILES = [os.path.join(SAMPLES, name) for name in sorted(os.listdir(SAMPLES)) if name.endswith(".py")] + [
+    os.path.join(STDLIB, name) for name in ("textwrap.py", "shlex.py", "fractions.py", "dataclasses.py")
+]
+
+SOURCE = '''
+"""module
+docstring"""
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def fib(n: int) -> int:
+    """cached"""
+    if n < 2 and n >= 0 or n is None:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+
+class A:
+    x: int = 1
+
+    def method(self, items):
+        try:
+            total = sum(i ** 2 for i in items if i % 2)
+        except (TypeError, ValueError):
+            total = -1
+        else:
+            total += 1
+        finally:
+            pass
+        while total > 10:
+            total //= 2
+        return {k: v for k, v in zip(items[1:], items[:-1])} if total else lambda: total
+
+    async def run(self):
+        async with self.lock as lock:
+            async for item in self.items():
+                assert item, "empty"
+        return [x for x in range(3)]
+
+
+def outer():
+    def inner(a, *args, b=2, **kwargs):
+        match a:
+            case [1, 2]:
+                return 1
+            case {"k": v} if v:
+                return v
+            case _:
+                return not a
+    return inner
+'''
+
+
+def check(G, metrics):
+    source = G.to_source()
+    expected = calculate_metrics(source)
+    result = metrics(G)
+    for key, value in expected.items():
+        assert result[key] == pytest.approx(value), key
+    assert result["Halstead Volume"] == pytest.approx(h_visit(source).total.volume)
+
+
+@pytest.mark.parametrize("path", FILES, ids=os.path.basename)
+def test_parity_with_radon(path):
+    with open(path) as f:
+        # the lines are counted in the text printed by to_source
+        G = CodeGraph(ast.parse(CodeGraph(ast.parse(f.read())).to_source()))
+    check(G, GraphMetrics())
+
+
+def test_parity_with_radon_constructs():
+    check(CodeGraph(ast.parse(SOURCE)), GraphMetrics())
+
+
+def test_function_cache():
+    metrics = GraphMetrics()
+    G = CodeGraph(ast.parse(SOURCE))
+    check(G, metrics)
+    metrics.hits = metrics.misses = 0
+    check(G, metrics)
+    assert metrics.misses == 0
+
+    # only the changed function is counted again
+    node_id = next(i for i, n in G.ast_nodes.items() if isinstance(n, ast.FunctionDef) and n.name == "fib")
+    with G.mutate(node_id) as (node,):
+        node.body.append(ast.parse("x = n + 1").body[0])
+    metrics.hits = metrics.misses = 0
+    check(G, metrics)
+    assert metrics.misses == 1
+
+
+def test_after_transform():
+    with open(os.path.join(SAMPLES, "test-expansion.py")) as f:
+        G = CodeGraph(ast.parse(f.read()))
+    metrics = GraphMetrics()
+    check(G, metrics)
+    transforms.expand_all_calls(G)
+    check(G, metrics)
@@ -0,0 +1,46 @@
+import ast
+import copy
+import os
+import pickle
+
+import pytest
+
+from compact import CompactCodeGraph
+from conftest import SAMPLES
+from graph import CodeGraph
+
+
+def roundtrips():
+    return [
+        ("deepcopy", copy.deepcopy),
+        ("pickle", lambda G: pickle.loads(pickle.dumps(G))),
+    ]
+
+
+@pytest.fixture(params=[CodeGraph, CompactCodeGraph], ids=lambda cls: cls.__name__)
+def graph(request):
+    return request.param.from_file(os.path.join(SAMPLES, "test-expansion.py"))
+
+
+def test_ids_do_not_depend_on_the_objects(graph):
+    other = type(graph).from_file(os.path.join(SAMPLES, "test-expansion.py"))
+    assert list(graph.ast_nodes) == list(other.ast_nodes)
+    assert list(graph.our_edges) == list(other.our_edges)
+
+
+@pytest.mark.parametrize("name,roundtrip", roundtrips(), ids=[n for n, _ in roundtrips()])
+def test_roundtrip_after_to_source(graph, name, roundtrip):
+    # to_source() fills the id() -> node id map, it must not survive the round trip
+    source = graph.to_source()
+    G = roundtrip(graph)
+    assert G.to_source() == source
+    node = G.ast_tree.body[0]
+    assert G.node_id(node) == graph.node_id(graph.ast_tree.body[0])
+
+
+def test_copy_resolves_its_own_nodes(graph):
+    graph.to_source()
+    G = graph.copy()
+    call = next(k for k, n in G.ast_nodes.items() if isinstance(n, ast.Call))
+    node = G.mutable(call)
+    assert G.node_id(node) == call
@@ -0,0 +1,95 @@
+import ast
+
+import pytest
+
+from graph import CodeGraph
+from passes import ExpandFunctionPass, Pass, PassManager, RemoveRedundantVariablesPass
+from transforms import expand_function, remove_redundant_variables
+
+
+SOURCE = """
+def f(x, y):
+    t = 3
+    return x + y
+
+def g(a):
+    unused = 5
+    z = f(a, 2)
+    return z
+"""
+
+
+class Renamer(ast.NodeTransformer):
+    def visit_Name(self, node):
+        if node.id == "a":
+            node.id = "b"
+        return node
+
+    def visit_arg(self, node):
+        if node.arg == "a":
+            node.arg = "b"
+        return node
+
+
+def call_id(G):
+    return next(i for i, n in G.ast_nodes.items() if isinstance(n, ast.Call))
+
+
+def test_pass_without_run_cannot_be_created():
+    class Incomplete(Pass):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_pipeline_matches_chained_transforms():
+    G1 = CodeGraph(ast.parse(SOURCE))
+    expand_function(G1, call_id(G1))
+    remove_redundant_variables(G1)
+
+    G2 = CodeGraph(ast.parse(SOURCE))
+    PassManager([ExpandFunctionPass(call_id(G2)), RemoveRedundantVariablesPass()]).run(G2)
+    assert ast.dump(G1.ast_tree) == ast.dump(G2.ast_tree)
+
+
+def test_transformers_share_one_refresh():
+    G = CodeGraph(ast.parse(SOURCE))
+    manager = PassManager([Renamer(), Renamer(), Renamer()])
+    manager.run(G)
+    assert [name for name, _ in manager.timings].count("refresh") == 1
+    assert list(G.ast_nodes) == list(CodeGraph(ast.parse(ast.unparse(G.ast_tree))).ast_nodes)
+
+
+def test_pipeline_on_copy_leaves_original():
+    G = CodeGraph(ast.parse(SOURCE))
+    before = ast.dump(G.ast_tree)
+    H = G.copy()
+    PassManager([Renamer(), RemoveRedundantVariablesPass()]).run(H)
+    assert ast.dump(G.ast_tree) == before
+    assert "unused" not in ast.unparse(H.ast_tree)
+
+
+def test_analyses_are_computed_again_only_when_invalidated():
+    calls = []
+    manager = PassManager()
+    manager.register_analysis("count", lambda G: calls.append(1) or len(G.ast_nodes))
+    manager.register_analysis("double", lambda G: 2 * manager.analysis("count"), requires=("count",))
+
+    class Use(Pass):
+        requires = ("double",)
+        invalidates = ()
+
+        def run(self, G, manager):
+            return ()
+
+    class Invalidate(Pass):
+        requires = ()
+        invalidates = ("count",)
+
+        def run(self, G, manager):
+            return ()
+
+    manager.add(Use()).add(Use()).add(Invalidate()).add(Use())
+    manager.run(CodeGraph(ast.parse(SOURCE)))
+    assert len(calls) == 2
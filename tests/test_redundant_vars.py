@@ -0,0 +1,152 @@
+import ast
+import os
+
+import pytest
+
+from conftest import SAMPLES
+from graph import CodeGraph
+from redundant_vars import find_redundant_variables, remove_redundant_variables
+
+
+CASES = {
+    "chain": """
+def main():
+    a = 1
+    b = a
+    c = b + 1
+    return 0
+""",
+    "side_effects": """
+calls = []
+
+def f(x):
+    calls.append(x)
+    return x
+
+def main():
+    x = f(1)
+    y, z = f(2), 3
+    return len(calls)
+""",
+    "augmented": """
+def main():
+    total = 0
+    for i in range(3):
+        total += i
+    n: int = 4
+    return 1
+""",
+    "deleted": """
+def main():
+    x = 1
+    y = 2
+    del x, y
+    return 2
+""",
+    "emptied": """
+def main():
+    for i in range(2):
+        unused = i
+    return 3
+""",
+    "closure": """
+def main():
+    x = 4
+    def inner():
+        return x
+    return inner()
+""",
+    "dynamic": """
+def main():
+    x = 5
+    return len(locals())
+""",
+}
+
+REMAINING = {
+    "chain": set(),
+    "side_effects": {"calls", "f", "len"},
+    "augmented": {"range"},
+    "deleted": set(),
+    "emptied": {"range"},
+    "closure": {"x", "inner"},
+    "dynamic": {"x", "locals", "len"},
+}
+
+
+def names(tree, function="main"):
+    main = next(n for n in ast.walk(tree) if isinstance(n, ast.FunctionDef) and n.name == function)
+    return {n.id for n in ast.walk(main) if isinstance(n, ast.Name)}
+
+
+def run(source):
+    namespace = {}
+    exec(compile(source, "<test>", "exec"), namespace)
+    return namespace["main"]()
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_remove(case):
+    G = CodeGraph(ast.parse(CASES[case]))
+    remove_redundant_variables(G)
+    source = G.to_source()
+    assert run(source) == run(CASES[case])
+    assert names(ast.parse(source)) - {"i"} == REMAINING[case]
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_idempotent(case):
+    G = CodeGraph(ast.parse(CASES[case]))
+    remove_redundant_variables(G)
+    # the unread loop variables are dead but a for loop is not removed
+    assert find_redundant_variables(G) <= {"i"}
+    source = G.to_source()
+    remove_redundant_variables(G)
+    assert G.to_source() == source
+    # the incremental refresh leaves the graph as a full build of the result would
+    rebuilt = CodeGraph(ast.parse(source))
+    assert set(G.ast_nodes) == set(rebuilt.ast_nodes)
+
+
+def test_side_effects_kept():
+    G = CodeGraph(ast.parse(CASES["side_effects"]))
+    remove_redundant_variables(G)
+    assert "f(1)" in G.to_source()
+    assert "f(2)" in G.to_source()
+
+
+def test_sample():
+    with open(os.path.join(SAMPLES, "test-redundant-vars.py")) as f:
+        G = CodeGraph(ast.parse(f.read()))
+    assert find_redundant_variables(G) == {"unused_var"}
+    remove_redundant_variables(G)
+    assert "unused_var" not in G.to_source()
+    assert run(G.to_source()) == 5
+
+
+NONLOCAL = """
+def outer():
+    x = 1
+    def inner():
+        nonlocal x
+        x = 2
+    inner()
+    return 0
+
+def main():
+    y = 0
+    def inner():
+        global z
+        z = 1
+    [(y := i) for i in range(3)]
+    return outer()
+"""
+
+
+def test_nested_stores_kept():
+    G = CodeGraph(ast.parse(NONLOCAL))
+    remove_redundant_variables(G)
+    source = G.to_source()
+    compile(source, "<test>", "exec")
+    assert run(source) == 0
+    assert {"x = 1", "x = 2", "y = 0"} <= {line.strip() for line in source.splitlines()}
@@ -0,0 +1,126 @@
+import ast
+import os
+
+import pytest
+
+import graph
+import transforms
+from conftest import SAMPLES
+from graph import CodeGraph
+
+
+NESTED = """
+def main(a):
+    def inner(x):
+        def deep(q):
+            return q < x < 3
+        return x + a
+    b = inner(a) + -a
+    return b
+"""
+
+
+def snapshot(G: CodeGraph):
+    """
+    everything a refresh computes, in order
+    """
+    return (
+        list(G.ast_nodes),
+        list(G.our_nodes),
+        list(G.our_edges),
+        dict(G._parents),
+        {k: list(v) for k, v in G._children.items()},
+        dict(G._depth),
+        list(G.syntax_tokens),
+        {t.id: [o.id for o in t.occurences] for t in G.syntax_tokens.values()},
+        list(G.occurences),
+        G.to_source(),
+    )
+
+
+def assert_same_as_rebuild(G: CodeGraph):
+    incremental = snapshot(G)
+    G.refresh()
+    assert snapshot(G) == incremental
+
+
+@pytest.mark.parametrize("name", ["test-expansion.py", "test-extraction.py", "test-redundant-vars.py"])
+def test_transforms_match_full_refresh(name):
+    G = CodeGraph.from_file(os.path.join(SAMPLES, name))
+    if name == "test-expansion.py":
+        call = next(k for k, n in G.ast_nodes.items() if isinstance(n, ast.Call))
+        transforms.expand_function(G, call)
+    elif name == "test-extraction.py":
+        transforms.extract_function(G, G.node_id(G.ast_tree.body[0]), 1, 2)
+    else:
+        transforms.remove_redundant_variables(G)
+    assert_same_as_rebuild(G)
+
+
+def test_mutate_insert_replace_delete():
+    G = CodeGraph(ast.parse(NESTED))
+    inner = G.ast_tree.body[0].body[0]
+    with G.mutate(G.node_id(inner)):
+        inner.body.insert(0, ast.parse("y = x * 2").body[0])
+    assert_same_as_rebuild(G)
+
+    deep = inner.body[1]
+    with G.mutate(G.node_id(deep), G.node_id(inner)):
+        deep.body[0].value = ast.Name(id="zz", ctx=ast.Load())
+    assert_same_as_rebuild(G)
+
+    with G.mutate(G.node_id(inner)):
+        del inner.body[1]
+    assert_same_as_rebuild(G)
+    assert "zz" not in G.to_source()
+
+
+def test_rebinding_updates_tokens():
+    G = CodeGraph(ast.parse("x = 1\ndef f():\n    return x\n"))
+    f = G.ast_tree.body[1]
+    with G.mutate(G.node_id(f)):
+        f.body.insert(0, ast.parse("x = 2").body[0])
+    # the x read in f is now bound in f, not in the module
+    assert_same_as_rebuild(G)
+    scopes = {t.scope_id for t in G.syntax_tokens.values() if t.attrs["name"] == "x"}
+    assert scopes == {G.root_id, G.node_id(f)}
+
+
+def test_untouched_nodes_kept(monkeypatch):
+    G = CodeGraph.from_file(os.path.join(os.path.dirname(os.__file__), "textwrap.py"))
+    method = next(
+        n for n in ast.walk(G.ast_tree) if isinstance(n, ast.FunctionDef) and n.name == "_split"
+    )
+    method_id = G.node_id(method)
+    inside = set(G.subtree(method_id))
+    nodes, edges = dict(G.our_nodes), dict(G.our_edges)
+    tokens, occurences = dict(G.syntax_tokens), dict(G.occurences)
+
+    visited = []
+    enter = graph.enter
+    monkeypatch.setattr(graph, "enter", lambda node, *args: visited.append(node) or enter(node, *args))
+    with G.mutate(method_id):
+        method.body.insert(0, ast.parse("total = len(text)").body[0])
+    # only the new subtree is walked
+    assert len(visited) == len(G.subtree(method_id))
+
+    for node_id, node in nodes.items():
+        if node_id not in inside:
+            assert G.our_nodes[node_id] is node
+    for key, edge in edges.items():
+        if key[1] not in inside:
+            assert G.our_edges[key] is edge
+    # the bindings without occurences in the method are the same objects, len gains one
+    kept = [
+        t for t in tokens.values()
+        if t.name != "len" and not inside & {o.node_id for o in t.occurences}
+    ]
+    assert len(kept) > len(tokens) // 2
+    for token in kept:
+        assert G.syntax_tokens[token.id] is token
+        for node in token.occurences:
+            assert G.occurences[(token.id, node.node_id)] is occurences[(token.id, node.node_id)]
+    len_id = f"stx_len_{G.root_id}"
+    assert G.syntax_tokens[len_id] is not tokens[len_id]
+    assert len(G.syntax_tokens[len_id].uses) == len(tokens[len_id].uses) + 1
+    assert_same_as_rebuild(G)
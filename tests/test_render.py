@@ -0,0 +1,115 @@
+import ast
+import io
+import math
+import struct
+import zlib
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import render
+from graph import CodeGraph
+from style import DetailParams, OurGraphToXML
+
+
+SOURCE = """
+def f(a):
+    x = a + 1
+    return x
+"""
+
+SVG = "{http://www.w3.org/2000/svg}"
+
+
+@pytest.fixture
+def G():
+    return CodeGraph(ast.parse(SOURCE))
+
+
+def document(G, **kwargs):
+    file = io.StringIO()
+    OurGraphToXML().write(G, file, **kwargs)
+    return file.getvalue()
+
+
+def read_png(data):
+    """
+    width, height and rows of RGB pixels of a PNG written by Raster
+    """
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    chunks = {}
+    offset = 8
+    while offset < len(data):
+        (length,) = struct.unpack(">I", data[offset : offset + 4])
+        kind = data[offset + 4 : offset + 8]
+        body = data[offset + 4 : offset + 8 + length]
+        (crc,) = struct.unpack(">I", data[offset + 8 + length : offset + 12 + length])
+        assert zlib.crc32(body) & 0xFFFFFFFF == crc
+        chunks[kind] = body[4:]
+        offset += 12 + length
+    assert list(chunks) == [b"IHDR", b"IDAT", b"IEND"]
+    width, height = struct.unpack(">II", chunks[b"IHDR"][:8])
+    raw = zlib.decompress(chunks[b"IDAT"])
+    stride = 3 * width + 1
+    assert len(raw) == height * stride
+    rows = [raw[y * stride + 1 : (y + 1) * stride] for y in range(height)]
+    return width, height, rows
+
+
+def test_load_cells(G):
+    vertices, edges = render.load_cells(document(G))
+    assert set(vertices) == {str(i) for i in G.our_nodes} | set(G.syntax_tokens)
+    assert len(edges) == len(G.our_edges) + len(G.occurences)
+    compressed = render.load_cells(document(G, compressed=True))
+    assert set(compressed[0]) == set(vertices)
+    assert len(compressed[1]) == len(edges)
+
+
+def test_pages(G):
+    pages = document(G, detail=DetailParams(split_functions=True))
+    vertices, _ = render.load_cells(pages, page="f")
+    assert str(G.node_id(G.ast_tree.body[0])) in vertices
+    assert render.load_cells(pages, page=1)[0].keys() == vertices.keys()
+    with pytest.raises(ValueError):
+        render.load_cells(pages, page="g")
+
+
+def test_svg(G, tmp_path):
+    output = render.render(G, str(tmp_path / "graph.svg"))
+    root = ET.parse(output).getroot()
+    vertices, edges = render.load_cells(document(G))
+    # the background and one rectangle per vertex
+    assert len(root.findall(f"{SVG}rect")) == len(vertices) + 1
+    assert len(root.findall(f"{SVG}polyline")) == len(edges)
+    texts = {"".join(t.itertext()) for t in root.iter(f"{SVG}text")}
+    assert "FunctionDefname: f" in texts
+
+
+def test_png(G, tmp_path):
+    vertices, edges = render.load_cells(document(G))
+    width, height, rows = read_png(render.to_png(vertices, edges, scale=0.5))
+    x0, y0, x1, y1 = render._bounds(vertices)
+    assert width == math.ceil((x1 - x0 + 2 * render.MARGIN) * 0.5)
+    assert height == math.ceil((y1 - y0 + 2 * render.MARGIN) * 0.5)
+    assert rows[0][:3] == b"\xff\xff\xff"
+    # the fill of a cell is drawn inside it
+    cell = next(c for c in vertices.values() if c.style.get("fillColor") not in (None, "#FFFFFF"))
+    x = int((cell.x - x0 + render.MARGIN + 4) * 0.5)
+    y = int((cell.y - y0 + render.MARGIN + cell.height / 2) * 0.5)
+    assert bytes(rows[y][3 * x : 3 * x + 3]) == bytes(render.parse_color(cell.style["fillColor"]))
+
+    # the size is capped
+    width, height, _ = read_png(render.to_png(vertices, edges, scale=10, max_size=300))
+    assert max(width, height) <= 300
+    render.render(G, str(tmp_path / "graph.png"), scale=0.5)
+    assert (tmp_path / "graph.png").read_bytes() == render.to_png(vertices, edges, scale=0.5)
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_render_many(G, tmp_path, workers):
+    jobs = [(G, str(tmp_path / f"{i}.svg")) for i in range(3)]
+    jobs.append((str(tmp_path / "missing.drawio"), str(tmp_path / "missing.svg")))
+    results = dict(render.render_many(jobs, workers=workers))
+    assert set(results) == {output for _, output in jobs}
+    assert [output for output, error in results.items() if error] == [str(tmp_path / "missing.svg")]
+    assert (tmp_path / "0.svg").read_text() == (tmp_path / "2.svg").read_text()
@@ -0,0 +1,135 @@
+import ast
+import os
+import symtable
+
+import pytest
+
+from compact import CompactCodeGraph
+from graph import CodeGraph
+
+
+SOURCE = '''
+import os.path as p, sys
+from x import *
+counter = 0
+def deco(f): return f
+@deco
+def outer(a, b=counter, *args, k: int = 1, **kw) -> sys.T:
+    global counter
+    counter += 1
+    c = [a * i for i in range(b) if i > c0]
+    c0 = 1
+    lam = lambda y, z=a: y + z + c
+    def inner():
+        nonlocal a
+        a = 2
+        return a + b + print
+    class K(object):
+        a = b
+        def m(self): return a, K
+    if (n := len(c)) > 1:
+        pass
+    try:
+        pass
+    except E as err:
+        err
+    match kw:
+        case {"k": v, **rest}: v, rest
+        case [h, *t]: h, t
+        case Q(x=w) as whole: w, whole
+    return inner, K, lam, n, p
+async def af(q):
+    async for r in q: await r
+gen = {s: t for s in range(3) for t in range(s)}
+'''
+
+STDLIB = os.path.dirname(os.__file__)
+MODULES = ["textwrap.py", "shlex.py", "dataclasses.py", "fractions.py"]
+
+
+def read(name):
+    if name == "snippet":
+        return SOURCE
+    with open(os.path.join(STDLIB, name)) as f:
+        return f.read()
+
+
+def tables(table):
+    yield table
+    for child in table.get_children():
+        yield from tables(child)
+
+
+def find(G, node_type, name):
+    return next(
+        i for i, n in G.ast_nodes.items() if isinstance(n, node_type) and getattr(n, "name", None) == name
+    )
+
+
+@pytest.mark.parametrize("name", ["snippet", *MODULES])
+def test_locals_match_symtable(name):
+    source = read(name)
+    G = CodeGraph(ast.parse(source))
+    scopes = [i for i in G.lookup if not isinstance(G.ast_nodes[i], ast.Module)]
+    expected = [t for t in tables(symtable.symtable(source, name, "exec")) if t.get_type() != "module"]
+    assert [getattr(G.ast_nodes[i], "lineno", None) for i in scopes] == [t.get_lineno() for t in expected]
+    for scope_id, table in zip(scopes, expected):
+        names = {s.get_name() for s in table.get_symbols() if s.is_local() and not s.get_name().startswith(".")}
+        assert set(G.lookup[scope_id]) == names
+
+    module = symtable.symtable(source, name, "exec")
+    bound = {s.get_name() for s in module.get_symbols() if s.is_assigned() or s.is_imported() or s.is_namespace()}
+    # names bound in functions by global statements are module bindings as well
+    for table in tables(module):
+        bound.update(s.get_name() for s in table.get_symbols() if s.is_declared_global() and s.is_assigned())
+    assert {n for n, token in G.lookup[G.root_id].items() if token.defs} == bound
+
+
+def test_def_use():
+    G = CodeGraph(ast.parse(SOURCE))
+    symbols = G.symbols
+    outer, inner = find(G, ast.FunctionDef, "outer"), find(G, ast.FunctionDef, "inner")
+    method = find(G, ast.FunctionDef, "m")
+
+    def uses_in(scope_id, name):
+        subtree = set(G.subtree(scope_id))
+        return [
+            i for i in subtree
+            if isinstance(G.ast_nodes[i], ast.Name) and G.ast_nodes[i].id == name
+            and isinstance(G.ast_nodes[i].ctx, ast.Load)
+        ]
+
+    # nonlocal and free names resolve to the enclosing function
+    a = symbols.bindings(outer)["a"]
+    assert a.scope_id == outer
+    assert set(uses_in(inner, "a")) <= set(a.uses)
+    assert symbols.binding(uses_in(inner, "b")[0]) is symbols.bindings(outer)["b"]
+    # class scopes are skipped by the functions defined in them
+    assert symbols.binding(uses_in(method, "a")[0]) is a
+    # global declarations bind at module level, builtins are unresolved module names
+    counter = symbols.bindings(G.root_id)["counter"]
+    assert len(counter.defs) == 2
+    assert not symbols.bindings(G.root_id)["print"].defs
+    # the iterable of the first generator is evaluated outside of the comprehension
+    comprehension = next(i for i, n in G.ast_nodes.items() if isinstance(n, ast.ListComp))
+    assert "b" not in symbols.bindings(comprehension)
+    assert symbols.binding(uses_in(comprehension, "b")[0]) is symbols.bindings(outer)["b"]
+    for node_id in a.uses:
+        assert node_id in symbols.uses(a.defs[0])
+        assert symbols.defs(node_id) == a.defs
+
+
+def test_compact_and_refresh():
+    G = CodeGraph(ast.parse(SOURCE))
+    C = CompactCodeGraph(ast.parse(SOURCE))
+    assert [list(v) for v in C.lookup.values()] == [list(v) for v in G.lookup.values()]
+
+    inner = find(G, ast.FunctionDef, "inner")
+    # a global declaration in inner changes the bindings of the module
+    with G.mutate(inner) as (function,):
+        function.body.insert(0, ast.Global(names=["b"]))
+    rebuilt = CodeGraph(G.ast_tree)
+    for scope_id, tokens in rebuilt.lookup.items():
+        assert {n: (t.defs, t.uses) for n, t in G.lookup[scope_id].items()} == {
+            n: (t.defs, t.uses) for n, t in tokens.items()
+        }
@@ -0,0 +1,87 @@
+import ast
+
+import pytest
+
+from search import Search, evaluate, maintainability, search, simplicity
+
+
+SOURCE = '''
+def add(x, y):
+    return x + y
+
+def process(items, scale):
+    total = 0
+    unused = 42
+    for item in items:
+        if item > 0:
+            total += item * scale
+        elif item < -10:
+            total -= item
+        else:
+            total += 1
+    count = len(items)
+    mean = total / count
+    spread = max(items) - min(items)
+    ratio = spread / (mean + 1)
+    extra = add(ratio, 2)
+    result = extra * 2
+    return result
+'''
+
+
+def run(source):
+    namespace = {}
+    exec(compile(source, "<test>", "exec"), namespace)
+    return namespace["process"]([3, -20, 0, 5], 2)
+
+
+def replay(result):
+    source = result.initial.source
+    for move in result.moves:
+        source = evaluate(source, move, maintainability, 3)[0]
+    return source
+
+
+@pytest.mark.parametrize("strategy", ["beam", "best"])
+def test_search(strategy):
+    result = search(SOURCE, strategy=strategy, max_depth=2, workers=0)
+    assert result.stopped == "exhausted"
+    assert result.best.score >= result.initial.score
+    assert result.best.depth == len(result.moves) <= 2
+    # the best code is reached again by its moves, and behaves as the original
+    assert replay(result) == result.best.source
+    assert run(result.best.source) == run(SOURCE)
+    assert result.evaluated > 1
+    assert result.report().startswith(f"evaluated {result.evaluated} states")
+
+
+def test_states_are_memoised():
+    search_ = Search(max_depth=3, beam_width=8, workers=0)
+    result = search_.run(SOURCE)
+    # every state is kept once, by the hash of its ast
+    assert len(search_._seen) == result.evaluated - result.duplicates - result.failed
+    assert result.duplicates > 0
+
+
+def test_limits():
+    result = search(SOURCE, max_depth=10, max_states=5, workers=0)
+    assert result.stopped == "max_states"
+    assert result.evaluated == 5
+    result = search(SOURCE, max_depth=10, time_limit=0, workers=0)
+    assert result.stopped == "time_limit"
+    assert result.evaluated == 1
+
+
+def test_workers():
+    serial = search(SOURCE, max_depth=2, workers=0, score=simplicity)
+    parallel = search(SOURCE, max_depth=2, workers=2, score=simplicity)
+    assert parallel.best.score == serial.best.score
+    assert parallel.evaluated == serial.evaluated
+
+
+def test_errors():
+    with pytest.raises(ValueError):
+        Search(strategy="other")
+    with pytest.raises(ValueError):
+        search("def f(:\n", workers=0)
+    assert ast.parse(search("x = 1\n", workers=0).best.source)
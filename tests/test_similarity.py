@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+from similarity import Location, SimilarityIndex
+
+
+def make_index(n=500, dim=16, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(n, dim))
+    locations = [Location(f"file{i % 7}.py", f"f{i}", i, i + 1) for i in range(n)]
+    index = SimilarityIndex(dim)
+    index.add(vectors, locations)
+    return index, vectors
+
+
+def brute_force(index, queries, k):
+    vectors = index.vectors / np.linalg.norm(index.vectors, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    scores = queries @ vectors.T
+    scores[:, ~index._alive[: index._size]] = -np.inf
+    return [list(np.argsort(-row, kind="stable")[:k]) for row in scores]
+
+
+def ids(results):
+    return [[i for _, i in row] for row in results]
+
+
+def test_exact_search(monkeypatch):
+    # several blocks
+    monkeypatch.setattr("similarity.BLOCK", 64)
+    index, vectors = make_index()
+    queries = np.random.default_rng(1).normal(size=(5, 16))
+    assert ids(index.search(queries, k=10)) == brute_force(index, queries, 10)
+    assert ids(index.search(vectors[:3], k=1)) == [[0], [1], [2]]
+
+
+def test_approximate_search():
+    index, _ = make_index(n=2000)
+    index.build_clusters()
+    queries = np.random.default_rng(1).normal(size=(20, 16))
+    exact = ids(index.search(queries, k=10))
+    approximate = ids(index.search(queries, k=10, n_probe=len(index.centroids) // 2))
+    recall = np.mean([len(set(a) & set(e)) / 10 for a, e in zip(approximate, exact)])
+    assert recall > 0.7
+    # every cluster probed
+    assert ids(index.search(queries, k=10, n_probe=len(index.centroids))) == exact
+    assert ids(index.search(queries, k=10, n_probe=len(index.centroids) + 5)) == exact
+    for n_probe in (0, -1):
+        with pytest.raises(ValueError):
+            index.search(queries, k=10, n_probe=n_probe)
+
+
+def test_remove():
+    index, vectors = make_index()
+    assert index.remove_file("file3.py") == len(range(3, 500, 7))
+    assert index.remove_file("file3.py") == 0
+    index.remove([0, 1])
+    assert len(index) == 500 - len(range(3, 500, 7)) - 2
+    assert "file3.py" not in index._by_file
+    assert 0 not in index._by_file["file0.py"]
+    with pytest.raises(KeyError):
+        index.remove([0])
+    with pytest.raises(KeyError):
+        index.remove([2, 2])
+    with pytest.raises(KeyError):
+        index.remove([500])
+    # nothing removed by a failed call
+    assert index._alive[2]
+
+    queries = vectors[:20]
+    assert ids(index.search(queries, k=5)) == brute_force(index, queries, 5)
+    found = {i for row in ids(index.search(queries, k=50)) for i in row}
+    assert not found & ({0, 1} | set(range(3, 500, 7)))
+
+
+def test_compact():
+    index, vectors = make_index()
+    index.remove_file("file3.py")
+    alive = np.flatnonzero(index._alive[: index._size])
+    queries = vectors[:10]
+    before = ids(index.search(queries, k=5))
+    rows = index.compact()
+    assert list(rows) == list(alive)
+    assert len(index) == len(index.vectors) == len(alive)
+    assert [[rows[i] for i in row] for row in ids(index.search(queries, k=5))] == before
+    assert all(index.locations[i].filename == filename for filename, rows in index._by_file.items() for i in rows)
+
+
+def test_save_load(tmp_path):
+    index, vectors = make_index()
+    index.build_clusters()
+    index.remove_file("file3.py")
+    queries = vectors[:10]
+    before = [[index.locations[i] for i in row] for row in ids(index.search(queries, k=5, n_probe=4))]
+    index.save(str(tmp_path))
+
+    loaded = SimilarityIndex.load(str(tmp_path))
+    assert isinstance(loaded._vectors, np.memmap)
+    assert len(loaded) == len(index)
+    after = [[loaded.locations[i] for i in row] for row in ids(loaded.search(queries, k=5, n_probe=4))]
+    assert after == before
+
+    # the memory-mapped matrix is copied before rows are added
+    new = loaded.add(vectors[:1] * -1, [Location("new.py", "g", 1, 2)])
+    assert loaded.search(-vectors[:1], k=1)[0][0][1] == new[0]
+    assert not isinstance(loaded._vectors, np.memmap)
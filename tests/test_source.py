@@ -0,0 +1,125 @@
+import ast
+import importlib
+import os
+
+import pytest
+
+import source
+from conftest import SAMPLES
+from graph import CodeGraph
+
+
+FILES = ["test-expansion.py", "test-extraction.py", "test-redundant-vars.py"]
+
+
+def parse(name):
+    with open(os.path.join(SAMPLES, name)) as f:
+        return CodeGraph(ast.parse(f.read()))
+
+
+def unparse(tree):
+    return ast.unparse(ast.fix_missing_locations(tree)) + "\n"
+
+
+def test_generator_is_compatible():
+    assert source._compatible()
+
+
+@pytest.mark.parametrize("name", FILES)
+def test_matches_unparse(name):
+    G = parse(name)
+    cache = source.SourceCache()
+    assert G.to_source(cache) == unparse(G.ast_tree)
+    # printed again from the cache
+    assert G.to_source(cache) == unparse(G.ast_tree)
+    assert cache.hits
+
+
+@pytest.mark.parametrize("name", FILES)
+def test_changed_without_refresh(name):
+    G = parse(name)
+    cache = source.SourceCache()
+    G.to_source(cache)
+    G.ast_tree.body.append(ast.parse("z = main()").body[0])
+    G.ast_tree.body[0] = ast.parse("import sys").body[0]
+    assert G.to_source(cache) == unparse(G.ast_tree)
+    with pytest.raises(ValueError):
+        G.source_map(cache)
+
+    G.refresh()
+    assert G.to_source(cache) == unparse(G.ast_tree)
+
+
+@pytest.mark.parametrize("name", FILES)
+def test_changed_with_mutate(name):
+    G = parse(name)
+    cache = source.SourceCache()
+    G.to_source(cache)
+    node_id = next(i for i, n in G.ast_nodes.items() if isinstance(n, ast.Constant))
+    with G.mutate(node_id) as (node,):
+        node.value = "changed"
+    assert G.to_source(cache) == unparse(G.ast_tree)
+
+
+def test_source_map():
+    G = parse("test-expansion.py")
+    text, spans = G.source_map(source.SourceCache())
+    for node_id, (start, end) in spans.items():
+        node = G.ast_nodes[node_id]
+        if isinstance(node, ast.expr):
+            # tuples are parenthesized when printed alone
+            assert text[start:end] in (ast.unparse(node), ast.unparse(node)[1:-1])
+        elif isinstance(node, ast.stmt):
+            # the lines after the first keep the indentation of the statement
+            assert text[start:end].split("\n")[0] == ast.unparse(node).split("\n")[0]
+
+
+def test_changed_in_place_before_refresh():
+    G = parse("test-expansion.py")
+    cache = source.SourceCache()
+    G.to_source(cache)
+    node_id = next(i for i, n in G.ast_nodes.items() if isinstance(n, ast.Constant))
+    G.mutable(node_id).value = "changed"
+    # the statement is not taken from the cache by its old hash
+    assert G.to_source(cache) == unparse(G.ast_tree)
+    with pytest.raises(ValueError):
+        G.source_map(cache)
+    G.refresh(changed=[node_id])
+    assert G.to_source(cache) == unparse(G.ast_tree)
+
+
+@pytest.mark.parametrize("name", FILES)
+def test_source_map_without_unparser(name, monkeypatch):
+    G = parse(name)
+    monkeypatch.setattr(source, "_Unparser", None)
+    text, spans = G.source_map()
+    assert text == G.to_source()
+    located = [i for i, n in G.ast_nodes.items() if isinstance(n, (ast.expr, ast.stmt))]
+    assert set(located) <= set(spans)
+    for node_id in located:
+        start, end = spans[node_id]
+        node = G.ast_nodes[node_id]
+        if isinstance(node, ast.stmt):
+            printed = ast.parse(text[start:end].replace("\n" + " " * node.col_offset, "\n")).body[0]
+        else:
+            printed = ast.parse(text[start:end], mode="eval").body
+        if isinstance(node, ast.expr):
+            # alone, targets are parsed as read
+            assert ast.dump(printed) == ast.dump(node).replace("Store()", "Load()")
+        else:
+            assert ast.dump(printed) == ast.dump(node)
+
+
+def test_incompatible_unparser(monkeypatch):
+    class Unparser:
+        pass
+
+    monkeypatch.setattr(ast, "_Unparser", Unparser)
+    try:
+        with pytest.warns(RuntimeWarning):
+            importlib.reload(source)
+        assert source._Unparser is None
+    finally:
+        monkeypatch.undo()
+        importlib.reload(source)
+    assert source._Unparser is ast._Unparser
@@ -0,0 +1,193 @@
+import ast
+import base64
+import io
+import os
+import subprocess
+import sys
+import zlib
+import xml.etree.ElementTree as ET
+from urllib.parse import unquote
+
+import pytest
+
+from conftest import SAMPLES
+from graph import ASTNode, CodeGraph
+from style import ASTNodeXML, DetailParams, LabelCache, OurGraphToXML, occurence_entry
+
+
+SOURCE = os.path.join(os.path.dirname(os.__file__), "fractions.py")
+
+
+@pytest.fixture(scope="module")
+def G():
+    with open(SOURCE) as f:
+        return CodeGraph(ast.parse(f.read()))
+
+
+NESTED = """
+class A:
+    def f(self):
+        def g():
+            return len([1, 2], key=g)
+        return g
+
+def h(x):
+    return x + x + x
+"""
+
+
+def canonical(xml):
+    return ET.canonicalize(xml, strip_text=True)
+
+
+def written(G, **kwargs):
+    file = io.StringIO()
+    OurGraphToXML().write(G, file, **kwargs)
+    return file.getvalue()
+
+
+def decompressed(diagram):
+    return unquote(zlib.decompress(base64.b64decode(diagram.text), -15).decode("utf-8"))
+
+
+def test_write_matches_graph_to_xml(G):
+    expected = ET.tostring(OurGraphToXML().graph_to_xml(G), encoding="unicode")
+    assert canonical(written(G)) == canonical(expected)
+
+
+def test_compressed(G):
+    plain = ET.fromstring(written(G))
+    compressed = ET.fromstring(written(G, compressed=True))
+    # several blocks of 64kB
+    assert len(ET.tostring(plain)) > 3 << 16
+    [diagram] = compressed.findall("diagram")
+    assert diagram.attrib == plain.find("diagram").attrib
+    assert canonical(decompressed(diagram)) == canonical(ET.tostring(plain.find("diagram/mxGraphModel")))
+
+
+def test_write_to_path(tmp_path):
+    with open(os.path.join(SAMPLES, "test-expansion.py")) as f:
+        G = CodeGraph(ast.parse(f.read()))
+    path = str(tmp_path / "graph.drawio")
+    OurGraphToXML().write(G, path)
+    with open(path) as f:
+        assert f.read() == written(G)
+
+
+def test_invalid_xml_characters():
+    G = CodeGraph(ast.parse('x = " \\x0b\\x0c\\x00\\t"'))
+    root = ET.fromstring(written(G))
+    labels = [cell.get("value") for cell in root.iter("mxCell") if cell.get("value")]
+    assert any("\\x0b\\x0c\\x00\t" in label for label in labels)
+
+
+def pages(G, detail):
+    """
+    name -> (vertex ids, edges as (source, target)) of every page
+    """
+    result = {}
+    for diagram in ET.fromstring(written(G, detail=detail)).findall("diagram"):
+        cells = list(diagram.iter("mxCell"))
+        vertices = [c.get("id") for c in cells if c.get("vertex")]
+        edges = [(c.get("source"), c.get("target")) for c in cells if c.get("edge")]
+        assert len(set(vertices)) == len(vertices)
+        # every edge has its ends on the page
+        assert all(source in vertices and target in vertices for source, target in edges)
+        result[diagram.get("name")] = vertices, edges
+    return result
+
+
+def test_detail_everything(G):
+    [(full, full_edges)] = pages(G, None).values()
+    [(shown, edges)] = pages(G, DetailParams()).values()
+    assert sorted(shown) == sorted(full)
+    assert sorted(edges) == sorted(full_edges)
+
+
+def test_detail_max_depth(G):
+    [(shown, _)] = pages(G, DetailParams(max_depth=3, tokens=False)).values()
+    nodes = {str(i): i for i in G.ast_nodes}
+    assert all(G.depth(nodes[i]) <= 3 for i in shown)
+    assert {str(i) for i in G.our_nodes if G.depth(i) <= 3} == set(shown)
+
+
+def test_detail_tokens():
+    G = CodeGraph(ast.parse(NESTED))
+    [(shown, edges)] = pages(G, DetailParams(tokens=False)).values()
+    assert not any(i.startswith("stx_") for i in shown)
+    [(shown, edges)] = pages(G, DetailParams(max_occurences=1)).values()
+    tokens = [source for source, _ in edges if source.startswith("stx_")]
+    assert len(tokens) == len(set(tokens)) == len({i for i in shown if i.startswith("stx_")})
+
+
+def test_detail_split_functions():
+    G = CodeGraph(ast.parse(NESTED))
+    result = pages(G, DetailParams(split_functions=True))
+    assert list(result) == ["Page-1", "A", "h", "A.f", "A.f.g"]
+    # every node is on one page, the functions also on the page of their parent as a summary
+    functions = {str(i) for i, n in G.ast_nodes.items() if isinstance(n, (ast.FunctionDef, ast.ClassDef))}
+    seen = [i for shown, _ in result.values() for i in shown if not i.startswith("stx_")]
+    assert sorted(seen) == sorted([str(i) for i in G.our_nodes] + list(functions))
+
+
+def test_detail_collapse_types():
+    G = CodeGraph(ast.parse(NESTED))
+    [(shown, _)] = pages(G, DetailParams(collapse_types=("Call",), tokens=False)).values()
+    call = next(i for i, n in G.ast_nodes.items() if isinstance(n, ast.Call))
+    assert str(call) in shown
+    assert not set(shown) & {str(i) for i in G.subtree(call)[1:]}
+
+
+EXPORT = """
+import ast, hashlib, io, sys
+sys.path.insert(0, {root!r})
+from graph import CodeGraph
+from style import DetailParams, OurGraphToXML
+with open({path!r}) as f:
+    G = CodeGraph(ast.parse(f.read()))
+for detail in (None, DetailParams(split_functions=True, max_occurences=2)):
+    file = io.StringIO()
+    OurGraphToXML().write(G, file, compressed=True, detail=detail)
+    print(hashlib.md5(file.getvalue().encode()).hexdigest())
+"""
+
+
+def test_deterministic(G):
+    assert written(G) == written(G)
+    detail = DetailParams(max_depth=4, split_functions=True)
+    assert written(G, detail=detail) == written(G, detail=detail)
+    # nor do they depend on the hash seed of the process
+    code = EXPORT.format(root=os.path.dirname(SAMPLES), path=os.path.join(SAMPLES, "test-extraction.py"))
+    outputs = {
+        subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+            env={**os.environ, "PYTHONHASHSEED": seed},
+        ).stdout
+        for seed in ("1", "2")
+    }
+    assert len(outputs) == 1
+    assert len(outputs.pop().split()) == 2
+
+
+def test_occurence_entries(G):
+    edges = list(G.occurences.values())
+    entries = [occurence_entry(edge) for edge in edges]
+    assert entries == [occurence_entry(edge) for edge in edges]
+    assert all(0.25 <= entry < 0.5 for entry in entries)
+    assert entries != [occurence_entry(edge, seed=1) for edge in edges]
+
+
+def test_label_cache():
+    cache = LabelCache(max_entries=2)
+    node = ast.parse("x = 1").body[0].targets[0]
+    assert cache.label(node) == "<b>Name</b><br>id: x<br>ctx: Store"
+    assert cache.label(node) == "<b>Name</b><br>id: x<br>ctx: Store"
+    assert (cache.hits, cache.misses) == (1, 1)
+    # a node changed in place gets a new label
+    node.id = "y"
+    assert cache.label(node) == "<b>Name</b><br>id: y<br>ctx: Store"
+    # 1 and True are told apart
+    assert "value: True" in cache.label(ast.Constant(True))
+    assert "value: 1" in cache.label(ast.Constant(1))
+    assert len(cache._entries) == 2
+    assert "id: y" in ASTNodeXML(ASTNode(0, node)).node_html_label()
@@ -0,0 +1,66 @@
+import ast
+import os
+
+import transforms
+from conftest import SAMPLES
+from graph import CodeGraph
+
+
+CALLS = """
+def plus(a, b):
+    return a + b
+
+def sq(v):
+    return v * v
+
+def g(p):
+    a = sq(p)
+    b = sq(a + 1)
+    c = plus(a, b)
+    return c
+"""
+
+
+def run(tree, name, *args):
+    namespace = {}
+    exec(compile(tree, "<transformed>", "exec"), namespace)
+    return namespace[name](*args)
+
+
+def test_expand_all_calls_compiles_and_keeps_behaviour():
+    expected = run(ast.parse(CALLS), "g", 3)
+    G = CodeGraph(ast.parse(CALLS))
+    transforms.expand_all_calls(G)
+    assert "sq(" not in G.to_source().split("def g")[1]
+    assert run(G.ast_tree, "g", 3) == expected
+    # the printed source is the same code
+    assert run(ast.parse(G.to_source()), "g", 3) == expected
+
+
+def test_expand_function_compiles():
+    G = CodeGraph.from_file(os.path.join(SAMPLES, "test-expansion.py"))
+    call = next(k for k, n in G.ast_nodes.items() if isinstance(n, ast.Call))
+    transforms.expand_function(G, call)
+    assert "plus(x, y)" not in G.to_source()
+    assert run(G.ast_tree, "main") == 3
+
+
+def test_chained_transforms_refresh_incrementally(monkeypatch):
+    G = CodeGraph(ast.parse(CALLS))
+    rebuilds = []
+    rebuild = G._rebuild
+    monkeypatch.setattr(G, "_rebuild", lambda: rebuilds.append(1) or rebuild())
+    g = next(k for k, n in G.ast_nodes.items() if isinstance(n, ast.FunctionDef) and n.name == "g")
+    transforms.extract_function(G, g, 1, 2)
+    call = next(k for k, n in G.ast_nodes.items() if isinstance(n, ast.Call) and n.func.id == "sq")
+    transforms.expand_function(G, call)
+    assert not rebuilds and not G.stale
+    assert run(G.ast_tree, "g", 3) == run(ast.parse(CALLS), "g", 3)
+
+    # a graph changed without a refresh is refreshed first
+    G.mutable(G.root_id).body.reverse()
+    assert G.stale
+    G.ast_tree.body.reverse()
+    call = next(k for k, n in G.ast_nodes.items() if isinstance(n, ast.Call) and n.func.id == "sq")
+    transforms.expand_function(G, call)
+    assert len(rebuilds) == 1
@@ -1,7 +1,10 @@
-from typing import Callable, List
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
 import ast 
+import bisect
 import copy
-from graph import CodeGraph 
+from graph import CodeGraph, SyntaxToken, path_id
+from liveness import Liveness, Region
+from scopes import SCOPE_KINDS
 
 
 
@@ -22,8 +25,8 @@ def get_assign_node(args: List[ast.arg], vars: List[ast.AST]):
     
     """
     new_vars_for_args = [ast.Name(id=x.arg, ctx=ast.Store()) for x in args]
-    targets_tuple = ast.Tuple(elts=new_vars_for_args,) #TODO ctx=ast.Store()
-    value_tuple = ast.Tuple(elts=vars,) #TODO ctx=ast.Load()
+    targets_tuple = ast.Tuple(elts=new_vars_for_args, ctx=ast.Store())
+    value_tuple = ast.Tuple(elts=vars, ctx=ast.Load())
     assign_node = ast.Assign(targets=[targets_tuple], value=value_tuple)
     return assign_node    
 
@@ -39,20 +42,31 @@ def expand_function(G: CodeGraph, node_id: int):
         (x_new, y_new) = (1, 2), 
     4. insert it before the function expansion: (x_new, y_new) = (1, 2); z = (x_new + y_new)
     """
+    # G = copy.deepcopy(G)
+    if G.stale:
+        G.refresh()
+    G.refresh(changed=_expand_function(G, node_id))
+    return G
+
+
+def _expand_function(G: CodeGraph, node_id: int) -> List[int]:
+    """
+    expand_function without the refreshes, returns the ids of the changed nodes
+    """
     def renaming_fun(x):
         return x + "_new" #TODO better renaming
 
-    # G = copy.deepcopy(G)
-    G.refresh()
     node = G.ast_nodes[node_id]
     assert isinstance(node, ast.Call), f"Node {node} is not a function call"
 
     parent_id = G.get_parent(node_id)
-    parent = G.ast_nodes[parent_id]
+    grandparent_id = G.get_parent(parent_id)
+    parent = G.mutable(parent_id)
     assert parent.value == node, f"Parent node {parent} is not the function call {node}"
 
     function_defs = [
-        n for n in G.ast_nodes.values() if isinstance(n, ast.FunctionDef) and n.name == node.func.id and n.lineno < node.lineno
+        G.ast_nodes[i] for i in G.symbols.defs(path_id(node_id, "func"))
+        if isinstance(G.ast_nodes[i], ast.FunctionDef) and G.ast_nodes[i].lineno < node.lineno
     ]
 
     assert len(function_defs) > 0, f"No function definition found for {node.func.id}"
@@ -66,90 +80,550 @@ def expand_function(G: CodeGraph, node_id: int):
     parent.value = copy.copy(fun_def_node.body[0].value)
 
     new_assign_node = get_assign_node(renamed_args, node.args)
+    # compile() needs the locations of the new nodes
+    ast.fix_missing_locations(ast.copy_location(new_assign_node, parent))
 
-    grandparent = G.ast_nodes[G.get_parent(parent_id)]
+    grandparent = G.ast_nodes[grandparent_id]
     assert hasattr(grandparent, 'body'), f"Grandparent node {grandparent} has no body"
 
     call_index = grandparent.body.index(parent)
     grandparent.body.insert(call_index, new_assign_node)
-    G.refresh()
-    return G
+    return [grandparent_id]
+
+
+class CallExpander:
+    """
+    inlines every eligible call of G as expand_function does for one call
+
+    The function definitions are indexed by binding once, a call is expanded with
+    the last definition of its name before it in the scope the name resolves to.
+    The renamed expression and arguments of a callee are built once and copied at
+    each of its call sites.
+    """
+
+    def __init__(self, G: CodeGraph, rename_fun: Callable[[str], str] = lambda x: x + "_new"):
+        self.G = G
+        self.rename_fun = rename_fun
+        # binding -> (line numbers, ids) of its function definitions, in line order
+        self.definitions: Dict[SyntaxToken, Tuple[List[int], List[int]]] = {}
+        # def id -> (renamed arguments, renamed expression or None)
+        self.templates: Dict[int, Tuple[List[ast.arg], Optional[ast.expr]]] = {}
+        # call id -> (def id, statement id, id of the node whose body holds it)
+        self.sites: Dict[int, Tuple[int, int, int]] = {}
+
+        symbols = G.symbols
+        definitions = {}
+        for node_id, node in G.ast_nodes.items():
+            if node.__class__ is ast.FunctionDef:
+                definitions.setdefault(symbols.binding(node_id), []).append((node.lineno, node_id))
+        for token, defs in definitions.items():
+            defs.sort()
+            self.definitions[token] = ([lineno for lineno, _ in defs], [i for _, i in defs])
+
+    def definition(self, call_id: int) -> Optional[int]:
+        """
+        id of the definition a call expands to, None if it is not a call of a
+        function defined before it
+        """
+        G = self.G
+        lineno = getattr(G.ast_nodes[call_id], "lineno", None)
+        token = G.symbols.binding(path_id(call_id, "func"))
+        if lineno is None or token not in self.definitions:
+            return None
+        linenos, def_ids = self.definitions[token]
+        i = bisect.bisect_left(linenos, lineno)
+        return def_ids[i - 1] if i else None
+
+    def template(self, def_id: int) -> Tuple[List[ast.arg], Optional[ast.expr]]:
+        if def_id not in self.templates:
+            function_def = self.G.ast_nodes[def_id]
+            args = [ast.arg(arg=self.rename_fun(x.arg), annotation=None) for x in function_def.args.args]
+            value = getattr(function_def.body[0], "value", None)
+            if value is not None:
+                value = rename_all_vars(value, self.rename_fun)
+            self.templates[def_id] = (args, value)
+        return self.templates[def_id]
+
+    def run(self, predicate: Callable[[int, int], bool] = None) -> "CallExpander":
+        """
+        finds the calls to expand: the value of a statement in a body, calling a
+        function whose first statement has a value with one positional argument per
+        parameter, and for which predicate(call id, def id) is true
+        """
+        G = self.G
+        for body_id, node in G.ast_nodes.items():
+            body = getattr(node, "body", None)
+            if body.__class__ is not list:
+                continue
+            for i, stmt in enumerate(body):
+                call = getattr(stmt, "value", None)
+                if call.__class__ is not ast.Call or call.keywords:
+                    continue
+                stmt_id = path_id(body_id, "body", i)
+                call_id = path_id(stmt_id, "value")
+                def_id = self.definition(call_id)
+                if def_id is None:
+                    continue
+                args, value = self.template(def_id)
+                if value is None or len(args) != len(call.args):
+                    continue
+                if any(isinstance(arg, ast.Starred) for arg in call.args):
+                    continue
+                if predicate is None or predicate(call_id, def_id):
+                    self.sites[call_id] = (def_id, stmt_id, body_id)
+        return self
+
+    def apply(self) -> CodeGraph:
+        """
+        expands the calls found by run() and refreshes G once
+        """
+        self.G.refresh(changed=self.edit())
+        return self.G
+
+    def edit(self) -> Set[int]:
+        """
+        expands the calls found by run() without refreshing G,
+        returns the ids of the changed nodes
+        """
+        G = self.G
+        expanded = {stmt_id: (call_id, def_id) for call_id, (def_id, stmt_id, _) in self.sites.items()}
+        body_ids = {body_id for _, _, body_id in self.sites.values()}
+
+        # every node is made mutable before any body changes, as inserting statements
+        # changes the ids of the ones after them
+        nodes = {node_id: G.mutable(node_id) for node_id in (*expanded, *body_ids)}
+
+        for body_id in body_ids:
+            statements = []
+            for i, stmt in enumerate(nodes[body_id].body):
+                stmt_id = path_id(body_id, "body", i)
+                if stmt_id in expanded:
+                    call_id, def_id = expanded[stmt_id]
+                    args, value = self.template(def_id)
+                    stmt = nodes[stmt_id]
+                    assign = get_assign_node(args, G.ast_nodes[call_id].args)
+                    statements.append(ast.fix_missing_locations(ast.copy_location(assign, stmt)))
+                    stmt.value = _clone(value)
+                statements.append(stmt)
+            nodes[body_id].body = statements
+        return body_ids
+
+
+def _clone(node: ast.AST) -> ast.AST:
+    """
+    copy of the subtree of node sharing only the Load/Store contexts, much faster
+    than copy.deepcopy
+    """
+    cls = node.__class__
+    clone = cls.__new__(cls)
+    fields = clone.__dict__
+    for key, value in node.__dict__.items():
+        if isinstance(value, ast.AST):
+            if not isinstance(value, ast.expr_context):
+                value = _clone(value)
+        elif value.__class__ is list:
+            value = [_clone(item) if isinstance(item, ast.AST) else item for item in value]
+        fields[key] = value
+    return clone
+
+
+def expand_all_calls(G: CodeGraph, predicate: Callable[[int, int], bool] = None):
+    """
+    expands every call of a function defined earlier in its scope (see CallExpander),
+    in one traversal and one refresh. predicate(call id, def id) selects the calls
+    """
+    return CallExpander(G).run(predicate).apply()
 
 
 def extract_function(G: CodeGraph, parent_id: int, start: int, end: int):
     # G = copy.deepcopy(G)
-    G.refresh()
+    if G.stale:
+        G.refresh()
+    G.refresh(changed=_extract_function(G, parent_id, start, end))
+    return G
+
+
+def _extract_function(
+    G: CodeGraph, parent_id: int, start: int, end: int, liveness: Liveness = None
+) -> List[int]:
+    """
+    extract_function without the refreshes, returns the ids of the changed nodes
+    """
     parent = G.ast_nodes[parent_id]
     assert hasattr(parent, 'body'), 'The node is not a function'
     assert start < end, 'The start index should be smaller than the end index'
-    end_node = parent.body[end]
+    return _extract_functions(G, [(parent_id, start, end)], ["extracted_function"], liveness)
 
-    all_vars = []
-    for node_body in parent.body[start:end+1]:
-        all_vars.extend([node for node in ast.walk(node_body) if isinstance(node, ast.Name)])
 
-    all_vars_lookup = {var.id: [node for node in all_vars if node.id == var.id] for var in all_vars}
+def extract_functions(
+    G: CodeGraph,
+    regions: Iterable[Union[Region, Tuple[int, int, int]]],
+    names: List[str] = None,
+):
+    """
+    extracts every region, given as a Region of Liveness(G) or (parent_id, start, end),
+    into a function defined just before its call, with one refresh.
+    The parameters are the variables read by the region that are set before it, the
+    return values the ones set by the region that are read after it. The regions of
+    a body must not overlap, names default to extracted_function, extracted_function_1...
+    """
+    G.refresh(changed=_extract_functions(G, regions, names))
+    return G
 
-    args = [ast.arg(arg=var, annotation=None) for var, appearances in all_vars_lookup.items() if isinstance(appearances[0].ctx, ast.Load)]
-    
-    function_name = 'extracted_function' # TODO
 
+def score_regions(
+    G: CodeGraph,
+    parent_id: int,
+    score: Callable[[Region], float] = None,
+    min_size: int = 2,
+    max_size: int = None,
+    liveness: Liveness = None,
+) -> List[Tuple[float, Region]]:
+    """
+    every region of the body of parent_id that can be extracted with its score, best
+    first. score defaults to the number of statements minus the number of parameters
+    and return values
+    """
+    if score is None:
+        score = lambda region: len(region) - len(region.params) - len(region.returns)  # noqa: E731
+    liveness = Liveness(G) if liveness is None else liveness
+    scored = [(score(region), region) for region in liveness.regions(parent_id, min_size, max_size)]
+    scored.sort(key=lambda x: (-x[0], x[1].start, x[1].end))
+    return scored
+
+
+def _extract_functions(
+    G: CodeGraph,
+    regions: Iterable[Union[Region, Tuple[int, int, int]]],
+    names: List[str] = None,
+    liveness: Liveness = None,
+) -> List[int]:
+    """
+    extract_functions without the refresh, returns the ids of the changed nodes
+    """
+    liveness = Liveness(G) if liveness is None else liveness
+    regions = [r if isinstance(r, Region) else liveness.region(*r) for r in regions]
+    if names is None:
+        names = _function_names(G, "extracted_function", len(regions))
+
+    by_parent: Dict[int, List[Tuple[Region, str]]] = {}
+    for region, name in zip(regions, names):
+        by_parent.setdefault(region.parent_id, []).append((region, name))
+    for parent_regions in by_parent.values():
+        parent_regions.sort(key=lambda x: x[0].start)
+        for (previous, _), (region, _) in zip(parent_regions, parent_regions[1:]):
+            if region.start <= previous.end:
+                raise ValueError(f"Regions {previous} and {region} overlap")
+
+    # every node is made mutable before any body changes, as the regions of a body
+    # may contain the bodies of other regions
+    nodes = {parent_id: G.mutable(parent_id) for parent_id in by_parent}
+
+    for parent_id, parent_regions in by_parent.items():
+        parent = nodes[parent_id]
+        body = list(parent.body)
+        # from the end, so that the indices of the regions left stay valid
+        for region, name in reversed(parent_regions):
+            statements = body[region.start:region.end + 1]
+            body[region.start:region.end + 1] = _extracted_function(G, name, statements, region)
+        parent.body = body
+    return list(by_parent)
+
+
+def _extracted_function(G: CodeGraph, name: str, statements: List[ast.stmt], region: Region):
+    """
+    definition of the function of a region and the statement calling it
+    """
+    args = [ast.arg(arg=param, annotation=None) for param in region.params]
     function_def = ast.FunctionDef(
-        name=function_name, 
-        args=ast.arguments(args=args, vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[]), 
-        body=parent.body[start:end+1], 
+        name=name,
+        args=ast.arguments(
+            posonlyargs=[], args=args, vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[]
+        ),
+        body=statements,
         decorator_list=[]
     )
 
     call_node = ast.Call(
-        func=ast.Name(id=function_name, ctx=G.load_node), 
-        args=[ast.Name(id=arg.arg, ctx=G.load_node) for arg in args], 
+        func=ast.Name(id=name, ctx=G.load_node),
+        args=[ast.Name(id=arg.arg, ctx=G.load_node) for arg in args],
         keywords=[]
         )
 
-    match end_node.__class__:
-        case ast.Assign:
-            return_node = ast.Return(ast.Name(id=end_node.targets[0].id, ctx=G.load_node))
-            function_def.body.append(return_node)
-            call_node = ast.Assign(targets=[ast.Name(id=end_node.targets[0].id, ctx=G.store_node)], value=call_node)
-        case ast.Call:
-            pass
-        case _:
-            raise ValueError('The end node should be an assignment or a function call')
-    
-    parent.body = parent.body[:start] + [function_def, call_node] + parent.body[end+1:]
-    G.refresh()
-    return G
+    if not region.returns:
+        call_node = ast.Expr(value=call_node)
+    else:
+        if len(region.returns) == 1:
+            value = ast.Name(id=region.returns[0], ctx=G.load_node)
+            target = ast.Name(id=region.returns[0], ctx=G.store_node)
+        else:
+            value = ast.Tuple(elts=[ast.Name(id=x, ctx=G.load_node) for x in region.returns], ctx=G.load_node)
+            target = ast.Tuple(elts=[ast.Name(id=x, ctx=G.store_node) for x in region.returns], ctx=G.store_node)
+        return_node = ast.copy_location(ast.Return(value), statements[-1])
+        function_def.body.append(ast.fix_missing_locations(return_node))
+        call_node = ast.Assign(targets=[target], value=call_node)
+
+    ast.fix_missing_locations(ast.copy_location(function_def, statements[0]))
+    ast.fix_missing_locations(ast.copy_location(call_node, statements[0]))
+    return [function_def, call_node]
+
+
+def _function_names(G: CodeGraph, prefix: str, n: int) -> List[str]:
+    """
+    n names starting with prefix that are not bound in G
+    """
+    names = []
+    i = 0
+    while len(names) < n:
+        name = prefix if i == 0 else f"{prefix}_{i}"
+        if not G.symbols.named(name):
+            names.append(name)
+        i += 1
+    return names
+
+# a function calling one of these can read its local variables by name
+DYNAMIC_NAMES = ("locals", "vars", "eval", "exec")
+FUNCTION_TYPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)
+STORE_TYPES = (ast.Assign, ast.AnnAssign, ast.AugAssign)
+# values that cannot be dropped together with the assignment
+SIDE_EFFECT_TYPES = (ast.Call, ast.Await, ast.Yield, ast.YieldFrom, ast.NamedExpr)
+
+
+class DeadStoreEliminator:
+    """
+    worklist dead-store elimination over the bindings of G.symbols
+
+    a local variable is dead when nothing reads it but augmented assignments to itself.
+    Its assignments (also to tuples of dead names, augmented and annotated ones) and its
+    del statements are removed, values that may have side effects are kept as expression
+    statements. The variables read only by removed values are dead in turn, so chains
+    like a = 1; b = a collapse in one run. The variables also bound from a nested scope
+    (nonlocal, assignment expressions in comprehensions) are left alone.
+    """
+
+    def __init__(self, G: CodeGraph):
+        self.G = G
+        self.removed: Dict[int, Optional[ast.stmt]] = {}  # statement id -> replacement
+        self.deleted: Dict[int, Set[int]] = {}  # del statement id -> ids of dead targets
+        self.dead: List[SyntaxToken] = []
+
+    def run(self) -> "DeadStoreEliminator":
+        G = self.G
+        dynamic = self._dynamic_scopes()
+        declared = self._declared_names()
+        self._live: Dict[SyntaxToken, int] = {}
+        self._worklist: List[SyntaxToken] = []
+        for scope_id, bindings in G.lookup.items():
+            if not isinstance(G.ast_nodes[scope_id], FUNCTION_TYPES) or scope_id in dynamic:
+                continue
+            for binding in bindings.values():
+                # the stores of a nested scope through nonlocal are not followed
+                if binding.name in declared.get(scope_id, ()):
+                    continue
+                if any(
+                    self._undeletable(def_id) or self._scope(def_id) != scope_id
+                    for def_id in binding.defs
+                ):
+                    continue
+                live = sum(1 for use_id in binding.uses if _reads(G.ast_nodes[use_id]))
+                self._live[binding] = live
+                if live == 0:
+                    self._worklist.append(binding)
+
+        while self._worklist:
+            binding = self._worklist.pop()
+            self.dead.append(binding)
+            for def_id in binding.defs:
+                stmt_id = self._statement(def_id)
+                if stmt_id is None or stmt_id in self.removed:
+                    continue
+                if isinstance(G.ast_nodes[stmt_id], ast.Delete):
+                    self.deleted.setdefault(stmt_id, set()).add(def_id)
+                    continue
+                names = self._stored_names(stmt_id)
+                if names is not None and all(
+                    self._live.get(G.symbols.binding(i)) == 0 for i in names
+                ):
+                    self._remove(stmt_id)
+        return self
+
+    def apply(self) -> CodeGraph:
+        """
+        removes the dead statements found by run() and refreshes G once
+        """
+        self.G.refresh(changed=self.edit())
+        return self.G
 
-class RedundantVariableRemover(ast.NodeTransformer):
-    def __init__(self, redundant_vars):
-        self.redundant_vars = redundant_vars
+    def edit(self) -> Set[int]:
+        """
+        removes the dead statements found by run() without refreshing G,
+        returns the ids of the changed nodes
+        """
+        G = self.G
+        for stmt_id, targets in self.deleted.items():
+            if len(targets) == len(G.ast_nodes[stmt_id].targets):
+                self.removed[stmt_id] = None
+        pruned = [stmt_id for stmt_id in self.deleted if stmt_id not in self.removed]
+        parent_ids = {G.get_parent(stmt_id) for stmt_id in self.removed}
+
+        # every node is made mutable before any list changes, as removing statements
+        # changes the ids of the ones after them
+        nodes = {node_id: G.mutable(node_id) for node_id in (*pruned, *parent_ids)}
+
+        for stmt_id in pruned:
+            stmt = nodes[stmt_id]
+            stmt.targets = [
+                target
+                for i, target in enumerate(stmt.targets)
+                if path_id(stmt_id, "targets", i) not in self.deleted[stmt_id]
+            ]
+
+        for parent_id in parent_ids:
+            parent = nodes[parent_id]
+            for field, value in ast.iter_fields(parent):
+                if not isinstance(value, list):
+                    continue
+                statements = []
+                for i, item in enumerate(value):
+                    item_id = path_id(parent_id, field, i)
+                    if item_id not in self.removed:
+                        statements.append(item)
+                    elif self.removed[item_id] is not None:
+                        statements.append(self.removed[item_id])
+                if value and not statements and field in ("body", "finalbody"):
+                    statements = [ast.copy_location(ast.Pass(), value[0])]
+                setattr(parent, field, statements)
+
+        return set(pruned) | parent_ids
+
+    def _dynamic_scopes(self) -> Set[int]:
+        G = self.G
+        dynamic = set()
+        for name in DYNAMIC_NAMES:
+            for binding in G.symbols.named(name):
+                if binding.defs:
+                    continue
+                for use_id in binding.uses:
+                    dynamic.update(
+                        a for a in G.ancestors(use_id) if isinstance(G.ast_nodes[a], FUNCTION_TYPES)
+                    )
+        return dynamic
+
+    def _declared_names(self) -> Dict[int, Set[str]]:
+        """
+        function id -> names declared global or nonlocal in the scopes nested in it
+        """
+        G = self.G
+        declared = {}
+        for node_id, node in G.ast_nodes.items():
+            if not isinstance(node, (ast.Global, ast.Nonlocal)):
+                continue
+            for a in G.ancestors(node_id):
+                if isinstance(G.ast_nodes[a], FUNCTION_TYPES):
+                    declared.setdefault(a, set()).update(node.names)
+        return declared
+
+    def _scope(self, def_id: int) -> Optional[int]:
+        # innermost scope containing the name, the binding is only followed when it is its own
+        return next(
+            (a for a in self.G.ancestors(def_id) if self.G.ast_nodes[a].__class__ in SCOPE_KINDS),
+            None,
+        )
+
+    def _statement(self, def_id: int) -> Optional[int]:
+        """
+        the assignment or del statement binding the name at def_id, if it only binds names
+        """
+        G = self.G
+        if not isinstance(G.ast_nodes[def_id], ast.Name):
+            return None
+        stmt_id = G.get_parent(def_id)
+        if isinstance(G.ast_nodes[stmt_id], ast.Delete):
+            return stmt_id
+        while isinstance(G.ast_nodes[stmt_id], (ast.Tuple, ast.List, ast.Starred)):
+            stmt_id = G.get_parent(stmt_id)
+        return stmt_id if isinstance(G.ast_nodes[stmt_id], STORE_TYPES) else None
+
+    def _undeletable(self, def_id: int) -> bool:
+        # removing the assignments would leave a del of an unbound name behind
+        node = self.G.ast_nodes[def_id]
+        return (
+            isinstance(node, ast.Name)
+            and isinstance(node.ctx, ast.Del)
+            and self._statement(def_id) is None
+        )
+
+    def _stored_names(self, stmt_id: int) -> Optional[List[int]]:
+        """
+        ids of the names the statement assigns, None if it also stores into attributes
+        or subscripts
+        """
+        G = self.G
+        stmt = G.ast_nodes[stmt_id]
+        if isinstance(stmt, ast.Assign):
+            stack = [path_id(stmt_id, "targets", i) for i in range(len(stmt.targets))]
+        else:
+            stack = [path_id(stmt_id, "target")]
+        names = []
+        while stack:
+            node_id = stack.pop()
+            node = G.ast_nodes[node_id]
+            if isinstance(node, ast.Name):
+                names.append(node_id)
+            elif isinstance(node, (ast.Tuple, ast.List, ast.Starred)):
+                stack.extend(
+                    c for c in G.children(node_id)
+                    if not isinstance(G.ast_nodes[c], ast.expr_context)
+                )
+            else:
+                return None
+        return names
+
+    def _remove(self, stmt_id: int):
+        G = self.G
+        stmt = G.ast_nodes[stmt_id]
+        dropped = []
+        if isinstance(stmt, ast.AnnAssign):
+            dropped.append(path_id(stmt_id, "annotation"))
+
+        replacement = None
+        if stmt.value is not None:
+            value_id = path_id(stmt_id, "value")
+            if any(isinstance(G.ast_nodes[i], SIDE_EFFECT_TYPES) for i in G.subtree(value_id)):
+                replacement = ast.copy_location(ast.Expr(value=stmt.value), stmt)
+            else:
+                dropped.append(value_id)
+        self.removed[stmt_id] = replacement
+
+        # the names read by the dropped code lose a use
+        for root_id in dropped:
+            for node_id in G.subtree(root_id):
+                if not _reads(G.ast_nodes[node_id]):
+                    continue
+                binding = G.symbols.binding(node_id)
+                if binding in self._live:
+                    self._live[binding] -= 1
+                    if self._live[binding] == 0:
+                        self._worklist.append(binding)
+
+
+def _reads(node: ast.AST) -> bool:
+    return isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)
 
-    def visit_Assign(self, node):
-        if len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
-            if node.targets[0].id in self.redundant_vars:
-                return None 
-        return self.generic_visit(node)
 
 def find_redundant_variables(G: CodeGraph):
-    redundant_vars = set()
-    for _, node in G.our_nodes.items():
-        if isinstance(node.ast_node, ast.Assign) and len(node.ast_node.targets) == 1:
-            target = node.ast_node.targets[0]
-            if isinstance(target, ast.Name) and not is_variable_used(G, target.id):
-                redundant_vars.add(target.id)
-    return redundant_vars
+    """
+    names of the local variables whose assignments are dead
+    """
+    return {binding.name for binding in DeadStoreEliminator(G).run().dead}
+
 
 def is_variable_used(G: CodeGraph, var_name):
-    for node in ast.walk(G.ast_tree):
-        if isinstance(node, ast.Name) and node.id == var_name and isinstance(node.ctx, ast.Load):
-            return True
-    return False
+    return any(binding.uses for binding in G.symbols.named(var_name))
+
 
 def remove_redundant_variables(G: CodeGraph):
-    redundant_vars = find_redundant_variables(G)
-    transformer = RedundantVariableRemover(redundant_vars)
-    new_ast = transformer.visit(G.ast_tree)
-    ast.fix_missing_locations(new_ast)
-    G.refresh()
-    return G
\ No newline at end of file
+    """
+    removes the assignments to local variables that are never read, with a single refresh
+    """
+    return DeadStoreEliminator(G).run().apply()